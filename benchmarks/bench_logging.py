@@ -0,0 +1,109 @@
+"""
+Бенчмарк логирования под нагрузкой: синхронный вывод в stdout против
+очереди с фоновым потоком вывода.
+
+Виртуальные запросы пишут те же логи, что обработчик сообщений (запрос
+пользователя целиком и отметку об ответе), а вывод идет в медленный
+приемник, который имитирует забитый pipe или сборщик логов. Выводит
+задержку запросов, задержку event loop и число потерянных записей.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_logging --requests 5000 --sink-delay 0.001
+    python -m benchmarks.bench_logging --sample-rate 0.1
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import List
+
+from benchmarks.load_test import monitor_loop_lag, percentile
+
+MESSAGE = "Объясни, пожалуйста, как устроены корутины и что делает await внутри event loop. " * 20
+
+
+class SlowStream:
+    """Приемник логов, каждая запись в который блокирует поток на delay секунд"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.lines = 0
+
+    def write(self, text: str) -> None:
+        time.sleep(self.delay)
+        self.lines += 1
+
+    def flush(self) -> None:
+        pass
+
+
+async def run_mode(args: argparse.Namespace, name: str, handler: logging.Handler, stream: SlowStream) -> None:
+    from utils.logger import per_message, request_context
+
+    log = logging.getLogger(f"bench.{name}")
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.addHandler(handler)
+
+    latencies: List[float] = []
+    lags: List[float] = []
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def handle(update_id: int) -> None:
+        async def process(event, data) -> None:
+            start = time.perf_counter()
+            user_id = 1000 + update_id % 100
+            log.info(f"Получен запрос от пользователя {user_id}", extra=per_message(user_id=user_id, text=MESSAGE))
+            await asyncio.sleep(args.latency)
+            log.info(f"Отправлен ответ пользователю {user_id}", extra=per_message(user_id=user_id))
+            latencies.append(time.perf_counter() - start - args.latency)
+
+        async with slots:
+            await request_context(process, type("Update", (), {"update_id": update_id})(), {})
+
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(handle(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+    log.removeHandler(handler)
+
+    print(f"{name}:")
+    print(f"  {args.requests / elapsed:.0f} запросов/с, записано строк: {stream.lines}")
+    print(
+        f"  задержка запроса без учета ответа модели: p50 {percentile(latencies, 50) * 1000:.2f} мс, "
+        f"p99 {percentile(latencies, 99) * 1000:.2f} мс"
+    )
+    print(f"  задержка event loop: p99 {percentile(lags, 99) * 1000:.1f} мс, максимум {max(lags, default=0) * 1000:.1f} мс")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Логирование под нагрузкой")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=200, help="Запросов одновременно")
+    parser.add_argument("--latency", type=float, default=0.05, help="Ответ модели (сек)")
+    parser.add_argument("--sink-delay", type=float, default=0.001, help="Запись одной строки в приемник (сек)")
+    parser.add_argument("--sample-rate", type=float, default=1.0, help="Доля запросов с логами каждого сообщения")
+    args = parser.parse_args()
+
+    # Настройки логов читаются при импорте конфига
+    os.environ["LOG_SAMPLE_RATE"] = str(args.sample_rate)
+    os.environ["LOG_LEVEL"] = "WARNING"
+    from utils.logger import JsonFormatter, create_pipeline
+
+    sync_stream = SlowStream(args.sink_delay)
+    sync_handler = logging.StreamHandler(sync_stream)
+    sync_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    await run_mode(args, "синхронный stdout", sync_handler, sync_stream)
+
+    queue_stream = SlowStream(args.sink_delay)
+    queue_handler, listener = create_pipeline(queue_stream, JsonFormatter())
+    listener.start()
+    await run_mode(args, f"очередь, выборка {args.sample_rate:.0%}", queue_handler, queue_stream)
+    listener.stop()
+    print(f"  после остановки записано строк: {queue_stream.lines}, потеряно при переполнении: {queue_handler.dropped}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Бенчмарк памяти под истории диалогов: сколько байт занимает один
+сохраненный диалог в виде списка словарей (как раньше), в виде записей
+Message и после сжатия истории простаивающего пользователя.
+
+Замер через tracemalloc, тексты сообщений учитываются во всех режимах.
+Дополнительно выводится время распаковки истории при следующем сообщении.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_memory --users 2000 --messages 20
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import List
+
+from benchmarks.load_test import percentile
+
+SYLLABLES = "ка ро те на ли ст ра во пр ме ко ни по де ть ся ло за ви ле то ны ва ре ки ен да мо го ди".split()
+
+
+def make_words(rnd: random.Random, count: int = 5000) -> List[str]:
+    """Словарь из псевдослов, чтобы сжатие не было лучше, чем на живом тексте"""
+    return ["".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4))) for _ in range(count)]
+
+
+def make_text(rnd: random.Random, vocabulary: List[str], words: int) -> str:
+    return " ".join(rnd.choice(vocabulary) for _ in range(words)).capitalize() + "."
+
+
+def make_conversation(rnd: random.Random, vocabulary: List[str], messages: int) -> str:
+    """История в том виде, в каком она лежала в SQLite до появления Message"""
+    history = []
+    for i in range(messages):
+        # Вопросы короткие, ответы длинные
+        role = "user" if i % 2 == 0 else "assistant"
+        words = rnd.randint(5, 40) if role == "user" else rnd.randint(40, 250)
+        content = make_text(rnd, vocabulary, words)
+        history.append({"role": role, "content": content, "tokens": len(content) // 3 + 5})
+    return json.dumps(history, ensure_ascii=False)
+
+
+def measure(build) -> tuple:
+    """Память, занятую результатом build, и сам результат"""
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return used, result
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Память под истории диалогов")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20, help="Сообщений в истории каждого пользователя")
+    args = parser.parse_args()
+
+    os.environ["LOG_LEVEL"] = "WARNING"
+    from core.history import loads_history
+    from core.state import StateStore
+
+    rnd = random.Random(42)
+    vocabulary = make_words(rnd)
+    stored = [make_conversation(rnd, vocabulary, args.messages) for _ in range(args.users)]
+    text_bytes = sum(len(data.encode("utf-8")) for data in stored)
+    print(f"Пользователей: {args.users}, сообщений в истории: {args.messages}, "
+          f"JSON истории: {text_bytes / args.users:.0f} байт")
+
+    legacy, dicts = measure(lambda: [json.loads(data) for data in stored])
+    # Сами строки текстов одинаковы во всех режимах, отдельно показываем служебную часть
+    texts = sum(sys.getsizeof(message["content"]) for history in dicts for message in history)
+    per_message = args.users * args.messages
+    print(f"  тексты сообщений: {texts / args.users:.0f} байт на диалог")
+    print(f"  список словарей: {legacy / args.users:.0f} байт на диалог, "
+          f"служебных {(legacy - texts) / per_message:.0f} байт на сообщение")
+    del dicts
+
+    store = StateStore(compress_after=0)
+
+    def fill() -> None:
+        for user_id, data in enumerate(stored):
+            store.get_state(user_id).history = loads_history(data)
+
+    compact, _ = measure(fill)
+    print(f"  записи Message: {compact / args.users:.0f} байт на диалог ({1 - compact / legacy:.0%} меньше), "
+          f"служебных {(compact - texts) / per_message:.0f} байт на сообщение")
+
+    # Сжимаем все истории, как у простаивающих пользователей; в памяти остаются только сжатые данные
+    await store.compress_idle()
+    packed = sum(len(store.get_state(user_id).packed or b"") for user_id in range(args.users))
+    states = [store.get_state(user_id) for user_id in range(args.users)]
+    print(f"  сжатые истории: {packed / args.users:.0f} байт на диалог ({1 - packed / legacy:.0%} меньше)")
+
+    # Распаковка при следующем сообщении пользователя
+    timings: List[float] = []
+    for state in states:
+        start = time.perf_counter()
+        await store.load_history(state)
+        timings.append(time.perf_counter() - start)
+    print(
+        f"  распаковка при следующем сообщении: p50 {percentile(timings, 50) * 1e6:.0f} мкс, "
+        f"p99 {percentile(timings, 99) * 1e6:.0f} мкс"
+    )
+    await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
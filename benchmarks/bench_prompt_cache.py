@@ -0,0 +1,89 @@
+"""
+Бенчмарк кэша промптов на длинных диалогах: сравнивает скользящее окно
+истории, сдвигающееся на каждом ходе, со сдвигом окна блоками.
+
+Клиент OpenAI работает с фейковым бэкендом, который имитирует кэш промптов:
+совпавший префикс сообщений не тратит время на обработку (prefill) и
+учитывается в cached_tokens. Выводит долю токенов из кэша, задержку
+ответа и стоимость.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_prompt_cache --users 10 --turns 60
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import List
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.load_test import percentile
+
+MESSAGE = "Расскажи подробнее, как работает асинхронность в Python и зачем нужен event loop? " * 6
+
+
+async def run_mode(args: argparse.Namespace, fake: FakeOpenAI, block_fraction: float) -> None:
+    from core.openai_client import OpenAIClient
+    from core.scheduler import RequestScheduler
+
+    # Лимиты OpenAI здесь не проверяем — сравниваем только сборку запроса
+    client = OpenAIClient(scheduler=RequestScheduler({}, {"rpm": 10 ** 9, "tpm": 10 ** 12}, max_concurrent=1000))
+    client.stable_prefix = block_fraction > 0
+    client.context.block_fraction = block_fraction
+
+    latencies: List[float] = []
+    cost = 0.0
+
+    async def user(user_id: int) -> None:
+        nonlocal cost
+        for turn in range(args.turns):
+            start = time.perf_counter()
+            result = await client.get_completion(user_id, f"{user_id}/{turn}. {MESSAGE}")
+            latencies.append(time.perf_counter() - start)
+            cost += result.input_cost + result.output_cost
+
+    await asyncio.gather(*(user(1000 + u) for u in range(args.users)))
+
+    name = f"блоками по {block_fraction:.0%} бюджета" if block_fraction else "скользящее окно"
+    hit_rate = fake.cached_tokens / fake.prompt_tokens if fake.prompt_tokens else 0
+    print(f"{name}:")
+    print(f"  токенов запроса {fake.prompt_tokens}, из кэша {fake.cached_tokens} ({hit_rate:.0%})")
+    print(
+        f"  задержка ответа: p50 {percentile(latencies, 50) * 1000:.0f} мс, "
+        f"p95 {percentile(latencies, 95) * 1000:.0f} мс"
+    )
+    print(f"  стоимость: ${cost:.4f}")
+
+    # Следующий режим начинает с чистой статистики и пустого кэша
+    fake.prompt_tokens = fake.cached_tokens = 0
+    fake._prefixes.clear()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Кэш промптов на длинных диалогах")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=60, help="Ходов в каждом диалоге")
+    parser.add_argument("--latency", type=float, default=0.05, help="Базовая задержка OpenAI (сек)")
+    parser.add_argument("--prefill-delay", type=float, default=0.0001,
+                        help="Обработка одного некэшированного токена запроса (сек)")
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(latency=args.latency, completion_tokens=args.completion_tokens,
+                      prefill_delay=args.prefill_delay)
+    # Окружение настраиваем до импорта конфига бота
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    os.environ["OPENAI_BASE_URL"] = await fake.start()
+    os.environ["STATE_DB_PATH"] = ""
+    os.environ["USAGE_DB_PATH"] = ""
+    os.environ["LOG_LEVEL"] = "WARNING"
+
+    from core.config import WINDOW_BLOCK_FRACTION
+
+    await run_mode(args, fake, 0.0)
+    await run_mode(args, fake, WINDOW_BLOCK_FRACTION or 0.25)
+    await fake.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
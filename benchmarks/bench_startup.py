@@ -0,0 +1,121 @@
+"""
+Бенчмарк запуска бота: время до готовности и задержка первого сообщения.
+
+Каждый замер — новый процесс Python, поэтому в него входят импорт
+библиотек, сборка диспетчера и загрузка токенизатора. Готовность —
+момент, когда диспетчер запущен и может принимать апдейты (как перед
+start_polling). Затем через --delay секунд приходит первое сообщение,
+и замеряется время до полного ответа от фейкового OpenAI.
+
+Режимы:
+    eager   — SDK OpenAI и tiktoken импортируются до сборки диспетчера, прогрева нет
+    lazy    — тяжелые импорты отложены до первого сообщения, прогрева нет
+    prewarm — отложенные импорты и фоновый прогрев после старта
+
+Словари tiktoken берутся из --cache-dir; если их там нет и нет сети,
+токены считаются приблизительно (это видно в колонке «токенизатор»).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_startup --runs 5 --delay 1
+    python -m benchmarks.bench_startup --runs 5 --delay 0 --cache-dir data/tiktoken
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+from benchmarks.fake_openai import FakeOpenAI
+
+MODES = ("eager", "lazy", "prewarm")
+RESULT_PREFIX = "RESULT "
+
+
+async def child(args: argparse.Namespace) -> None:
+    """Один запуск бота в отдельном процессе; окружение настраивает родитель"""
+    if args.child == "eager":
+        # Так стартовал бот до отложенных импортов
+        import openai  # noqa: F401
+        import tiktoken  # noqa: F401
+
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+    from benchmarks.fake_telegram import FakeTelegramSession, UpdateFeeder
+    from main import create_dispatcher
+
+    session = FakeTelegramSession()
+    bot = Bot(token="42:FAKE", session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = create_dispatcher()
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    ready = time.time()
+
+    await asyncio.sleep(args.delay)
+    start = time.perf_counter()
+    await UpdateFeeder(dp, bot).send(1001, "Привет! Расскажи коротко, что ты умеешь.")
+    first = time.perf_counter() - start
+
+    from core.config import DEFAULT_MODEL, MODELS
+    from core.tokens import get_encoding
+
+    tokenizer = get_encoding(MODELS[DEFAULT_MODEL]["name"]) is not None
+    await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+    print(RESULT_PREFIX + json.dumps({"ready": ready, "first": first, "tokenizer": tokenizer}), flush=True)
+
+
+async def run_once(mode: str, args: argparse.Namespace, base_url: str) -> dict:
+    """Запускает процесс бота и возвращает его замеры"""
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY="sk-fake", OPENAI_BASE_URL=base_url,
+        CACHE_DB_PATH="", STATE_DB_PATH="", USAGE_DB_PATH="", LOG_LEVEL="WARNING",
+        STARTUP_PREWARM="1" if mode == "prewarm" else "0",
+        TIKTOKEN_CACHE_DIR=args.cache_dir,
+    )
+    spawned = time.time()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "benchmarks.bench_startup", "--child", mode, "--delay", str(args.delay),
+        env=env, stdout=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await process.communicate()
+    for line in stdout.decode().splitlines():
+        if line.startswith(RESULT_PREFIX):
+            result = json.loads(line[len(RESULT_PREFIX):])
+            result["ready"] -= spawned
+            return result
+    raise RuntimeError(f"Процесс бота ({mode}) завершился без результата, код {process.returncode}")
+
+
+async def run(args: argparse.Namespace) -> None:
+    fake = FakeOpenAI(latency=args.latency)
+    base_url = await fake.start()
+
+    print(f"Запусков на режим: {args.runs}, первое сообщение через {args.delay:.1f} с после готовности")
+    print(f"{'режим':<8} {'готовность':>11} {'1-е сообщение':>14} {'готовность+1-е':>15}  токенизатор")
+    for mode in args.modes:
+        results = [await run_once(mode, args, base_url) for _ in range(args.runs)]
+        ready = statistics.median(r["ready"] for r in results)
+        first = statistics.median(r["first"] for r in results)
+        tokenizer = "да" if all(r["tokenizer"] for r in results) else "нет (оценка)"
+        print(f"{mode:<8} {ready * 1000:>9.0f} мс {first * 1000:>11.0f} мс {(ready + first) * 1000:>12.0f} мс  {tokenizer}")
+
+    await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время запуска бота и задержка первого сообщения")
+    parser.add_argument("--runs", type=int, default=3, help="Запусков на каждый режим (берется медиана)")
+    parser.add_argument("--delay", type=float, default=1.0,
+                        help="Через сколько секунд после готовности приходит первое сообщение")
+    parser.add_argument("--latency", type=float, default=0.2, help="Задержка фейкового OpenAI (сек)")
+    parser.add_argument("--cache-dir", default="data/tiktoken", help="Каталог кэша словарей tiktoken")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    asyncio.run(child(args) if args.child else run(args))
+
+
+if __name__ == "__main__":
+    main()
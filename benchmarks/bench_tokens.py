@@ -0,0 +1,83 @@
+"""
+Микробенчмарк учета токенов: сравнивает полный пересчет истории на каждом ходе
+с тем, что делает бот: make_message для нового сообщения и
+ContextManager.build по сохраненным счетчикам с бюджетом модели по умолчанию.
+
+Время хода бота выводится по частям — кодирование нового сообщения и сборка
+окна; обе не должны расти с длиной истории. Без словаря tiktoken (нет сети и
+локального кэша) токены оцениваются по длине текста, и сравнение теряет смысл —
+бенчмарк об этом предупреждает.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_tokens
+"""
+import asyncio
+import time
+
+from core.config import DEFAULT_MODEL, MODELS
+from core.context import ContextManager
+from core.state import StateStore
+from core.tokens import TokenCounter, count_text, MESSAGE_OVERHEAD
+
+# Модель и бюджет истории, с которыми работает бот
+MODEL_INFO = MODELS[DEFAULT_MODEL]
+MODEL = MODEL_INFO["name"]
+SYSTEM_PROMPT = (
+    "Ты — полезный ассистент, который отвечает на русском языке. "
+    "Твои ответы должны быть информативными и полезными."
+)
+MESSAGE = "Расскажи подробнее, как работает асинхронность в Python и зачем нужен event loop? " * 5
+TURNS = 20
+
+
+def legacy_turn(history) -> int:
+    """Старое поведение: кодируем системный промпт и всю историю заново"""
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + history
+    return sum(MESSAGE_OVERHEAD + count_text(m["content"], MODEL) for m in messages)
+
+
+async def no_summary(user_id, previous, messages) -> str:
+    return ""
+
+
+async def main():
+    counter = TokenCounter()
+    store = StateStore()
+    context = ContextManager(counter, store, no_summary)
+    # Прогреваем токенизатор, чтобы не мерить загрузку словаря
+    if await counter.encoding(MODEL) is None:
+        print("ВНИМАНИЕ: токенизатор недоступен, токены оцениваются по длине текста — результаты не показательны")
+
+    for history_len in (10, 100, 1000):
+        base = [{"role": "user", "content": MESSAGE} for _ in range(history_len)]
+
+        start = time.perf_counter()
+        for _ in range(TURNS):
+            legacy_turn(base + [{"role": "user", "content": MESSAGE}])
+        legacy_ms = (time.perf_counter() - start) / TURNS * 1000
+
+        state = store.get_state(history_len)
+        state.history = [await counter.make_message("user", MESSAGE, MODEL) for _ in range(history_len)]
+        # У бота история не длиннее окна: первый ход один раз обрезает накопленное, его не меряем
+        state.history, _, _ = context.build(state, SYSTEM_PROMPT, MODEL_INFO)
+        await asyncio.sleep(0)
+        encode = build = 0.0
+        for _ in range(TURNS):
+            start = time.perf_counter()
+            message = await counter.make_message("user", MESSAGE, MODEL)
+            encode += time.perf_counter() - start
+            state.history.append(message)
+            start = time.perf_counter()
+            state.history, _, _ = context.build(state, SYSTEM_PROMPT, MODEL_INFO)
+            build += time.perf_counter() - start
+
+        print(
+            f"история {history_len:>5} сообщений: полный пересчет {legacy_ms:8.3f} мс/ход, "
+            f"бот: новое сообщение {encode / TURNS * 1000:6.3f} мс + окно {build / TURNS * 1000:6.3f} мс"
+        )
+
+    counter.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
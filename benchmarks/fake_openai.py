@@ -0,0 +1,200 @@
+"""
+Локальный сервер, имитирующий OpenAI Chat Completions API.
+
+Поддерживает обычные и потоковые (SSE) ответы, настраиваемую задержку
+и подмешивание ответов 429 с заголовком Retry-After. Имитирует кэш
+промптов OpenAI: совпавший с прошлыми запросами префикс сообщений
+учитывается в cached_tokens и не тратит время на обработку.
+
+Запуск отдельно:
+    python -m benchmarks.fake_openai --port 8081 --latency 0.5 --rate-429 0.05
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeOpenAI:
+    """
+    Фейковый бэкенд OpenAI.
+
+    Args:
+        latency: Задержка до первого токена (сек)
+        token_delay: Задержка между токенами ответа (сек)
+        completion_tokens: Сколько токенов в ответе
+        rate_429: Доля запросов, на которые отвечаем 429
+        retry_after: Значение Retry-After для ответов 429 (сек)
+        slow_rate: Доля запросов с дополнительной задержкой slow_latency
+        slow_latency: Дополнительная задержка медленных запросов (сек)
+        prefill_delay: Время обработки одного некэшированного токена запроса (сек)
+    """
+
+    # Как у OpenAI: кэшируются префиксы от 1024 токенов с шагом 128
+    CACHE_MIN_TOKENS = 1024
+    CACHE_STEP = 128
+
+    def __init__(self, latency: float = 0.2, token_delay: float = 0.0, completion_tokens: int = 50,
+                 rate_429: float = 0.0, retry_after: float = 0.5, slow_rate: float = 0.0,
+                 slow_latency: float = 5.0, prefill_delay: float = 0.0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.completion_tokens = completion_tokens
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.prefill_delay = prefill_delay
+
+        self.requests = 0
+        self.rate_limited = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._prefixes = set()  # Хэши префиксов сообщений уже обработанных запросов
+        self._runner: Optional[web.AppRunner] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle)
+        app.router.add_get("/v1/models/{model}", self.handle_model)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает base_url для клиента OpenAI"""
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle_model(self, request: web.Request) -> web.Response:
+        """Информация о модели — ее запрашивает прогрев клиента"""
+        return web.json_response({
+            "id": request.match_info["model"], "object": "model", "created": 0, "owned_by": "fake",
+        })
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+
+        if random.random() < self.rate_429:
+            self.rate_limited += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers={"retry-after": str(self.retry_after)},
+            )
+
+        prompt_tokens, cached_tokens = self._prompt_cache(body.get("messages", []))
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+
+        latency = self.latency + (prompt_tokens - cached_tokens) * self.prefill_delay
+        if random.random() < self.slow_rate:
+            latency += self.slow_latency
+        await asyncio.sleep(latency)
+
+        model = body.get("model", "gpt-4.1-nano")
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": prompt_tokens + self.completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        words = [f"слово{i} " for i in range(self.completion_tokens)]
+
+        if not body.get("stream"):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay * self.completion_tokens)
+            return web.json_response({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(words)},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await response.prepare(request)
+            for word in words:
+                await self._send_chunk(response, model, [{"index": 0, "delta": {"content": word}, "finish_reason": None}])
+                if self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+            await self._send_chunk(response, model, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            await self._send_chunk(response, model, [], usage)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # Клиент отменил запрос (например, проигравший дублирующий запрос)
+            pass
+        return response
+
+    def _prompt_cache(self, messages: list) -> tuple:
+        """Возвращает (токены запроса, из них найдено в кэше) и запоминает префиксы запроса"""
+        digest = hashlib.sha256()
+        tokens = 0
+        cached = 0
+        seen = []
+        for message in messages:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            tokens += len(message.get("content", "")) // 3 + 4
+            key = digest.hexdigest()
+            if key in self._prefixes:
+                cached = tokens
+            seen.append(key)
+
+        if len(self._prefixes) > 1_000_000:
+            self._prefixes.clear()
+        self._prefixes.update(seen)
+        if cached < self.CACHE_MIN_TOKENS:
+            return tokens, 0
+        return tokens, cached - cached % self.CACHE_STEP
+
+    @staticmethod
+    async def _send_chunk(response: web.StreamResponse, model: str, choices: list, usage: Optional[dict] = None):
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            "usage": usage,
+        }
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--prefill-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(args.latency, args.token_delay, args.completion_tokens, args.rate_429, args.retry_after,
+                      prefill_delay=args.prefill_delay)
+    web.run_app(fake.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
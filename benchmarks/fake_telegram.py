@@ -0,0 +1,94 @@
+"""
+Фейковый Telegram: сессия aiogram без сети и генератор входящих апдейтов.
+
+Сессия отвечает на методы Bot API так, как ответил бы Telegram, и
+записывает время отправок и правок, чтобы считать время до первого
+видимого текста.
+"""
+import asyncio
+import itertools
+import json
+import time
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Update
+
+PLACEHOLDERS = {"⏳"}
+
+
+class FakeTelegramSession(BaseSession):
+    """
+    Сессия aiogram, которая не ходит в сеть.
+
+    Args:
+        api_latency: Имитация задержки Bot API на каждый вызов (сек)
+    """
+
+    def __init__(self, api_latency: float = 0.0):
+        super().__init__()
+        self.api_latency = api_latency
+        self.calls: Dict[str, int] = {}
+        self.first_text_at: Dict[int, float] = {}  # chat_id -> время первого видимого текста
+        self._message_ids = itertools.count(1)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+        text = getattr(method, "text", None)
+        chat_id = getattr(method, "chat_id", None)
+        if text is not None and chat_id is not None and text not in PLACEHOLDERS:
+            self.first_text_at.setdefault(chat_id, time.perf_counter())
+
+        if name in ("sendMessage", "editMessageText"):
+            result = {
+                "message_id": getattr(method, "message_id", None) or next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+        else:
+            result = True
+
+        content = json.dumps({"ok": True, "result": result}, ensure_ascii=False)
+        return self.check_response(bot=bot, method=method, status_code=200, content=content).result
+
+    async def stream_content(self, url: str, headers: Optional[Dict[str, Any]] = None, timeout: int = 30,
+                             chunk_size: int = 65536, raise_for_status: bool = True) -> AsyncGenerator[bytes, None]:
+        yield b""
+
+    async def close(self) -> None:
+        pass
+
+
+class UpdateFeeder:
+    """Подает синтетические апдейты в настоящий диспетчер через feed_update"""
+
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        self.dp = dp
+        self.bot = bot
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def make_update(self, user_id: int, text: str) -> Update:
+        """Строит апдейт с текстовым сообщением от пользователя"""
+        data = {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text,
+            },
+        }
+        return Update.model_validate(data, context={"bot": self.bot})
+
+    async def send(self, user_id: int, text: str) -> None:
+        """Подает сообщение и ждет завершения обработки"""
+        await self.dp.feed_update(self.bot, self.make_update(user_id, text))
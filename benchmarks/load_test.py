@@ -0,0 +1,208 @@
+"""
+Нагрузочный тест бота без реальных токенов.
+
+Поднимает фейковый OpenAI, собирает настоящий диспетчер из main.py и
+прогоняет N виртуальных пользователей, каждый из которых отправляет
+сообщения по очереди, дожидаясь ответа. Выводит пропускную способность,
+перцентили задержек, задержку event loop и память на пользователя.
+
+В режиме --webhook апдейты отправляются POST-запросами на локальный
+вебхук-сервер бота; задержкой считается время приема апдейта, а
+пропускной способностью — скорость полной обработки.
+
+Запуск из корня репозитория:
+    python -m benchmarks.load_test --users 200 --messages 5 --latency 0.5 --stream
+    python -m benchmarks.load_test --users 500 --messages 2 --webhook --workers 64
+    python -m benchmarks.load_test --users 100 --messages 5 --slow-rate 0.05 --slo-mode hedge --slo-budget 1
+"""
+import argparse
+import asyncio
+import os
+import time
+import tracemalloc
+from typing import List
+
+from aiohttp import ClientSession
+
+from benchmarks.fake_openai import FakeOpenAI
+from benchmarks.fake_telegram import FakeTelegramSession, UpdateFeeder
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def monitor_loop_lag(lags: List[float], interval: float = 0.01) -> None:
+    """Замеряет, насколько event loop опаздывает с пробуждением"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def configure_environment(args: argparse.Namespace, base_url: str) -> None:
+    """Настраивает окружение до импорта конфига бота"""
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["STREAMING_ENABLED"] = "1" if args.stream else "0"
+    os.environ["CACHE_ENABLED"] = "1" if args.cache else "0"
+    os.environ["CACHE_DB_PATH"] = ""
+    os.environ["STATE_DB_PATH"] = ""
+    os.environ["USAGE_DB_PATH"] = ""
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.environ["SLO_MODE"] = args.slo_mode
+    if args.slo_mode != "off":
+        # Число дублированных запросов берем из счетчика метрик
+        os.environ["METRICS_ENABLED"] = "1"
+
+
+async def run(args: argparse.Namespace) -> None:
+    fake = FakeOpenAI(
+        latency=args.latency, token_delay=args.token_delay, completion_tokens=args.completion_tokens,
+        rate_429=args.rate_429, retry_after=args.retry_after,
+        slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+    )
+    base_url = await fake.start()
+    configure_environment(args, base_url)
+
+    # Импортируем бота только после настройки окружения
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+    from core.config import LATENCY_SLO, DEFAULT_LATENCY_SLO
+    from main import create_dispatcher
+    from utils.metrics import HEDGED_TOTAL
+
+    if args.slo_budget:
+        # Боевые бюджеты рассчитаны на настоящие модели, для фейка задаем свой
+        for slo in (*LATENCY_SLO.values(), DEFAULT_LATENCY_SLO):
+            slo["p95"] = slo["ttft_p95"] = args.slo_budget
+
+    session = FakeTelegramSession(api_latency=args.telegram_latency)
+    bot = Bot(token="42:FAKE", session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = create_dispatcher()
+    dp["user_dispatcher"].debounce = args.debounce
+
+    feeder = UpdateFeeder(dp, bot)
+    latencies: List[float] = []
+    first_text: List[float] = []
+    lags: List[float] = []
+
+    if args.webhook:
+        from utils.webhook import WebhookServer, SECRET_HEADER
+
+        server = WebhookServer(dp, bot, secret="bench", workers=args.workers, queue_size=args.queue_size)
+        port = await server.start("127.0.0.1", 0)
+        http = ClientSession()
+        url = f"http://127.0.0.1:{port}/webhook"
+        rejected = 0
+
+        async def virtual_user(user_id: int) -> None:
+            nonlocal rejected
+            for i in range(args.messages):
+                update = feeder.make_update(user_id, f"Вопрос номер {i} от пользователя {user_id}")
+                start = time.perf_counter()
+                async with http.post(url, data=update.model_dump_json(exclude_none=True),
+                                     headers={SECRET_HEADER: "bench", "Content-Type": "application/json"}) as response:
+                    if response.status != 200:
+                        rejected += 1
+                latencies.append(time.perf_counter() - start)
+    else:
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+
+        async def virtual_user(user_id: int) -> None:
+            for i in range(args.messages):
+                session.first_text_at.pop(user_id, None)
+                start = time.perf_counter()
+                await feeder.send(user_id, f"Вопрос номер {i} от пользователя {user_id}")
+                latencies.append(time.perf_counter() - start)
+                if user_id in session.first_text_at:
+                    first_text.append(session.first_text_at[user_id] - start)
+
+    if args.memory:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0] if args.memory else 0
+
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(1000 + u) for u in range(args.users)))
+    if args.webhook:
+        # Ждем, пока воркеры обработают все принятые апдейты
+        await server.queue.join()
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    memory = tracemalloc.get_traced_memory()[0] - baseline if args.memory else 0
+    if args.memory:
+        tracemalloc.stop()
+
+    if args.webhook:
+        await http.close()
+        await server.stop()
+    else:
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+    await fake.stop()
+
+    total = args.users * args.messages
+    print(f"Пользователей: {args.users}, сообщений: {total}, время: {elapsed:.2f} с")
+    print(f"Пропускная способность: {total / elapsed:.1f} сообщений/с")
+    if args.webhook:
+        print(f"Отклонено вебхуком (503): {rejected}")
+    print(
+        f"{'Прием апдейта' if args.webhook else 'Задержка ответа'}: p50 {percentile(latencies, 50) * 1000:.0f} мс, "
+        f"p95 {percentile(latencies, 95) * 1000:.0f} мс, p99 {percentile(latencies, 99) * 1000:.0f} мс"
+    )
+    if first_text:
+        print(
+            f"До первого текста: p50 {percentile(first_text, 50) * 1000:.0f} мс, "
+            f"p95 {percentile(first_text, 95) * 1000:.0f} мс, p99 {percentile(first_text, 99) * 1000:.0f} мс"
+        )
+    print(
+        f"Задержка event loop: p99 {percentile(lags, 99) * 1000:.1f} мс, "
+        f"максимум {max(lags, default=0) * 1000:.1f} мс"
+    )
+    print(f"Запросов к OpenAI: {fake.requests}, из них 429: {fake.rate_limited}")
+    hedged = {}
+    # При выключенных метриках счетчик — заглушка без значений
+    for labels, value in getattr(HEDGED_TOTAL, "values", {}).items():
+        hedged[labels[2]] = hedged.get(labels[2], 0) + value
+    if hedged:
+        print(f"Дублировано запросов ({args.slo_mode}): {sum(hedged.values()):.0f}, "
+              f"запасной ответил первым: {hedged.get('backup', 0):.0f}")
+    print(f"Вызовы Bot API: {session.calls}")
+    if args.memory:
+        print(f"Память на активного пользователя: {memory / args.users:.0f} байт")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на фейковых бэкендах")
+    parser.add_argument("--users", type=int, default=50, help="Число одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument("--latency", type=float, default=0.3, help="Задержка OpenAI до первого токена (сек)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Задержка между токенами (сек)")
+    parser.add_argument("--completion-tokens", type=int, default=50)
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Доля медленных ответов OpenAI")
+    parser.add_argument("--slow-latency", type=float, default=5.0, help="Доп. задержка медленных ответов (сек)")
+    parser.add_argument("--slo-mode", choices=("off", "hedge", "fallback"), default="off",
+                        help="Что делать при превышении бюджета задержки")
+    parser.add_argument("--slo-budget", type=float, default=0.0,
+                        help="Бюджет задержки для всех моделей (сек), 0 — из конфига")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="Задержка Bot API (сек)")
+    parser.add_argument("--debounce", type=float, default=0.0, help="Окно объединения сообщений (сек)")
+    parser.add_argument("--stream", action="store_true", help="Потоковые ответы")
+    parser.add_argument("--cache", action="store_true", help="Включить кэш ответов")
+    parser.add_argument("--memory", action="store_true", help="Замерять память через tracemalloc")
+    parser.add_argument("--webhook", action="store_true", help="Подавать апдейты через вебхук-сервер")
+    parser.add_argument("--workers", type=int, default=64, help="Воркеров вебхука")
+    parser.add_argument("--queue-size", type=int, default=1000, help="Размер очереди вебхука")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
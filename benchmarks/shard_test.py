@@ -0,0 +1,165 @@
+"""
+Нагрузочный тест шардированного режима.
+
+Поднимает фейковые OpenAI в отдельных процессах, запускает фронт с N
+воркерами (каждый — настоящий диспетчер из main.py с фейковым Bot API) и
+прогоняет через него апдейты пользователей. Для каждого числа воркеров
+выводит пропускную способность и распределение апдейтов по шардам.
+С --kill-after один воркер убивается посреди прогона, чтобы проверить,
+что после перезапуска все апдейты все равно обработаны.
+
+Запуск из корня репозитория:
+    python -m benchmarks.shard_test --shards 1,2,4 --users 400 --messages 3 --stream
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import time
+from typing import List
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+def make_update(update_id: int, user_id: int, text: str) -> bytes:
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "text": text,
+        },
+    }, ensure_ascii=False).encode("utf-8")
+
+
+async def run_shards(args: argparse.Namespace, shards: int, worker_command: List[str]) -> None:
+    from utils.sharding import ShardRouter
+
+    # Воркеры делят лимиты OpenAI поровну, как в боевом режиме
+    os.environ["SHARD_COUNT"] = str(shards)
+    router = ShardRouter(shards, worker_command, restart_delay=0.2)
+    await router.start()
+
+    killer = None
+    if args.kill_after:
+        async def kill_one():
+            await asyncio.sleep(args.kill_after)
+            router.shards[0].process.send_signal(signal.SIGKILL)
+        killer = asyncio.create_task(kill_one())
+
+    total = args.users * args.messages
+    started = time.perf_counter()
+    update_id = 0
+    for message in range(args.messages):
+        for user in range(args.users):
+            update_id += 1
+            await router.route(make_update(update_id, 1000 + user, f"Вопрос {message} от пользователя {user}"))
+    await router.join()
+    elapsed = time.perf_counter() - started
+
+    if killer is not None:
+        killer.cancel()
+    await router.stop()
+
+    per_shard = ", ".join(str(shard.processed) for shard in router.shards)
+    restarts = sum(shard.restarts for shard in router.shards)
+    print(
+        f"Воркеров: {shards}, апдейтов: {total}, время: {elapsed:.2f} с, "
+        f"{total / elapsed:.1f} апдейтов/с; по шардам: {per_shard}; перезапусков: {restarts}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    # Фейковые OpenAI в отдельных процессах, чтобы бэкенд не стал узким местом
+    ports = [free_port() for _ in range(args.fake_processes)]
+    fakes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "benchmarks.fake_openai", "--port", str(port), "--latency", str(args.latency),
+            "--completion-tokens", str(args.completion_tokens), "--token-delay", str(args.token_delay),
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL,
+        )
+        for port in ports
+    ]
+    try:
+        for port in ports:
+            await wait_port(port)
+        os.environ["FAKE_OPENAI_URLS"] = ",".join(f"http://127.0.0.1:{port}/v1" for port in ports)
+        os.environ["STREAMING_ENABLED"] = "1" if args.stream else "0"
+
+        worker_command = [sys.executable, "-m", "benchmarks.shard_test", "--worker"]
+        print(f"Ядер: {os.cpu_count()}")
+        for shards in (int(value) for value in args.shards.split(",")):
+            await run_shards(args, shards, worker_command)
+    finally:
+        for fake in fakes:
+            fake.terminate()
+            await fake.wait()
+
+
+async def run_worker_process(fd: int, index: int) -> None:
+    """Воркер с фейковым Bot API; OpenAI — один из фейковых процессов"""
+    urls = os.environ["FAKE_OPENAI_URLS"].split(",")
+    os.environ["OPENAI_API_KEY"] = "sk-fake"
+    os.environ["OPENAI_BASE_URL"] = urls[index % len(urls)]
+    os.environ["STATE_DB_PATH"] = ""
+    os.environ["CACHE_ENABLED"] = "0"
+    os.environ["USAGE_DB_PATH"] = ""
+    os.environ["LOG_LEVEL"] = "WARNING"
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    from aiogram import Bot
+    from aiogram.client.default import DefaultBotProperties
+    from aiogram.enums import ParseMode
+    from benchmarks.fake_telegram import FakeTelegramSession
+    from main import create_dispatcher
+    from utils.sharding import run_worker
+
+    bot = Bot(token="42:FAKE", session=FakeTelegramSession(),
+              default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = create_dispatcher(shards=int(os.environ["SHARD_COUNT"]))
+    dp["user_dispatcher"].debounce = 0
+    await run_worker(dp, bot, socket.socket(fileno=fd))
+
+
+def main():
+    if sys.argv[1:2] == ["--worker"]:
+        asyncio.run(run_worker_process(int(sys.argv[2]), int(sys.argv[3])))
+        return
+
+    parser = argparse.ArgumentParser(description="Нагрузочный тест шардированного режима")
+    parser.add_argument("--shards", default="1,2,4", help="Числа воркеров через запятую")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=3, help="Сообщений от каждого пользователя")
+    parser.add_argument("--latency", type=float, default=0.1, help="Задержка OpenAI до первого токена (сек)")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="Задержка между токенами (сек)")
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--stream", action="store_true", help="Потоковые ответы")
+    parser.add_argument("--fake-processes", type=int, default=2, help="Процессов фейкового OpenAI")
+    parser.add_argument("--kill-after", type=float, default=0.0, help="Убить воркер 0 через столько секунд")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
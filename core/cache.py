@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+from utils.logger import logger
+
+
+def normalize(text: str) -> str:
+    """Нормализует текст для ключа кэша: лишние пробелы не влияют на ответ"""
+    return " ".join(text.split())
+
+
+def make_key(model_name: str, messages: List[Dict[str, Any]]) -> str:
+    """
+    Строит ключ кэша по модели и списку сообщений (включая системный промпт)
+
+    Args:
+        model_name: Название модели
+        messages: Сообщения для API
+
+    Returns:
+        Хэш запроса
+    """
+    payload = json.dumps(
+        [model_name] + [[m["role"], normalize(m["content"])] for m in messages],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _DiskTier:
+    """Дисковый уровень кэша на SQLite; все операции выполняются в отдельном потоке"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def get(self, key: str, ttl: float) -> Optional[str]:
+        row = self._db.execute(
+            "SELECT value FROM completions WHERE key = ? AND created > ?", (key, time.time() - ttl)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, value: str) -> None:
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO completions (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+
+    def prune(self, ttl: float, max_entries: int) -> None:
+        with self._db:
+            self._db.execute("DELETE FROM completions WHERE created <= ?", (time.time() - ttl,))
+            self._db.execute(
+                "DELETE FROM completions WHERE key NOT IN "
+                "(SELECT key FROM completions ORDER BY created DESC LIMIT ?)",
+                (max_entries,),
+            )
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class CompletionCache:
+    """
+    Кэш ответов модели с ограничением по времени жизни, числу записей и объему.
+
+    Память — LRU; при наличии пути к базе используется дисковый уровень,
+    который переживает перезапуск. Считает попадания и промахи.
+    """
+
+    def __init__(self, ttl: float = 24 * 3600, max_entries: int = 5000,
+                 max_bytes: int = 32 * 1024 * 1024, db_path: Optional[str] = None,
+                 disk_max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # ключ -> (ответ, время записи)
+        self._bytes = 0
+        self._disk = _DiskTier(db_path) if db_path else None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache") if self._disk else None
+        self._puts = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    async def get(self, key: str) -> Optional[str]:
+        """
+        Возвращает сохраненный ответ или None
+
+        Args:
+            key: Ключ запроса (см. make_key)
+
+        Returns:
+            Текст ответа или None
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, created = entry
+            if time.monotonic() - created < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self._remove(key)
+
+        if self._disk is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                value = await loop.run_in_executor(self._executor, self._disk.get, key, self.ttl)
+            except Exception as e:
+                logger.warning(f"Ошибка чтения дискового кэша: {e}")
+                value = None
+            if value is not None:
+                self._store(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        """
+        Сохраняет ответ; запись на диск выполняется в фоне
+
+        Args:
+            key: Ключ запроса
+            value: Текст ответа
+        """
+        self._store(key, value)
+        if self._disk is None:
+            return
+
+        self._puts += 1
+        future = self._executor.submit(self._disk.put, key, value)
+        future.add_done_callback(self._log_disk_error)
+        # Время от времени чистим устаревшие и лишние записи на диске
+        if self._puts % 1000 == 0:
+            future = self._executor.submit(self._disk.prune, self.ttl, self.disk_max_entries)
+            future.add_done_callback(self._log_disk_error)
+
+    def close(self) -> None:
+        """Дожидается записи на диск и закрывает базу"""
+        if self._disk is not None:
+            self._executor.shutdown(wait=True)
+            self._disk.close()
+
+    def _store(self, key: str, value: str) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, time.monotonic())
+        self._bytes += len(value)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._bytes -= len(value)
+
+    @staticmethod
+    def _log_disk_error(future) -> None:
+        error = future.exception()
+        if error is not None:
+            logger.warning(f"Ошибка записи дискового кэша: {error}")
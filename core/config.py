@@ -7,6 +7,7 @@ load_dotenv()
 # Токены и ключи
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")  # Свой адрес API (прокси, локальный стенд)
 
 # Настройки OpenAI
 MAX_TOKENS = 5000  # Максимальное количество токенов в ответе
@@ -15,17 +16,127 @@ MAX_TOKENS = 5000  # Максимальное количество токено
 ADMINS = [165879072, 5237388776, 415595998]  # Список ID администраторов бота
 
 # Словарь с моделями и их стоимостью на 1 млн токенов (в долларах)
+# history_budget — сколько токенов запроса (системный промпт + история) отправлять модели
+# cached_input_price — цена токенов запроса, взятых из кэша промптов OpenAI
 MODELS = {
-    "gpt-4.1": {"name": "gpt-4.1", "input_price": 2.00, "output_price": 8.00},
-    "gpt-4.1-mini": {"name": "gpt-4.1-mini", "input_price": 0.40, "output_price": 1.60},
-    "gpt-4.1-nano": {"name": "gpt-4.1-nano", "input_price": 0.10, "output_price": 0.40},
-    "gpt-4o": {"name": "gpt-4o", "input_price": 2.50, "output_price": 10.00},
-    "gpt-4o-mini": {"name": "gpt-4o-mini", "input_price": 0.15, "output_price": 0.60},
-    "o4-mini": {"name": "o4-mini", "input_price": 1.10, "output_price": 4.40},
+    "gpt-4.1": {"name": "gpt-4.1", "input_price": 2.00, "cached_input_price": 0.50, "output_price": 8.00, "history_budget": 8000},
+    "gpt-4.1-mini": {"name": "gpt-4.1-mini", "input_price": 0.40, "cached_input_price": 0.10, "output_price": 1.60, "history_budget": 8000},
+    "gpt-4.1-nano": {"name": "gpt-4.1-nano", "input_price": 0.10, "cached_input_price": 0.025, "output_price": 0.40, "history_budget": 6000},
+    "gpt-4o": {"name": "gpt-4o", "input_price": 2.50, "cached_input_price": 1.25, "output_price": 10.00, "history_budget": 8000},
+    "gpt-4o-mini": {"name": "gpt-4o-mini", "input_price": 0.15, "cached_input_price": 0.075, "output_price": 0.60, "history_budget": 6000},
+    "o4-mini": {"name": "o4-mini", "input_price": 1.10, "cached_input_price": 0.275, "output_price": 4.40, "history_budget": 8000},
 }
 
 # Курс доллара к рублю
 USD_TO_RUB = 107.0
 
 # Модель по умолчанию
-DEFAULT_MODEL = "gpt-4.1-nano"
\ No newline at end of file
+DEFAULT_MODEL = "gpt-4.1-nano"
+
+# Бюджет токенов истории, если у модели он не указан
+DEFAULT_HISTORY_BUDGET = 6000
+
+# Сжатие старой части диалога в краткое содержание
+SUMMARY_MODEL = "gpt-4.1-nano"
+SUMMARY_MAX_TOKENS = 400
+# Вытесненные сообщения сжимаются, только когда их накопилось на столько токенов: один запрос на пачку, а не на каждый ход
+SUMMARY_BATCH_TOKENS = 1500
+
+# Потоковая выдача ответа с постепенным редактированием сообщения
+STREAMING_ENABLED = os.getenv("STREAMING_ENABLED", "1") == "1"
+STREAM_EDIT_INTERVAL = 1.0  # Минимальный интервал между редактированиями сообщения (сек)
+
+# Хранилище состояний пользователей (модель, системный промпт, история).
+# Пустой путь — хранить только в памяти
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "data/state.db")
+STATE_MAX_USERS = 10000  # Сколько пользователей держать в памяти
+STATE_MAX_BYTES = 256 * 1024 * 1024  # Лимит памяти под состояния пользователей
+STATE_IDLE_TTL = 3600  # Через сколько секунд простоя выгружать пользователя из памяти
+STATE_COMPRESS_AFTER = 600  # Через сколько секунд простоя сжимать историю пользователя в памяти
+STATE_FLUSH_INTERVAL = 2.0  # Период пакетной записи изменений (сек)
+
+# Сообщения пользователя, пришедшие в пределах этого окна (сек), объединяются в один запрос
+COALESCE_WINDOW = 0.3
+
+# Лимиты OpenAI по моделям: запросов (rpm) и токенов (tpm) в минуту
+RATE_LIMITS = {
+    "gpt-4.1": {"rpm": 500, "tpm": 30000},
+    "gpt-4.1-mini": {"rpm": 500, "tpm": 200000},
+    "gpt-4.1-nano": {"rpm": 500, "tpm": 200000},
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200000},
+    "o4-mini": {"rpm": 1000, "tpm": 100000},
+}
+DEFAULT_RATE_LIMIT = {"rpm": 500, "tpm": 30000}
+MAX_CONCURRENT_REQUESTS = 32  # Сколько запросов к OpenAI выполнять одновременно
+RATE_LIMIT_RETRIES = 5  # Сколько раз повторять запрос после ответа 429
+
+# Кэш ответов на одинаковые запросы (модель + системный промпт + история).
+# Выключен по умолчанию: с ним повторный вопрос получает тот же ответ, а не новый
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "0") == "1"
+CACHE_TTL = 24 * 3600  # Время жизни ответа в кэше (сек)
+CACHE_MAX_ENTRIES = 5000  # Сколько ответов держать в памяти
+CACHE_MAX_BYTES = 32 * 1024 * 1024  # Лимит памяти под ответы
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "")  # Путь к SQLite для кэша между перезапусками; пустой — только память
+
+# Логи: JSON-строки (json) или текст (text) в stdout через фоновый поток
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # Доля запросов, для которых пишутся логи каждого сообщения
+LOG_MAX_LENGTH = 500  # Длиннее обрезаются сообщение и поля записи (символов)
+LOG_QUEUE_SIZE = 10000  # Сколько записей может ждать вывода; при переполнении новые теряются
+
+# Метрики в формате Prometheus на локальном HTTP-эндпоинте /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "0") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))
+
+# Режим получения апдейтов: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Публичный адрес, например https://bot.example.com/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = 64  # Сколько апдейтов обрабатывать одновременно
+WEBHOOK_QUEUE_SIZE = 1000  # Сколько принятых апдейтов может ждать обработки
+
+# Лимиты Bot API на исходящие сообщения: всего по боту и в каждый чат (сообщений в секунду)
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без ожидания
+
+# Учет расхода токенов по данным API: агрегаты по пользователям, моделям и дням
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "data/usage.db")  # Пустой путь — только память
+USAGE_FLUSH_INTERVAL = 5.0  # Период записи накопленных счетчиков (сек)
+
+# Стабильный префикс запроса для кэша промптов OpenAI: окно истории сдвигается блоками
+PROMPT_STABLE_PREFIX = os.getenv("PROMPT_STABLE_PREFIX", "1") == "1"
+WINDOW_BLOCK_FRACTION = 0.25  # Какую долю бюджета истории освобождать при сдвиге окна
+
+# Шардирование по процессам: фронт раздает апдейты воркерам по хэшу ID пользователя (0 — один процесс)
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_MAX_PENDING = 1000  # Сколько неподтвержденных апдейтов держать на воркер
+
+# Бюджеты задержки моделей (p95, сек): после них запрос дублируется или уходит в более быструю модель.
+# p95 — ответ целиком, ttft_p95 — первый токен при потоковом ответе, fallback — модель для режима fallback
+LATENCY_SLO = {
+    "gpt-4.1": {"p95": 30.0, "ttft_p95": 5.0, "fallback": "gpt-4.1-mini"},
+    "gpt-4.1-mini": {"p95": 20.0, "ttft_p95": 3.0, "fallback": "gpt-4.1-nano"},
+    "gpt-4.1-nano": {"p95": 15.0, "ttft_p95": 2.0},
+    "gpt-4o": {"p95": 30.0, "ttft_p95": 5.0, "fallback": "gpt-4o-mini"},
+    "gpt-4o-mini": {"p95": 20.0, "ttft_p95": 3.0},
+    "o4-mini": {"p95": 60.0, "ttft_p95": 20.0, "fallback": "gpt-4.1-mini"},
+}
+DEFAULT_LATENCY_SLO = {"p95": 30.0, "ttft_p95": 5.0}
+# Режим по умолчанию: off — ждать, hedge — дублировать запрос, fallback — дублировать в более быструю модель.
+# Дублированные запросы оплачиваются, поэтому по умолчанию выключено; пользователь может включить через /speed
+SLO_MODE = os.getenv("SLO_MODE", "off")
+REQUEST_TIMEOUT = 120.0  # Предельное время одного запроса к OpenAI (сек)
+
+# Прогрев после старта: токенизаторы моделей и соединение с OpenAI загружаются в фоне, пока идет polling
+STARTUP_PREWARM = os.getenv("STARTUP_PREWARM", "1") == "1"
+PREWARM_TIMEOUT = 10.0  # Предельное время прогревочного запроса к OpenAI (сек)
+# Локальный кэш словарей tiktoken: если файлы уже там, при старте ничего не скачивается.
+# Пустая строка — не кэшировать (словари скачиваются при каждом запуске)
+TIKTOKEN_CACHE_DIR = os.getenv("TIKTOKEN_CACHE_DIR", "data/tiktoken")
@@ -0,0 +1,145 @@
+import asyncio
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+from core.config import DEFAULT_HISTORY_BUDGET, SUMMARY_BATCH_TOKENS
+from core.history import Message
+from core.state import StateStore, UserState
+from core.tokens import TokenCounter, to_api_messages
+from utils.logger import logger
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+# Функция сжатия: (ID пользователя, предыдущее краткое содержание, вытесненные сообщения) -> новое содержание
+Summarizer = Callable[[int, Optional[str], List[Message]], Awaitable[str]]
+
+
+class ContextManager:
+    """
+    Упаковывает историю диалога в бюджет токенов модели.
+
+    В запрос попадают самые свежие сообщения, которые помещаются в бюджет.
+    Вытесненные сообщения копятся в состоянии пользователя (UserState.pending)
+    и, когда их набирается на batch_tokens, в фоне сворачиваются в краткое
+    содержание, которое отправляется модели отдельным системным сообщением.
+    Сообщения убираются из очереди только после записи краткого содержания,
+    поэтому при ошибке сжатия или перезапуске они не теряются.
+
+    При block_fraction > 0 окно сдвигается блоками: при переполнении из него
+    убирается сразу такая доля бюджета, и следующие ходы только дописывают
+    сообщения в конец. Префикс запроса между ходами не меняется, и OpenAI
+    может брать его из кэша промптов.
+    """
+
+    def __init__(self, tokens: TokenCounter, store: StateStore, summarizer: Summarizer, block_fraction: float = 0.0,
+                 batch_tokens: int = SUMMARY_BATCH_TOKENS):
+        self.tokens = tokens
+        self.store = store
+        self.summarizer = summarizer
+        self.block_fraction = block_fraction
+        self.batch_tokens = batch_tokens
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    def build(self, state: UserState, system_prompt: str, model_info: Dict[str, Any]) -> tuple:
+        """
+        Формирует сообщения для API в пределах бюджета токенов
+
+        Args:
+            state: Состояние пользователя (последнее сообщение истории — текущий запрос)
+            system_prompt: Системный промпт
+            model_info: Информация о модели
+
+        Returns:
+            Кортеж (оставшаяся история, сообщения для API, токены запроса)
+        """
+        model_name = model_info["name"]
+        budget = model_info.get("history_budget", DEFAULT_HISTORY_BUDGET)
+        history = state.history
+        summary = state.summary
+
+        used = self.tokens.system_prompt_tokens(system_prompt, model_name)
+        if summary is not None:
+            used += summary.tokens
+
+        # Идем от новых сообщений к старым; текущий запрос отправляем всегда
+        start = len(history)
+        for i in range(len(history) - 1, -1, -1):
+            message_tokens = self.tokens.message_tokens(history[i], model_name)
+            if used + message_tokens > budget and i < len(history) - 1:
+                break
+            used += message_tokens
+            start = i
+
+        if start > 0 and self.block_fraction > 0:
+            # Освобождаем место с запасом, чтобы следующие ходы не сдвигали начало окна
+            target = budget * (1 - self.block_fraction)
+            while used > target and start < len(history) - 1:
+                used -= self.tokens.message_tokens(history[start], model_name)
+                start += 1
+
+        window = history[start:]
+        if start > 0:
+            self._schedule_summary(state, history[:start], model_name)
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if summary is not None:
+            messages.append(summary.to_api())
+        messages.extend(to_api_messages(window))
+
+        return window, messages, used
+
+    def reset(self, state: UserState) -> None:
+        """
+        Забывает краткое содержание и отменяет результат незавершенного сжатия
+
+        Args:
+            state: Состояние пользователя
+        """
+        state.generation += 1
+        state.summary = None
+        state.pending = []
+
+    def _schedule_summary(self, state: UserState, overflow: List[Message], model_name: str) -> None:
+        """Ставит вытесненные сообщения в очередь и запускает сжатие, когда набралась пачка"""
+        state.pending.extend(overflow)
+        self.store.mark_dirty(state)
+        task = self._tasks.get(state.user_id)
+        if task is not None and not task.done():
+            return
+        if self._pending_tokens(state, model_name) < self.batch_tokens:
+            return
+        self._tasks[state.user_id] = asyncio.create_task(self._run_summary(state, model_name))
+
+    def _pending_tokens(self, state: UserState, model_name: str) -> int:
+        """Сколько токенов в сообщениях, ожидающих сжатия"""
+        return sum(self.tokens.message_tokens(m, model_name) for m in state.pending)
+
+    async def _run_summary(self, state: UserState, model_name: str) -> None:
+        """Сворачивает накопленные сообщения в краткое содержание"""
+        user_id = state.user_id
+        try:
+            # Сообщения, вытесненные во время сжатия, ждут следующей полной пачки
+            while self._pending_tokens(state, model_name) >= self.batch_tokens:
+                generation = state.generation
+                batch = list(state.pending)
+                previous = state.summary
+                previous_text = previous.content[len(SUMMARY_PREFIX):] if previous else None
+
+                try:
+                    text = await self.summarizer(user_id, previous_text, batch)
+                except Exception as e:
+                    # Пачка остается в очереди: сожмем при следующем переполнении
+                    logger.error(f"Не удалось сжать историю пользователя {user_id}: {e}")
+                    return
+                summary = await self.tokens.make_message("system", SUMMARY_PREFIX + text, model_name)
+
+                if state.generation != generation:
+                    # История была сброшена, пока шло сжатие — результат устарел
+                    continue
+
+                # Пока шло сжатие, в очередь могли добавиться новые сообщения — они остаются
+                state.summary = summary
+                state.pending = state.pending[len(batch):]
+                self.store.mark_dirty(state)
+                logger.info(f"История пользователя {user_id} сжата ({len(batch)} сообщений)")
+        finally:
+            self._tasks.pop(user_id, None)
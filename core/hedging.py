@@ -0,0 +1,96 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Попытка запроса: (информация о модели, событие «запрос отправлен», запасная ли попытка) -> результат
+Attempt = Callable[[Dict[str, Any], asyncio.Event, bool], Awaitable[T]]
+
+SLO_MODES = ("off", "hedge", "fallback")
+
+
+class HedgeOutcome:
+    """Итог гонки запросов: победитель и проигравшие попытки"""
+
+    __slots__ = ("result", "model_info", "losers", "hedged", "backup_won")
+
+    def __init__(self, result: Any, model_info: Dict[str, Any],
+                 losers: List[Tuple[Dict[str, Any], Optional[Any], bool, bool]], hedged: bool,
+                 backup_won: bool = False):
+        self.result = result
+        self.model_info = model_info
+        # (модель, результат, был ли запрос отправлен, завершилась ли ошибкой) проигравших;
+        # результат None — попытка отменена до ответа или упала. Попытка, отмененная в очереди
+        # лимитов, в OpenAI не попала и ничего не стоит
+        self.losers = losers
+        self.hedged = hedged  # Отправлялся ли дублирующий запрос
+        self.backup_won = backup_won
+
+
+async def hedged_call(attempt: Attempt, primary: Dict[str, Any], backup: Optional[Dict[str, Any]],
+                      budget: float) -> HedgeOutcome:
+    """
+    Выполняет запрос, дублируя его, если ответ не пришел в пределах бюджета
+
+    Бюджет отсчитывается с момента отправки основного запроса (время в очереди
+    лимитов не учитывается). По истечении бюджета запускается запасная
+    попытка; побеждает первый успешный ответ, остальные попытки отменяются.
+    Ошибка возвращается, только если не удались обе попытки.
+
+    Args:
+        attempt: Функция, выполняющая одну попытку; должна выставить событие, когда запрос прошел лимиты и отправлен
+        primary: Модель основного запроса
+        backup: Модель запасного запроса (None — не дублировать)
+        budget: Бюджет задержки (сек)
+
+    Returns:
+        Результат победившей попытки с информацией о проигравших
+    """
+    started = asyncio.Event()
+    first = asyncio.create_task(attempt(primary, started, False))
+    if backup is None:
+        return HedgeOutcome(await first, primary, [], False)
+
+    tasks = {first: (primary, started)}
+    waiter = asyncio.create_task(started.wait())
+    try:
+        # Ждем отправки запроса (или его быстрого завершения), затем — бюджет
+        await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        if not first.done():
+            await asyncio.wait({first}, timeout=budget)
+        if first.done():
+            return HedgeOutcome(first.result(), primary, [], False)
+
+        backup_started = asyncio.Event()
+        second = asyncio.create_task(attempt(backup, backup_started, True))
+        tasks[second] = (backup, backup_started)
+
+        pending = set(tasks)
+        error: Optional[BaseException] = None
+        winner = None
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task
+                    break
+                error = task.exception()
+        if winner is None:
+            raise error
+
+        losers = []
+        for task, (model_info, sent) in tasks.items():
+            if task is winner:
+                continue
+            task.cancel()
+            result, = await asyncio.gather(task, return_exceptions=True)
+            failed = isinstance(result, BaseException) and not isinstance(result, asyncio.CancelledError)
+            losers.append((model_info, None if isinstance(result, BaseException) else result, sent.is_set(), failed))
+        return HedgeOutcome(winner.result(), tasks[winner][0], losers, True, winner is second)
+    finally:
+        # При отмене снаружи не оставляем висящих запросов
+        waiter.cancel()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
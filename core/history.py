@@ -0,0 +1,67 @@
+import json
+import sys
+import zlib
+from typing import Any, Dict, List, Optional
+
+# Уровень сжатия истории простаивающих пользователей: сжатие редкое, важнее размер
+COMPRESS_LEVEL = 6
+
+
+class Message:
+    """
+    Запись истории диалога.
+
+    Вместо словаря — объект со слотами: роль интернирована (одна строка на
+    все сообщения с этой ролью), количество токенов хранится рядом с текстом
+    и считается один раз.
+    """
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str, tokens: Optional[int] = None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens  # Токены с учетом служебной структуры; None — еще не посчитаны
+
+    def to_api(self) -> Dict[str, str]:
+        """Сообщение в формате API"""
+        return {"role": self.role, "content": self.content}
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Словарь для сохранения в JSON"""
+        return {"role": self.role, "content": self.content, "tokens": self.tokens}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Message":
+        return cls(data["role"], data["content"], data.get("tokens"))
+
+
+def dumps_history(history: List[Message]) -> str:
+    """Сериализует историю в JSON"""
+    return json.dumps([[m.role, m.content, m.tokens] for m in history], ensure_ascii=False)
+
+
+def loads_history(data: str) -> List[Message]:
+    """
+    Восстанавливает историю из JSON
+
+    Args:
+        data: Результат dumps_history или список словарей (формат до появления Message)
+
+    Returns:
+        Список сообщений
+    """
+    return [
+        Message.from_dict(item) if isinstance(item, dict) else Message(*item)
+        for item in json.loads(data)
+    ]
+
+
+def pack_history(history: List[Message]) -> bytes:
+    """Сжимает историю простаивающего пользователя"""
+    return zlib.compress(dumps_history(history).encode("utf-8"), COMPRESS_LEVEL)
+
+
+def unpack_history(blob: bytes) -> List[Message]:
+    """Распаковывает историю, сжатую pack_history"""
+    return loads_history(zlib.decompress(blob).decode("utf-8"))
@@ -1,109 +1,548 @@
 import asyncio
-from openai import AsyncOpenAI
-from core.config import OPENAI_API_KEY, MAX_TOKENS, MODELS, DEFAULT_MODEL, USD_TO_RUB
-from tiktoken import encoding_for_model
-from typing import List, Dict, Any
+import importlib
+import time
+from contextlib import AsyncExitStack
+from functools import partial
+from core.config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, MAX_TOKENS, MODELS, DEFAULT_MODEL, USD_TO_RUB, SUMMARY_MODEL, SUMMARY_MAX_TOKENS, ADMINS,
+    RATE_LIMITS, DEFAULT_RATE_LIMIT, MAX_CONCURRENT_REQUESTS, RATE_LIMIT_RETRIES, PROMPT_STABLE_PREFIX,
+    WINDOW_BLOCK_FRACTION, LATENCY_SLO, DEFAULT_LATENCY_SLO, SLO_MODE, REQUEST_TIMEOUT, PREWARM_TIMEOUT,
+)
+from core.cache import CompletionCache, make_key
+from core.context import ContextManager
+from core.history import Message
+from core.hedging import HedgeOutcome, SLO_MODES, hedged_call
+from core.scheduler import RequestScheduler, QueueCallback, is_rate_limit, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BACKGROUND
+from core.state import StateStore, UserState
+from core.tokens import TokenCounter
+from core.usage import UsageLedger
+from utils.logger import logger
+from utils.metrics import STAGE_SECONDS, TOKENS_TOTAL, COST_USD_TOTAL, ERRORS_TOTAL, HEDGED_TOTAL
+from typing import TYPE_CHECKING, List, Dict, Any, AsyncIterator, Optional, NamedTuple
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+# Ответ пользователю, если OpenAI так и не принял запрос из-за лимитов
+RATE_LIMIT_TEXT = "Сейчас слишком много запросов к нейронке, попробуй через минуту 🙏"
+
+
+class CompletionResult(NamedTuple):
+    """Ответ модели со статистикой токенов и стоимости"""
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    input_cost: float = 0
+    output_cost: float = 0
+    input_cost_rub: float = 0
+    output_cost_rub: float = 0
+    total_cost_rub: float = 0
+    cached: bool = False  # Ответ взят из кэша, запрос к API не выполнялся
+    cached_tokens: int = 0  # Токены запроса, взятые из кэша промптов OpenAI
+    model: Optional[str] = None  # Модель, давшая ответ, если это не модель пользователя
+
+
+class _OpenStream:
+    """Открытый потоковый ответ, от которого уже получен первый фрагмент текста"""
+
+    __slots__ = ("stack", "ticket", "chunks", "head", "sent", "first_token")
+
+    def __init__(self, stack: AsyncExitStack, ticket, chunks: AsyncIterator, head: list, sent: float):
+        self.stack = stack  # Держит слот планировщика и соединение до конца потока
+        self.ticket = ticket
+        self.chunks = chunks
+        self.head = head  # Фрагменты, прочитанные до первого текста
+        self.sent = sent
+        self.first_token = time.perf_counter() - sent
+
+    async def replay(self) -> AsyncIterator:
+        """Все фрагменты потока, начиная с уже прочитанных"""
+        for chunk in self.head:
+            yield chunk
+        async for chunk in self.chunks:
+            yield chunk
+
+
+class CompletionStream:
+    """Асинхронный поток фрагментов ответа модели с итоговой статистикой"""
 
-class OpenAIClient:
     def __init__(self):
-        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+        self._chunks: Optional[AsyncIterator[str]] = None
+        self.result: Optional[CompletionResult] = None
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._chunks
+
+
+class OpenAIClient:
+    def __init__(self, store: Optional[StateStore] = None, scheduler: Optional[RequestScheduler] = None,
+                 cache: Optional[CompletionCache] = None, ledger: Optional[UsageLedger] = None):
+        # SDK OpenAI импортируется долго, поэтому клиент создается при первом обращении (или при прогреве)
+        self._client: Optional["AsyncOpenAI"] = None
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler(
+            RATE_LIMITS, DEFAULT_RATE_LIMIT, max_concurrent=MAX_CONCURRENT_REQUESTS, max_retries=RATE_LIMIT_RETRIES,
+        )
+        self.cache = cache  # Кэш ответов на одинаковые запросы (None — выключен)
+        self.ledger = ledger  # Учет расхода токенов (None — выключен)
         self.models = MODELS
-        self.user_models = {}
-        self.conversations = {}  # Словарь для хранения истории диалогов по user_id
-        self.system_prompts = {}  # Системные промпты для каждого пользователя
+        # Модели, системные промпты и истории диалогов пользователей
+        self.store = store if store is not None else StateStore()
+        self.tokens = TokenCounter()  # Учет токенов с кэшем токенизаторов
+        # Режим SLO для пользователей, которые не выбрали свой
+        self.default_slo_mode = SLO_MODE if SLO_MODE in SLO_MODES else "off"
+        if SLO_MODE not in SLO_MODES:
+            logger.warning(f"Неизвестный SLO_MODE={SLO_MODE!r}, дублирование запросов выключено")
+        # Бюджет токенов истории; при стабильном префиксе окно сдвигается блоками
+        self.stable_prefix = PROMPT_STABLE_PREFIX
+        self.context = ContextManager(
+            self.tokens, self.store, self._summarize,
+            block_fraction=WINDOW_BLOCK_FRACTION if self.stable_prefix else 0.0,
+        )
         
         # Дефолтный системный промпт
         self.default_system_prompt = (
             "Ты — полезный ассистент, который отвечает на русском языке. "
             "Твои ответы должны быть информативными и полезными."
         )
+
+    @property
+    def client(self) -> "AsyncOpenAI":
+        """Клиент OpenAI; SDK загружается при первом обращении"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            # Повторы при 429 выполняет планировщик, встроенные повторы SDK отключены
+            self._client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, max_retries=0)
+        return self._client
+
+    async def prewarm(self) -> None:
+        """
+        Готовит клиента к первому сообщению после запуска
+
+        Импортирует SDK, загружает токенизаторы всех моделей и открывает
+        соединение с OpenAI легким запросом информации о модели. Ошибки
+        прогрева не мешают работе: все это повторится при первом запросе.
+        """
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        # Импорт SDK занимает процессор, пока event loop принимает апдейты
+        await loop.run_in_executor(None, importlib.import_module, "openai")
+        encodings = await self.tokens.prewarm(model["name"] for model in self.models.values())
+        try:
+            await self.client.models.retrieve(self.models[DEFAULT_MODEL]["name"], timeout=PREWARM_TIMEOUT)
+        except Exception as e:
+            # Соединение могло открыться, даже если сам запрос не удался
+            logger.warning(f"Прогревочный запрос к OpenAI не удался: {e}")
+        logger.info(f"Клиент OpenAI прогрет за {time.perf_counter() - started:.2f} с, токенизаторов: {encodings}")
         
-    def _count_tokens(self, messages, model_name):
+    async def _prepare_messages(self, user_id: int, prompt: str) -> tuple:
         """
-        Подсчитывает количество токенов в сообщениях
+        Добавляет запрос пользователя в историю и формирует сообщения для API
         
         Args:
-            messages: Список сообщений для подсчета токенов
-            model_name: Название модели для токенизации
+            user_id: ID пользователя
+            prompt: Текст запроса к модели
             
         Returns:
-            Количество токенов
+            Кортеж (состояние пользователя, информация о модели, сообщения для API, токены запроса)
         """
-        try:
-            # Попытка получить подходящую модель токенизации
-            base_model = model_name.split('-')[0] + "-" + model_name.split('-')[1]
-            enc = encoding_for_model(base_model)
-        except KeyError:
-            # Если точной модели нет, используем cl100k_base как дефолтную
-            enc = encoding_for_model("gpt-4")
+        # Подгружаем настройки и историю диалога при первом обращении, не блокируя event loop
+        state = await self.store.load_state(user_id)
+        history = await self.store.load_history(state)
+
+        # Получаем модель для данного пользователя
+        model_info = self.get_user_model(user_id)
+        model_name = model_info["name"]
+
+        # Получаем системный промпт для данного пользователя или используем дефолтный
+        system_prompt = state.system_prompt or self.default_system_prompt
+        
+        with STAGE_SECONDS.time(("tokenize",)):
+            # Добавляем сообщение пользователя в историю вместе с количеством токенов
+            user_entry = await self.tokens.make_message("user", prompt, model_name)
+            history.append(user_entry)
             
-        token_count = 0
-        for message in messages:
-            # Учитываем токены для роли и контента
-            token_count += 4  # Примерно 4 токена на структуру сообщения
-            token_count += len(enc.encode(message["content"]))
+            # Оставляем в истории только то, что помещается в бюджет токенов модели,
+            # остальное сворачивается в краткое содержание в фоне
+            state.history, messages, prompt_tokens = self.context.build(state, system_prompt, model_info)
+        self.store.mark_dirty(state)
+
+        return state, model_info, messages, prompt_tokens
+
+    async def _remember_answer(self, state: UserState, generation: int, answer: str, model_name: str) -> None:
+        """
+        Добавляет ответ модели в историю пользователя
         
-        return token_count
+        Args:
+            state: Состояние пользователя
+            generation: Поколение истории на момент запроса
+            answer: Текст ответа
+            model_name: Название модели для токенизации
+        """
+        assistant_entry = await self.tokens.make_message("assistant", answer, model_name)
+        # Если историю сбросили, пока модель отвечала, ответ к новой истории не относится
+        if state.generation == generation:
+            history = await self.store.load_history(state)
+            history.append(assistant_entry)
+            self.store.mark_dirty(state)
 
-    async def get_completion(self, user_id: int, prompt: str) -> tuple:
+    def _calculate_cost(self, model_info: Dict[str, Any], prompt_tokens: int, completion_tokens: int,
+                        cached_tokens: int = 0) -> tuple:
         """
-        Асинхронно получает ответ от OpenAI API
+        Рассчитывает стоимость запроса и ответа
         
         Args:
-            prompt: Текст запроса к модели
+            model_info: Информация о модели
+            prompt_tokens: Токены запроса
+            completion_tokens: Токены ответа
+            cached_tokens: Из токенов запроса взято из кэша промптов (оплачиваются по сниженной цене)
             
         Returns:
-            Кортеж (текстовый ответ от модели, токены запроса, токены ответа, стоимость запроса, стоимость ответа)
+            Кортеж (стоимость запроса, стоимость ответа, то же в рублях, итого в рублях)
         """
-        try:
-            # Инициализация истории диалога для нового пользователя
-            if user_id not in self.conversations:
-                self.conversations[user_id] = []
+        cached_price = model_info.get("cached_input_price", model_info["input_price"])
+        input_cost = ((prompt_tokens - cached_tokens) * model_info["input_price"]
+                      + cached_tokens * cached_price) / 1000000
+        output_cost = (completion_tokens / 1000000) * model_info["output_price"]
+        # Рассчитываем стоимость в рублях
+        input_cost_rub = input_cost * USD_TO_RUB
+        output_cost_rub = output_cost * USD_TO_RUB
+        total_cost_rub = input_cost_rub + output_cost_rub
 
-            # Получаем модель для данного пользователя
-            model_info = self.get_user_model(user_id)
-            model_name = model_info["name"]
+        model_name = model_info["name"]
+        TOKENS_TOTAL.inc(prompt_tokens, (model_name, "prompt"))
+        TOKENS_TOTAL.inc(completion_tokens, (model_name, "completion"))
+        TOKENS_TOTAL.inc(cached_tokens, (model_name, "cached"))
+        COST_USD_TOTAL.inc(input_cost + output_cost, (model_name,))
+        return input_cost, output_cost, input_cost_rub, output_cost_rub, total_cost_rub
 
-            # Получаем системный промпт для данного пользователя или используем дефолтный
-            system_prompt = self.system_prompts.get(user_id, self.default_system_prompt)
+    def _account(self, user_id: int, model_info: Dict[str, Any], usage) -> tuple:
+        """
+        Учитывает расход по данным API и рассчитывает стоимость
+        
+        Args:
+            user_id: ID пользователя
+            model_info: Информация о модели
+            usage: Статистика использования из ответа API
             
-            # Формируем все сообщения с системным промптом в начале
-            messages = [{"role": "system", "content": system_prompt}]
+        Returns:
+            Поля CompletionResult после текста: токены, стоимость и токены из кэша промптов
+        """
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = (details.cached_tokens or 0) if details is not None else 0
+        costs = self._calculate_cost(model_info, usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+        if self.ledger is not None:
+            self.ledger.record(user_id, model_info["name"], usage.prompt_tokens, cached_tokens,
+                               usage.completion_tokens, costs[0] + costs[1])
+        return (usage.prompt_tokens, usage.completion_tokens, *costs, False, cached_tokens)
+
+    async def _summarize(self, user_id: int, previous_summary: Optional[str], messages: List[Message]) -> str:
+        """
+        Сворачивает старые сообщения диалога в краткое содержание
+        
+        Args:
+            user_id: ID пользователя, чей диалог сжимается
+            previous_summary: Предыдущее краткое содержание или None
+            messages: Вытесненные из окна сообщения
             
-            # Добавляем сообщение пользователя в историю
-            self.conversations[user_id].append({"role": "user", "content": prompt})
+        Returns:
+            Новое краткое содержание
+        """
+        # Длинные вставки (логи, код) обрезаем — для пересказа достаточно начала
+        transcript = "\n".join(f"{m.role}: {m.content[:2000]}" for m in messages)
+        if previous_summary:
+            transcript = f"Ранее: {previous_summary}\n\n{transcript}"
+
+        messages = [
+            {"role": "system", "content": (
+                "Сожми диалог в краткое содержание на русском языке. "
+                "Сохрани факты, договоренности и контекст, нужный для продолжения разговора."
+            )},
+            {"role": "user", "content": transcript},
+        ]
+        estimate = await self.tokens.acount_text(transcript, SUMMARY_MODEL) + SUMMARY_MAX_TOKENS
+
+        async with self.scheduler.slot(SUMMARY_MODEL, estimate, PRIORITY_BACKGROUND):
+            response = await self.scheduler.call(SUMMARY_MODEL, lambda: self.client.chat.completions.create(
+                model=SUMMARY_MODEL,
+                messages=messages,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                timeout=REQUEST_TIMEOUT,
+            ))
+        # Сжатие тоже расходует токены — относим его на пользователя
+        if response.usage is not None and SUMMARY_MODEL in self.models:
+            self._account(user_id, self.models[SUMMARY_MODEL], response.usage)
+        return response.choices[0].message.content.strip()
+
+    async def _cache_lookup(self, model_name: str, messages: List[Dict[str, Any]]) -> tuple:
+        """
+        Ищет готовый ответ на такой же запрос
+        
+        Args:
+            model_name: Название модели
+            messages: Сообщения для API
             
-            # Ограничиваем историю до последних 10 сообщений для экономии токенов
-            if len(self.conversations[user_id]) > 20:
-                self.conversations[user_id] = self.conversations[user_id][-20:]
+        Returns:
+            Кортеж (ключ кэша или None, если кэш выключен; ответ или None)
+        """
+        if self.cache is None:
+            return None, None
+        key = make_key(model_name, messages)
+        return key, await self.cache.get(key)
 
-            # Добавляем историю диалога к сообщениям
-            messages.extend(self.conversations[user_id])
+    def _request_options(self, user_id: int) -> Dict[str, Any]:
+        """Дополнительные параметры запроса к API"""
+        if not self.stable_prefix:
+            return {}
+        # Запросы одного пользователя с общим префиксом направляются на один и тот же кэш
+        return {"prompt_cache_key": f"user-{user_id}"}
 
-            # Подсчитываем токены запроса
-            prompt_tokens = self._count_tokens(messages, model_name)
+    def _priority(self, user_id: int) -> int:
+        """Приоритет запросов пользователя: администраторы обслуживаются первыми"""
+        return PRIORITY_HIGH if user_id in ADMINS else PRIORITY_NORMAL
 
-            response = await self.client.chat.completions.create(
+    def _slo_policy(self, user_id: int, model_info: Dict[str, Any], streaming: bool) -> tuple:
+        """
+        Бюджет задержки и запасная модель для запроса пользователя
+        
+        Args:
+            user_id: ID пользователя
+            model_info: Информация о модели запроса
+            streaming: Потоковый ответ (бюджет на первый токен) или целиком
+            
+        Returns:
+            Кортеж (бюджет в секундах, информация о запасной модели или None — не дублировать)
+        """
+        mode = self.get_slo_mode(user_id)
+        if mode == "off":
+            return 0.0, None
+        slo = LATENCY_SLO.get(model_info["name"], DEFAULT_LATENCY_SLO)
+        budget = slo["ttft_p95" if streaming else "p95"]
+        # Без более быстрой модели fallback дублирует запрос в ту же модель
+        fallback = slo.get("fallback")
+        if mode == "fallback" and fallback in self.models:
+            return budget, self.models[fallback]
+        return budget, model_info
+
+    def _attempt_priority(self, user_id: int, is_backup: bool, on_queued: Optional[QueueCallback]) -> tuple:
+        """Приоритет и обработчик очереди для попытки запроса"""
+        if is_backup:
+            # Запасной запрос не должен отнимать лимиты у основных запросов других пользователей,
+            # а о месте в очереди пользователю уже сообщила основная попытка
+            return PRIORITY_BACKGROUND, None
+        return self._priority(user_id), on_queued
+
+    async def _complete_attempt(self, user_id: int, messages: List[Dict[str, Any]], estimate: int,
+                                on_queued: Optional[QueueCallback], model_info: Dict[str, Any],
+                                started: asyncio.Event, is_backup: bool):
+        """Одна попытка запроса без потока; started выставляется, когда запрос прошел лимиты"""
+        model_name = model_info["name"]
+        async with self.scheduler.slot(model_name, estimate, *self._attempt_priority(user_id, is_backup, on_queued)) as ticket:
+            started.set()
+            with STAGE_SECONDS.time(("api_total",)):
+                response = await self.scheduler.call(model_name, lambda: self.client.chat.completions.create(
+                    model=model_name,
+                    messages=messages,
+                    max_tokens=MAX_TOKENS,
+                    timeout=REQUEST_TIMEOUT,
+                    **self._request_options(user_id),
+                ))
+            ticket.actual_tokens = response.usage.total_tokens
+        return response
+
+    async def _stream_attempt(self, user_id: int, messages: List[Dict[str, Any]], estimate: int,
+                              on_queued: Optional[QueueCallback], model_info: Dict[str, Any],
+                              started: asyncio.Event, is_backup: bool) -> _OpenStream:
+        """Одна попытка потокового запроса; завершается, когда пришел первый фрагмент текста"""
+        model_name = model_info["name"]
+        stack = AsyncExitStack()
+        try:
+            # Слот занят на все время потока, чтобы соблюдать лимит одновременных запросов
+            ticket = await stack.enter_async_context(self.scheduler.slot(
+                model_name, estimate, *self._attempt_priority(user_id, is_backup, on_queued),
+            ))
+            started.set()
+            sent = time.perf_counter()
+            response = await self.scheduler.call(model_name, lambda: self.client.chat.completions.create(
                 model=model_name,
                 messages=messages,
                 max_tokens=MAX_TOKENS,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=REQUEST_TIMEOUT,
+                **self._request_options(user_id),
+            ))
+            stack.push_async_callback(response.close)
+
+            head = []
+            chunks = response.__aiter__()
+            async for chunk in chunks:
+                head.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    break
+            return _OpenStream(stack, ticket, chunks, head, sent)
+        except BaseException:
+            await stack.aclose()
+            raise
+
+    async def _settle_hedge(self, user_id: int, primary: Dict[str, Any], backup: Optional[Dict[str, Any]],
+                            outcome: HedgeOutcome, prompt_tokens: int) -> None:
+        """
+        Закрывает проигравшие попытки и учитывает их расход
+        
+        Args:
+            user_id: ID пользователя
+            primary: Модель основного запроса
+            backup: Модель запасного запроса
+            outcome: Итог гонки запросов
+            prompt_tokens: Локальная оценка токенов запроса
+        """
+        if not outcome.hedged:
+            return
+        mode = "hedge" if backup is primary else "fallback"
+        HEDGED_TOTAL.inc(labels=(primary["name"], mode, "backup" if outcome.backup_won else "primary"))
+        for model_info, result, sent, failed in outcome.losers:
+            if not sent or failed:
+                # Отменена, не дождавшись лимитов, или завершилась ошибкой (5xx, таймаут, 429):
+                # такие запросы OpenAI не оплачиваются
+                continue
+            if isinstance(result, _OpenStream):
+                await result.stack.aclose()
+                result = None
+            if result is not None and result.usage is not None:
+                self._account(user_id, model_info, result.usage)
+                continue
+            # Отмененный после отправки запрос оплачивается: учитываем хотя бы токены запроса
+            costs = self._calculate_cost(model_info, prompt_tokens, 0)
+            if self.ledger is not None:
+                self.ledger.record(user_id, model_info["name"], prompt_tokens, 0, 0, costs[0])
+
+    async def get_completion(self, user_id: int, prompt: str, on_queued: Optional[QueueCallback] = None) -> CompletionResult:
+        """
+        Асинхронно получает ответ от OpenAI API
+        
+        Args:
+            prompt: Текст запроса к модели
+            on_queued: Вызывается с номером в очереди, если запрос ждет лимитов OpenAI
+            
+        Returns:
+            CompletionResult: текстовый ответ от модели, токены запроса и ответа, стоимость запроса и ответа
+        """
+        try:
+            state, model_info, messages, prompt_tokens = await self._prepare_messages(user_id, prompt)
+            generation = state.generation
+
+            model_name = model_info["name"]
+            cache_key, cached_answer = await self._cache_lookup(model_name, messages)
+            if cached_answer is not None:
+                await self._remember_answer(state, generation, cached_answer, model_name)
+                return CompletionResult(cached_answer, cached=True)
+
+            # OpenAI учитывает в лимите токенов и максимальную длину ответа
+            estimate = prompt_tokens + MAX_TOKENS
+            # Если модель не уложилась в бюджет задержки, запрос дублируется
+            budget, backup = self._slo_policy(user_id, model_info, streaming=False)
+            outcome = await hedged_call(
+                partial(self._complete_attempt, user_id, messages, estimate, on_queued), model_info, backup, budget,
             )
+            await self._settle_hedge(user_id, model_info, backup, outcome, prompt_tokens)
+            response = outcome.result
+            answered_by = outcome.model_info
             # Получаем ответ и добавляем его в историю
             assistant_response = response.choices[0].message.content.strip()
-            self.conversations[user_id].append({"role": "assistant", "content": assistant_response})
+            await self._remember_answer(state, generation, assistant_response, answered_by["name"])
             
-            completion_tokens = response.usage.completion_tokens
-            # Рассчитываем стоимость
-            input_cost = (prompt_tokens / 1000000) * model_info["input_price"]
-            output_cost = (completion_tokens / 1000000) * model_info["output_price"]
-            # Рассчитываем стоимость в рублях
-            input_cost_rub = input_cost * USD_TO_RUB
-            output_cost_rub = output_cost * USD_TO_RUB
-            total_cost_rub = input_cost_rub + output_cost_rub
+            # Токены и стоимость считаем по данным API, а не по локальной оценке
+            stats = self._account(user_id, answered_by, response.usage)
+            # Ответ запасной модели не кэшируем под ключом выбранной пользователем
+            if cache_key is not None and assistant_response and answered_by is model_info:
+                self.cache.put(cache_key, assistant_response)
+            
+            return CompletionResult(assistant_response, *stats,
+                                    model=None if answered_by is model_info else answered_by["name"])
+        except Exception as e:
+            ERRORS_TOTAL.inc(labels=(type(e).__name__,))
+            if is_rate_limit(e):
+                return CompletionResult(RATE_LIMIT_TEXT)
+            return CompletionResult(f"Упс, что-то сломалось: {str(e)}")
+
+    def stream_completion(self, user_id: int, prompt: str, on_queued: Optional[QueueCallback] = None) -> "CompletionStream":
+        """
+        Запускает потоковое получение ответа от OpenAI API
+        
+        Args:
+            user_id: ID пользователя
+            prompt: Текст запроса к модели
+            on_queued: Вызывается с номером в очереди, если запрос ждет лимитов OpenAI
             
-            return assistant_response, prompt_tokens, completion_tokens, input_cost, output_cost, input_cost_rub, output_cost_rub, total_cost_rub
+        Returns:
+            Поток фрагментов ответа; после завершения итерации в stream.result
+            лежит такой же CompletionResult, как у get_completion
+        """
+        stream = CompletionStream()
+        stream._chunks = self._stream_chunks(user_id, prompt, stream, on_queued)
+        return stream
+
+    async def _stream_chunks(self, user_id: int, prompt: str, stream: "CompletionStream",
+                             on_queued: Optional[QueueCallback] = None) -> AsyncIterator[str]:
+        """Генератор фрагментов ответа, по завершении заполняет stream.result"""
+        parts = []
+        try:
+            state, model_info, messages, prompt_tokens = await self._prepare_messages(user_id, prompt)
+            generation = state.generation
+
+            model_name = model_info["name"]
+            cache_key, cached_answer = await self._cache_lookup(model_name, messages)
+            if cached_answer is not None:
+                await self._remember_answer(state, generation, cached_answer, model_name)
+                stream.result = CompletionResult(cached_answer, cached=True)
+                yield cached_answer
+                return
+
+            estimate = prompt_tokens + MAX_TOKENS
+            usage = None
+            # Если первый токен не пришел в пределах бюджета, запрос дублируется
+            budget, backup = self._slo_policy(user_id, model_info, streaming=True)
+            outcome = await hedged_call(
+                partial(self._stream_attempt, user_id, messages, estimate, on_queued), model_info, backup, budget,
+            )
+            await self._settle_hedge(user_id, model_info, backup, outcome, prompt_tokens)
+            opened = outcome.result
+            answered_by = outcome.model_info
+            STAGE_SECONDS.observe(opened.first_token, ("first_token",))
+            async with opened.stack:
+                async for chunk in opened.replay():
+                    # Последний чанк содержит только статистику использования
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                        opened.ticket.actual_tokens = usage.total_tokens
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+                STAGE_SECONDS.observe(time.perf_counter() - opened.sent, ("api_total",))
+
+            # Добавляем полный ответ в историю
+            assistant_response = "".join(parts).strip()
+            await self._remember_answer(state, generation, assistant_response, answered_by["name"])
+
+            if usage is not None:
+                stats = self._account(user_id, answered_by, usage)
+            else:
+                # API не прислал статистику — остается только локальная оценка
+                stats = (prompt_tokens, 0, *self._calculate_cost(answered_by, prompt_tokens, 0))
+            # Ответ запасной модели не кэшируем под ключом выбранной пользователем
+            if cache_key is not None and assistant_response and answered_by is model_info:
+                self.cache.put(cache_key, assistant_response)
+            stream.result = CompletionResult(assistant_response, *stats,
+                                             model=None if answered_by is model_info else answered_by["name"])
         except Exception as e:
-            return f"Упс, что-то сломалось: {str(e)}", 0, 0, 0, 0, 0, 0, 0
+            ERRORS_TOTAL.inc(labels=(type(e).__name__,))
+            error_text = RATE_LIMIT_TEXT if is_rate_limit(e) else f"Упс, что-то сломалось: {str(e)}"
+            yield ("\n\n" if parts else "") + error_text
+            stream.result = CompletionResult("".join(parts) + error_text)
         
     def reset_conversation(self, user_id: int) -> None:
         """
@@ -112,8 +551,9 @@ class OpenAIClient:
         Args:
             user_id: ID пользователя
         """
-        if user_id in self.conversations:
-            self.conversations[user_id] = []
+        state = self.store.get_state(user_id)
+        self.context.reset(state)
+        self.store.reset_history(state)
 
     def set_system_prompt(self, user_id: int, prompt: str) -> None:
         """
@@ -123,7 +563,9 @@ class OpenAIClient:
             user_id: ID пользователя
             prompt: Системный промпт
         """
-        self.system_prompts[user_id] = prompt
+        state = self.store.get_state(user_id)
+        state.system_prompt = prompt
+        self.store.mark_dirty(state)
         
     def reset_system_prompt(self, user_id: int) -> None:
         """
@@ -132,8 +574,10 @@ class OpenAIClient:
         Args:
             user_id: ID пользователя
         """
-        if user_id in self.system_prompts:
-            del self.system_prompts[user_id]
+        state = self.store.get_state(user_id)
+        if state.system_prompt is not None:
+            state.system_prompt = None
+            self.store.mark_dirty(state)
 
     def get_user_model(self, user_id: int) -> Dict[str, Any]:
         """
@@ -145,7 +589,10 @@ class OpenAIClient:
         Returns:
             Словарь с информацией о модели
         """
-        model_key = self.user_models.get(user_id, DEFAULT_MODEL)
+        model_key = self.store.get_state(user_id).model
+        # Модель могли убрать из конфига после сохранения
+        if model_key not in self.models:
+            model_key = DEFAULT_MODEL
         return self.models[model_key]
 
     def set_user_model(self, user_id: int, model_key: str) -> bool:
@@ -160,10 +607,43 @@ class OpenAIClient:
             True, если модель успешно установлена, иначе False
         """
         if model_key in self.models:
-            self.user_models[user_id] = model_key
+            state = self.store.get_state(user_id)
+            state.model = model_key
+            self.store.mark_dirty(state)
             return True
         return False
 
+    def get_slo_mode(self, user_id: int) -> str:
+        """
+        Получает поведение при медленном ответе модели для пользователя
+        
+        Args:
+            user_id: ID пользователя
+            
+        Returns:
+            Один из режимов SLO_MODES
+        """
+        mode = self.store.get_state(user_id).slo_mode
+        return mode if mode in SLO_MODES else self.default_slo_mode
+
+    def set_slo_mode(self, user_id: int, mode: str) -> bool:
+        """
+        Устанавливает поведение при медленном ответе модели
+        
+        Args:
+            user_id: ID пользователя
+            mode: off — ждать, hedge — дублировать запрос, fallback — переключиться на более быструю модель
+            
+        Returns:
+            True, если режим установлен, иначе False
+        """
+        if mode not in SLO_MODES:
+            return False
+        state = self.store.get_state(user_id)
+        state.slo_mode = mode
+        self.store.mark_dirty(state)
+        return True
+
     def get_available_models(self) -> Dict[str, Dict[str, Any]]:
         """
         Возвращает словарь с доступными моделями
@@ -0,0 +1,281 @@
+import asyncio
+import bisect
+import itertools
+import random
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Dict, List, Optional, Callable, Awaitable, AsyncIterator, Any
+
+from utils.logger import logger
+from utils.metrics import STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from openai import RateLimitError
+
+# Уведомление о постановке в очередь: получает номер в очереди (с 1)
+QueueCallback = Callable[[int], Awaitable[None]]
+
+PRIORITY_HIGH = 0  # Администраторы
+PRIORITY_NORMAL = 1  # Обычные пользователи
+PRIORITY_BACKGROUND = 2  # Фоновые задачи (сжатие истории)
+
+
+def is_rate_limit(error: BaseException) -> bool:
+    """
+    Проверяет, что ошибка — 429 от OpenAI
+
+    SDK не импортируется ради проверки: если он еще не загружен,
+    то и ошибки от него быть не могло.
+
+    Args:
+        error: Исключение запроса
+
+    Returns:
+        True для openai.RateLimitError
+    """
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.RateLimitError)
+
+
+class TokenBucket:
+    """Корзина токенов с пополнением по лимиту в минуту; capacity — допустимый всплеск"""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.capacity = float(per_minute if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated:
+            # Момент замера взят до создания корзины или последнего пополнения
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Сколько секунд ждать, пока в корзине наберется amount"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def give(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float) -> None:
+        """Блокирует корзину на время, указанное сервером в Retry-After"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "model", "tokens", "future")
+
+    def __init__(self, priority: int, seq: int, model: str, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.model = model
+        self.tokens = tokens
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Ticket:
+    """Разрешение на запрос; actual_tokens позволяет вернуть в корзину неизрасходованное"""
+
+    __slots__ = ("model", "tokens", "actual_tokens")
+
+    def __init__(self, model: str, tokens: int):
+        self.model = model
+        self.tokens = tokens
+        self.actual_tokens: Optional[int] = None
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов к OpenAI.
+
+    Ограничивает число одновременных запросов и расход по лимитам запросов
+    и токенов в минуту для каждой модели. Ожидающие запросы обслуживаются по
+    приоритету, а внутри приоритета — в порядке поступления. Ответы 429
+    повторяются с экспоненциальной задержкой со случайным разбросом с учетом
+    заголовка Retry-After.
+    """
+
+    def __init__(self, limits: Dict[str, Dict[str, int]], default_limit: Dict[str, int],
+                 max_concurrent: int = 32, max_retries: int = 5, base_delay: float = 1.0):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+
+        self._buckets: Dict[str, tuple] = {}
+        self._waiters: List[_Waiter] = []
+        self._active = 0
+        self._seq = itertools.count()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _model_buckets(self, model: str) -> tuple:
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            limit = self.limits.get(model, self.default_limit)
+            buckets = self._buckets[model] = (TokenBucket(limit["rpm"]), TokenBucket(limit["tpm"]))
+        return buckets
+
+    @asynccontextmanager
+    async def slot(self, model: str, tokens: int, priority: int = PRIORITY_NORMAL,
+                   on_queued: Optional[QueueCallback] = None) -> AsyncIterator[Ticket]:
+        """
+        Ожидает разрешения на запрос к модели
+
+        Args:
+            model: Название модели
+            tokens: Оценка расхода токенов (запрос + максимум ответа)
+            priority: Приоритет, меньше — раньше
+            on_queued: Вызывается с номером в очереди, если запрос не прошел сразу
+
+        Yields:
+            Ticket; если заполнить actual_tokens, разница вернется в лимит
+        """
+        loop = asyncio.get_running_loop()
+        queued_at = time.perf_counter()
+        waiter = _Waiter(priority, next(self._seq), model, tokens, loop.create_future())
+        bisect.insort(self._waiters, waiter)
+        self._pump()
+
+        try:
+            if not waiter.future.done() and on_queued is not None:
+                try:
+                    await on_queued(self._position(waiter))
+                except Exception as e:
+                    logger.warning(f"Не удалось сообщить о позиции в очереди: {e}")
+            await waiter.future
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Разрешение уже выдано, но запрос отменен — возвращаем его
+                self._release(Ticket(model, tokens), refund=tokens)
+            else:
+                waiter.future.cancel()
+                self._pump()
+            raise
+
+        STAGE_SECONDS.observe(time.perf_counter() - queued_at, ("queue_wait",))
+        ticket = Ticket(model, tokens)
+        try:
+            yield ticket
+        finally:
+            refund = tokens - ticket.actual_tokens if ticket.actual_tokens is not None else 0
+            self._release(ticket, refund)
+
+    async def call(self, model: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Выполняет запрос, повторяя его при ответе 429
+
+        Args:
+            model: Название модели
+            request: Фабрика корутины запроса
+
+        Returns:
+            Результат запроса
+        """
+        attempt = 0
+        while True:
+            try:
+                return await request()
+            except Exception as e:
+                # Закончившуюся квоту повторять бессмысленно
+                if not is_rate_limit(e) or e.code == "insufficient_quota" or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                # Придерживаем и остальные запросы к этой модели
+                for bucket in self._model_buckets(model):
+                    bucket.pause(delay)
+                logger.warning(f"OpenAI 429 для {model}, повтор через {delay:.1f} с (попытка {attempt + 1})")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _retry_delay(self, error: "RateLimitError", attempt: int) -> float:
+        """Задержка перед повтором: Retry-After от сервера или экспонента с разбросом"""
+        backoff = self.base_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+        headers = error.response.headers if error.response is not None else {}
+        retry_after_ms = headers.get("retry-after-ms")
+        retry_after = headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                return float(retry_after_ms) / 1000 + random.uniform(0, 0.25)
+            if retry_after is not None:
+                return float(retry_after) + random.uniform(0, 0.25)
+        except ValueError:
+            pass
+        return backoff
+
+    def _position(self, waiter: _Waiter) -> int:
+        """Номер запроса в очереди, начиная с 1"""
+        position = 1
+        for other in self._waiters:
+            if other is waiter:
+                break
+            if not other.future.done():
+                position += 1
+        return position
+
+    def _release(self, ticket: Ticket, refund: int) -> None:
+        self._active -= 1
+        if refund > 0:
+            self._model_buckets(ticket.model)[1].give(refund)
+        self._pump()
+
+    def _pump(self) -> None:
+        """Выдает разрешения ожидающим запросам, насколько позволяют лимиты"""
+        now = time.monotonic()
+        blocked = set()
+        next_wake = None
+        remaining = []
+
+        for waiter in self._waiters:
+            if waiter.future.done():
+                continue
+            if self._active >= self.max_concurrent or waiter.model in blocked:
+                remaining.append(waiter)
+                continue
+
+            rpm, tpm = self._model_buckets(waiter.model)
+            wait = max(rpm.wait_time(1, now), tpm.wait_time(waiter.tokens, now))
+            if wait > 0:
+                # Запросы к этой модели с меньшим приоритетом не обгоняют текущий
+                blocked.add(waiter.model)
+                next_wake = wait if next_wake is None else min(next_wake, wait)
+                remaining.append(waiter)
+                continue
+
+            rpm.take(1)
+            tpm.take(waiter.tokens)
+            self._active += 1
+            waiter.future.set_result(None)
+
+        self._waiters = remaining
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if next_wake is not None:
+            self._timer = asyncio.get_running_loop().call_later(next_wake, self._pump)
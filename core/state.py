@@ -0,0 +1,421 @@
+import abc
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from core.history import Message, dumps_history, loads_history, pack_history, unpack_history
+from utils.logger import logger
+
+# Накладные расходы на одно сообщение в памяти помимо текста (запись со слотами, ссылка в списке), байт
+MESSAGE_OVERHEAD_BYTES = 72
+
+
+class UserState:
+    """Состояние одного пользователя: модель, системный промпт, история"""
+
+    __slots__ = ("user_id", "model", "system_prompt", "history", "packed", "summary", "pending", "slo_mode",
+                 "generation", "last_access", "size")
+
+    def __init__(self, user_id: int, model: Optional[str] = None, system_prompt: Optional[str] = None,
+                 summary: Optional[Message] = None, slo_mode: Optional[str] = None,
+                 pending: Optional[List[Message]] = None):
+        self.user_id = user_id
+        self.model = model
+        self.system_prompt = system_prompt
+        self.slo_mode = slo_mode  # Поведение при медленном ответе модели (None — по умолчанию)
+        self.history: Optional[List[Message]] = None  # None — еще не загружена из хранилища или сжата
+        self.packed: Optional[bytes] = None  # Сжатая история простаивающего пользователя
+        self.summary = summary
+        # Сообщения, вытесненные из окна, но еще не вошедшие в краткое содержание
+        self.pending: List[Message] = pending or []
+        self.generation = 0  # Увеличивается при сбросе истории
+        self.last_access = time.monotonic()
+        self.size = 0
+
+    def estimate_size(self) -> int:
+        """Приблизительный объем состояния в памяти, байт"""
+        size = len(self.system_prompt or "")
+        if self.summary is not None:
+            size += sys.getsizeof(self.summary.content) + MESSAGE_OVERHEAD_BYTES
+        if self.packed is not None:
+            size += len(self.packed)
+        for message in self.history or ():
+            size += sys.getsizeof(message.content) + MESSAGE_OVERHEAD_BYTES
+        for message in self.pending:
+            size += sys.getsizeof(message.content) + MESSAGE_OVERHEAD_BYTES
+        return size
+
+    def is_default(self) -> bool:
+        """Нет ничего, что стоило бы хранить: настройки по умолчанию и пустая история"""
+        return (self.model is None and self.system_prompt is None and self.summary is None
+                and self.slo_mode is None and not self.history and self.packed is None and not self.pending)
+
+
+class StateBackend(abc.ABC):
+    """Постоянное хранилище состояний пользователей"""
+
+    @abc.abstractmethod
+    def load_settings(self, user_id: int) -> Optional[tuple]:
+        """Возвращает (модель, системный промпт, краткое содержание, режим SLO, ожидающие сжатия) или None"""
+
+    @abc.abstractmethod
+    def load_history(self, user_id: int) -> Optional[List[Message]]:
+        """Возвращает историю диалога или None"""
+
+    @abc.abstractmethod
+    def save(self, rows: List[tuple]) -> None:
+        """Сохраняет пачку (user_id, модель, промпт, краткое содержание, режим SLO, ожидающие сжатия, история)"""
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteBackend(StateBackend):
+    """
+    Хранилище на SQLite в режиме WAL.
+
+    Короткие чтения настроек идут через отдельное соединение для чтения,
+    запись пачками выполняется в выделенном потоке.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                model TEXT,
+                system_prompt TEXT,
+                summary TEXT,
+                updated_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS histories (
+                user_id INTEGER PRIMARY KEY,
+                messages TEXT NOT NULL
+            );
+            """
+        )
+        # Колонки, добавленные после создания базы
+        columns = {row[1] for row in self._writer.execute("PRAGMA table_info(users)")}
+        if "slo_mode" not in columns:
+            self._writer.execute("ALTER TABLE users ADD COLUMN slo_mode TEXT")
+        if "pending" not in columns:
+            self._writer.execute("ALTER TABLE users ADD COLUMN pending TEXT")
+        self._writer.commit()
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+
+    def load_settings(self, user_id: int) -> Optional[tuple]:
+        row = self._reader.execute(
+            "SELECT model, system_prompt, summary, slo_mode, pending FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        model, system_prompt, summary, slo_mode, pending = row
+        summary = Message.from_dict(json.loads(summary)) if summary else None
+        return model, system_prompt, summary, slo_mode, loads_history(pending) if pending else None
+
+    def load_history(self, user_id: int) -> Optional[List[Message]]:
+        row = self._reader.execute(
+            "SELECT messages FROM histories WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return loads_history(row[0]) if row else None
+
+    def save(self, rows: List[tuple]) -> None:
+        now = time.time()
+        users = []
+        histories = []
+        for user_id, model, system_prompt, summary, slo_mode, pending, history in rows:
+            summary = json.dumps(summary.to_dict(), ensure_ascii=False) if summary else None
+            pending = dumps_history(pending) if pending else None
+            users.append((user_id, model, system_prompt, summary, slo_mode, pending, now))
+            if history is not None:
+                histories.append((user_id, dumps_history(history)))
+
+        with self._writer:
+            self._writer.executemany(
+                "INSERT OR REPLACE INTO users (user_id, model, system_prompt, summary, slo_mode, pending, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                users,
+            )
+            self._writer.executemany(
+                "INSERT OR REPLACE INTO histories (user_id, messages) VALUES (?, ?)",
+                histories,
+            )
+
+    def close(self) -> None:
+        self._reader.close()
+        self._writer.close()
+
+
+class StateStore:
+    """
+    Общее хранилище состояний пользователей.
+
+    Горячие состояния держатся в памяти в порядке LRU и вытесняются по времени
+    простоя и по лимиту памяти. Изменения накапливаются и записываются в
+    постоянное хранилище пачками в фоне; история пользователя подгружается
+    при первом сообщении. История пользователя, простаивающего дольше
+    compress_after, сжимается zlib и распаковывается при его следующем сообщении.
+
+    Без постоянного хранилища память — единственная копия, поэтому
+    вытесняются только состояния с настройками по умолчанию и пустой историей.
+    """
+
+    def __init__(self, backend: Optional[StateBackend] = None, max_users: int = 10000,
+                 max_bytes: int = 256 * 1024 * 1024, idle_ttl: float = 3600.0, flush_interval: float = 2.0,
+                 compress_after: float = 600.0):
+        self.backend = backend
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.compress_after = compress_after
+
+        self._states: "OrderedDict[int, UserState]" = OrderedDict()
+        self._dirty: Dict[int, UserState] = {}
+        self._bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+    def get_state(self, user_id: int) -> UserState:
+        """
+        Возвращает состояние пользователя, загружая настройки при промахе
+
+        При промахе чтение из хранилища блокирует event loop, поэтому в
+        обработчиках состояние заранее подгружается через load_state.
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            Состояние пользователя (история может быть еще не загружена)
+        """
+        state = self._cached(user_id)
+        if state is not None:
+            return state
+        settings = self.backend.load_settings(user_id) if self.backend else None
+        return self._insert(user_id, settings)
+
+    async def load_state(self, user_id: int) -> UserState:
+        """
+        Возвращает состояние пользователя, читая настройки при промахе в фоновом потоке
+
+        Args:
+            user_id: ID пользователя
+
+        Returns:
+            Состояние пользователя (история может быть еще не загружена)
+        """
+        state = self._cached(user_id)
+        if state is not None or self.backend is None:
+            return state or self._insert(user_id, None)
+        loop = asyncio.get_running_loop()
+        settings = await loop.run_in_executor(self._executor, self.backend.load_settings, user_id)
+        # Пока шло чтение, состояние мог создать другой запрос
+        return self._cached(user_id) or self._insert(user_id, settings)
+
+    def _cached(self, user_id: int) -> Optional[UserState]:
+        """Состояние из памяти (в том числе вытесненное, но еще не записанное) или None"""
+        state = self._states.get(user_id)
+        if state is not None:
+            self._states.move_to_end(user_id)
+            state.last_access = time.monotonic()
+            return state
+        state = self._dirty.get(user_id)
+        if state is not None:
+            state.last_access = time.monotonic()
+            self._states[user_id] = state
+            self._resize(state)
+            self._enforce_limits()
+        return state
+
+    def _insert(self, user_id: int, settings: Optional[tuple]) -> UserState:
+        """Добавляет в память новое состояние с настройками из хранилища"""
+        state = UserState(user_id, *settings) if settings else UserState(user_id)
+        if self.backend is None:
+            state.history = []
+        self._states[user_id] = state
+        self._resize(state)
+        self._enforce_limits()
+        return state
+
+    async def load_history(self, state: UserState) -> List[Message]:
+        """
+        Возвращает историю пользователя, при необходимости распаковывая или подгружая ее из хранилища
+
+        Args:
+            state: Состояние пользователя
+
+        Returns:
+            История диалога
+        """
+        if state.history is None and state.packed is not None:
+            state.history = unpack_history(state.packed)
+            state.packed = None
+            self._resize(state)
+        if state.history is None:
+            loop = asyncio.get_running_loop()
+            history = await loop.run_in_executor(self._executor, self.backend.load_history, state.user_id)
+            # Пока шла загрузка, история могла быть сброшена или загружена другим запросом
+            if state.history is None:
+                state.history = history or []
+                self._resize(state)
+        return state.history
+
+    def reset_history(self, state: UserState) -> None:
+        """
+        Очищает историю пользователя, в том числе сжатую
+
+        Args:
+            state: Состояние пользователя
+        """
+        state.history = []
+        state.packed = None
+        self.mark_dirty(state)
+
+    def mark_dirty(self, state: UserState) -> None:
+        """
+        Отмечает состояние как измененное для отложенной записи
+
+        Args:
+            state: Состояние пользователя
+        """
+        if self.backend is not None:
+            self._dirty[state.user_id] = state
+        self._resize(state)
+        self._enforce_limits()
+
+    async def start(self) -> None:
+        """Запускает фоновую запись изменений и вытеснение простаивающих пользователей"""
+        self._task = asyncio.create_task(self._maintenance_loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновые задачи и записывает все несохраненные изменения"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self.backend is not None:
+            self.backend.close()
+        self._executor.shutdown(wait=True)
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return
+        states = list(self._dirty.values())
+        self._dirty.clear()
+        rows = [
+            (s.user_id, s.model, s.system_prompt, s.summary, s.slo_mode, list(s.pending),
+             list(s.history) if s.history is not None else None)
+            for s in states
+        ]
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self.backend.save, rows)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние {len(rows)} пользователей: {e}")
+            # Вернем в очередь, если за это время не появилось более свежих изменений
+            for s in states:
+                self._dirty.setdefault(s.user_id, s)
+        self._enforce_limits()
+
+    async def _maintenance_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self._evict_idle()
+                await self.compress_idle()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания хранилища состояний: {e}")
+
+    def _resize(self, state: UserState) -> None:
+        """Пересчитывает объем состояния и общий объем памяти"""
+        if state.user_id not in self._states:
+            return
+        size = state.estimate_size()
+        self._bytes += size - state.size
+        state.size = size
+
+    def _evict(self, user_id: int) -> bool:
+        """Вытесняет состояние из памяти, если оно уже сохранено"""
+        if user_id in self._dirty:
+            return False
+        if self.backend is None and not self._states[user_id].is_default():
+            # Сохранить некуда — вытеснение стерло бы модель, промпт и историю пользователя
+            return False
+        state = self._states.pop(user_id)
+        self._bytes -= state.size
+        state.size = 0
+        return True
+
+    def _evict_idle(self) -> None:
+        """Вытесняет пользователей, простаивающих дольше idle_ttl"""
+        deadline = time.monotonic() - self.idle_ttl
+        for user_id, state in list(self._states.items()):
+            # Порядок LRU: дальше идут только более свежие состояния
+            if state.last_access > deadline:
+                break
+            self._evict(user_id)
+
+    async def compress_idle(self) -> None:
+        """Сжимает истории пользователей, простаивающих дольше compress_after"""
+        deadline = time.monotonic() - self.compress_after
+        candidates = []
+        for state in self._states.values():
+            # Порядок LRU: дальше идут только более свежие состояния
+            if state.last_access > deadline:
+                break
+            # Несохраненные истории не трогаем: при записи нужен их полный вид
+            if state.history and state.user_id not in self._dirty:
+                candidates.append((state, state.history, state.last_access))
+        if not candidates:
+            return
+
+        # Сжатие — работа для процессора, выполняем ее вне event loop
+        loop = asyncio.get_running_loop()
+        blobs = await loop.run_in_executor(
+            self._executor, lambda: [pack_history(history) for _, history, _ in candidates],
+        )
+        packed = 0
+        for (state, history, last_access), blob in zip(candidates, blobs):
+            # Пока шло сжатие, пользователь мог написать или сбросить историю
+            if state.history is not history or state.last_access != last_access or state.user_id in self._dirty:
+                continue
+            state.history = None
+            state.packed = blob
+            self._resize(state)
+            packed += 1
+        if packed:
+            logger.info(f"Сжаты истории {packed} простаивающих пользователей")
+
+    def _enforce_limits(self) -> None:
+        """Вытесняет давно не использованные состояния при превышении лимитов"""
+        if len(self._states) <= self.max_users and self._bytes <= self.max_bytes:
+            return
+        for user_id in list(self._states):
+            if len(self._states) <= self.max_users and self._bytes <= self.max_bytes:
+                break
+            # Самого свежего пользователя не трогаем — им сейчас пользуются
+            if user_id == next(reversed(self._states)):
+                break
+            self._evict(user_id)
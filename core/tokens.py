@@ -0,0 +1,233 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+from core.config import TIKTOKEN_CACHE_DIR
+from core.history import Message
+from utils.logger import logger
+
+if TYPE_CHECKING:
+    import tiktoken
+
+# Примерно 4 токена на служебную структуру каждого сообщения
+MESSAGE_OVERHEAD = 4
+
+# Тексты длиннее этого порога (в символах) токенизируются в пуле потоков,
+# чтобы не блокировать event loop
+OFFLOAD_THRESHOLD = 4000
+
+# Кодировка по умолчанию, если модель неизвестна tiktoken
+FALLBACK_ENCODING = "cl100k_base"
+
+# tiktoken читает каталог кэша из окружения при загрузке словаря; явно заданный снаружи не трогаем
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+
+
+# Не чаще, чем раз в столько секунд, повторяем загрузку словаря после неудачи (сек)
+ENCODING_RETRY_INTERVAL = 60.0
+
+# Загруженные токенизаторы по моделям; неудачи не кэшируются, а только откладывают повтор
+_encodings: Dict[str, "tiktoken.Encoding"] = {}
+_failed_at: Dict[str, float] = {}
+
+
+def _load_encoding(model_name: str) -> "tiktoken.Encoding":
+    """Загружает словарь токенизатора модели; при ошибке бросает исключение"""
+    import tiktoken
+
+    try:
+        encoding_name = tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        encoding_name = FALLBACK_ENCODING
+    return tiktoken.get_encoding(encoding_name)
+
+
+def get_encoding(model_name: str) -> Optional["tiktoken.Encoding"]:
+    """
+    Возвращает токенизатор для модели, загружая его при первом обращении
+
+    Загрузка блокирующая (чтение, а при отсутствии в TIKTOKEN_CACHE_DIR —
+    скачивание словаря), поэтому из event loop вызывается через
+    TokenCounter.encoding. После неудачи загрузка повторяется не чаще
+    ENCODING_RETRY_INTERVAL.
+
+    Args:
+        model_name: Название модели
+
+    Returns:
+        Объект кодировки или None, если словарь токенизатора недоступен
+    """
+    enc = _encodings.get(model_name)
+    if enc is not None:
+        return enc
+    failed = _failed_at.get(model_name)
+    if failed is not None and time.monotonic() - failed < ENCODING_RETRY_INTERVAL:
+        return None
+
+    try:
+        enc = _load_encoding(model_name)
+    except Exception as e:
+        # Нет сети или локального кэша — пока считаем токены приблизительно
+        _failed_at[model_name] = time.monotonic()
+        logger.warning(f"Не удалось загрузить токенизатор для {model_name}: {e}")
+        return None
+    _failed_at.pop(model_name, None)
+    _encodings[model_name] = enc
+    return enc
+
+
+def _count(enc: Optional["tiktoken.Encoding"], text: str) -> int:
+    if enc is None:
+        # Грубая оценка: ~3 символа на токен для смешанного русского/английского текста
+        return len(text) // 3 + 1
+    return len(enc.encode_ordinary(text))
+
+
+@lru_cache(maxsize=1024)
+def _count_cached(enc: Optional["tiktoken.Encoding"], text: str) -> int:
+    """Кэшированный подсчет для часто повторяющихся текстов (системные промпты)"""
+    return _count(enc, text)
+
+
+def count_text(text: str, model_name: str) -> int:
+    """
+    Подсчитывает количество токенов в тексте, при необходимости загружая токенизатор
+
+    Args:
+        text: Текст для подсчета
+        model_name: Название модели для токенизации
+
+    Returns:
+        Количество токенов
+    """
+    return _count(get_encoding(model_name), text)
+
+
+class TokenCounter:
+    """
+    Учет токенов с кэшированием токенизаторов и счетчиков по сообщениям.
+
+    Количество токенов каждого сообщения сохраняется прямо в записи истории
+    (Message.tokens), поэтому на каждом ходе кодируется только новое сообщение.
+    """
+
+    def __init__(self, offload_threshold: int = OFFLOAD_THRESHOLD, max_workers: int = 2):
+        self.offload_threshold = offload_threshold
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tokens")
+        self._loading: Dict[str, asyncio.Future] = {}  # Загрузки словарей, которые уже идут
+
+    async def encoding(self, model_name: str) -> Optional["tiktoken.Encoding"]:
+        """
+        Возвращает токенизатор модели, загружая словарь в пуле потоков
+
+        Одновременные вызовы (прогрев и первое сообщение) ждут одну и ту же загрузку.
+
+        Args:
+            model_name: Название модели
+
+        Returns:
+            Объект кодировки или None, если словарь токенизатора недоступен
+        """
+        enc = _encodings.get(model_name)
+        if enc is not None:
+            return enc
+        failed = _failed_at.get(model_name)
+        if failed is not None and time.monotonic() - failed < ENCODING_RETRY_INTERVAL:
+            return None
+        future = self._loading.get(model_name)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, get_encoding, model_name)
+            self._loading[model_name] = future
+            future.add_done_callback(lambda _: self._loading.pop(model_name, None))
+        # Отмена одного ожидающего не должна прерывать загрузку для остальных
+        return await asyncio.shield(future)
+
+    async def acount_text(self, text: str, model_name: str) -> int:
+        """
+        Асинхронно подсчитывает токены, вынося загрузку словаря и длинные тексты в пул потоков
+
+        Args:
+            text: Текст для подсчета
+            model_name: Название модели для токенизации
+
+        Returns:
+            Количество токенов
+        """
+        enc = await self.encoding(model_name)
+        if len(text) < self.offload_threshold:
+            return _count(enc, text)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _count, enc, text)
+
+    async def make_message(self, role: str, content: str, model_name: str) -> Message:
+        """
+        Создает запись истории с заранее посчитанным количеством токенов
+
+        Args:
+            role: Роль отправителя (user/assistant/system)
+            content: Текст сообщения
+            model_name: Название модели для токенизации
+
+        Returns:
+            Запись истории с посчитанными токенами
+        """
+        tokens = MESSAGE_OVERHEAD + await self.acount_text(content, model_name)
+        return Message(role, content, tokens)
+
+    def message_tokens(self, message: Message, model_name: str) -> int:
+        """
+        Возвращает количество токенов сообщения, досчитывая и сохраняя его при отсутствии
+
+        Словарь здесь не загружается: если токенизатор модели еще не готов,
+        количество оценивается приблизительно.
+
+        Args:
+            message: Запись истории
+            model_name: Название модели для токенизации
+
+        Returns:
+            Количество токенов с учетом служебной структуры
+        """
+        tokens = message.tokens
+        if tokens is None:
+            tokens = MESSAGE_OVERHEAD + _count(_encodings.get(model_name), message.content)
+            message.tokens = tokens
+        return tokens
+
+    def system_prompt_tokens(self, prompt: str, model_name: str) -> int:
+        """Количество токенов системного промпта (кэшируется по тексту)"""
+        return MESSAGE_OVERHEAD + _count_cached(_encodings.get(model_name), prompt)
+
+    async def prewarm(self, model_names: Iterable[str]) -> int:
+        """
+        Загружает токенизаторы моделей заранее, чтобы первое сообщение не ждало словарь
+
+        Args:
+            model_names: Названия моделей
+
+        Returns:
+            Сколько токенизаторов загружено (без недоступных)
+        """
+        encodings = await asyncio.gather(*(self.encoding(name) for name in set(model_names)))
+        return len({id(enc) for enc in encodings if enc is not None})
+
+    def shutdown(self) -> None:
+        """Останавливает пул потоков токенизации"""
+        self._executor.shutdown(wait=False)
+
+
+def to_api_messages(messages: List[Message]) -> List[Dict[str, str]]:
+    """
+    Убирает служебные поля из записей истории перед отправкой в API
+
+    Args:
+        messages: Записи истории
+
+    Returns:
+        Список сообщений только с ролью и контентом
+    """
+    return [m.to_api() for m in messages]
@@ -0,0 +1,267 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from utils.logger import logger
+
+# Порядок счетчиков в агрегатах
+REQUESTS, PROMPT, CACHED, COMPLETION, COST = range(5)
+
+
+class UsageStats:
+    """Суммарный расход: запросы, токены и стоимость в долларах"""
+
+    __slots__ = ("requests", "prompt_tokens", "cached_tokens", "completion_tokens", "cost_usd")
+
+    def __init__(self, requests: int = 0, prompt_tokens: int = 0, cached_tokens: int = 0,
+                 completion_tokens: int = 0, cost_usd: float = 0.0):
+        self.requests = requests
+        self.prompt_tokens = prompt_tokens
+        self.cached_tokens = cached_tokens
+        self.completion_tokens = completion_tokens
+        self.cost_usd = cost_usd
+
+    def add(self, values) -> None:
+        self.requests += values[REQUESTS]
+        self.prompt_tokens += values[PROMPT]
+        self.cached_tokens += values[CACHED]
+        self.completion_tokens += values[COMPLETION]
+        self.cost_usd += values[COST]
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def today() -> str:
+    """Текущий день по UTC в формате YYYY-MM-DD"""
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def days_ago(days: int) -> str:
+    """День, отстоящий от текущего на days дней назад"""
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time() - days * 86400))
+
+
+class UsageLedger:
+    """
+    Учет расхода токенов по данным API.
+
+    Каждый запрос увеличивает счетчики в памяти по ключу (пользователь,
+    модель, день). Накопленные приращения периодически записываются в SQLite
+    одной транзакцией в выделенном потоке; в базе хранятся только агрегаты по
+    дням — по пользователям и общие по моделям, — поэтому отчеты читают
+    несколько строк и никогда не перебирают отдельные запросы.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, flush_interval: float = 5.0):
+        self.flush_interval = flush_interval
+        self._pending: Dict[Tuple[int, str, str], list] = {}  # Еще не записанные приращения
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage")
+        self._task: Optional[asyncio.Task] = None
+
+        if db_path:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        # Без пути агрегаты хранятся в памяти; соединение используется только из потока учета
+        self._conn = sqlite3.connect(db_path or ":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS usage_daily (
+                user_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                day TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, day, model)
+            );
+            CREATE INDEX IF NOT EXISTS usage_daily_day ON usage_daily (day);
+            CREATE TABLE IF NOT EXISTS usage_totals (
+                day TEXT NOT NULL,
+                model TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                cached_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                cost_usd REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, model)
+            );
+            """
+        )
+        self._conn.commit()
+
+    def record(self, user_id: int, model_name: str, prompt_tokens: int, cached_tokens: int,
+               completion_tokens: int, cost_usd: float) -> None:
+        """
+        Учитывает один запрос к API
+
+        Args:
+            user_id: ID пользователя
+            model_name: Название модели
+            prompt_tokens: Токены запроса по данным API
+            cached_tokens: Из них взято из кэша промптов OpenAI
+            completion_tokens: Токены ответа по данным API
+            cost_usd: Стоимость запроса в долларах
+        """
+        key = (user_id, model_name, today())
+        values = self._pending.get(key)
+        if values is None:
+            values = self._pending[key] = [0, 0, 0, 0, 0.0]
+        values[REQUESTS] += 1
+        values[PROMPT] += prompt_tokens
+        values[CACHED] += cached_tokens
+        values[COMPLETION] += completion_tokens
+        values[COST] += cost_usd
+
+    async def user_usage(self, user_id: int, since: str) -> Dict[str, UsageStats]:
+        """
+        Расход пользователя по моделям начиная с дня since
+
+        Args:
+            user_id: ID пользователя
+            since: Первый день периода (YYYY-MM-DD)
+
+        Returns:
+            Словарь модель -> расход
+        """
+        pending = [(model, values) for (pending_user, model, day), values in self._pending.items()
+                   if pending_user == user_id and day >= since]
+        rows = await self._read(
+            "SELECT model, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), "
+            "SUM(cost_usd) FROM usage_daily WHERE user_id = ? AND day >= ? GROUP BY model",
+            (user_id, since),
+        )
+        return self._collect(rows, pending)
+
+    async def total_usage(self, since: str) -> Dict[str, UsageStats]:
+        """
+        Общий расход всех пользователей по моделям начиная с дня since
+
+        Args:
+            since: Первый день периода (YYYY-MM-DD)
+
+        Returns:
+            Словарь модель -> расход
+        """
+        pending = [(model, values) for (_, model, day), values in self._pending.items() if day >= since]
+        rows = await self._read(
+            "SELECT model, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), "
+            "SUM(cost_usd) FROM usage_totals WHERE day >= ? GROUP BY model",
+            (since,),
+        )
+        return self._collect(rows, pending)
+
+    async def top_users(self, day: str, limit: int = 10) -> List[Tuple[int, UsageStats]]:
+        """
+        Пользователи с наибольшей стоимостью запросов за день
+
+        Args:
+            day: День (YYYY-MM-DD)
+            limit: Сколько пользователей вернуть
+
+        Returns:
+            Список (ID пользователя, расход) по убыванию стоимости
+        """
+        pending = [(user_id, values) for (user_id, _, pending_day), values in self._pending.items()
+                   if pending_day == day]
+        rows = await self._read(
+            "SELECT user_id, SUM(requests), SUM(prompt_tokens), SUM(cached_tokens), SUM(completion_tokens), "
+            "SUM(cost_usd) FROM usage_daily WHERE day = ? GROUP BY user_id",
+            (day,),
+        )
+        result = self._collect(rows, pending)
+        return sorted(result.items(), key=lambda item: item[1].cost_usd, reverse=True)[:limit]
+
+    async def start(self) -> None:
+        """Запускает периодическую запись счетчиков"""
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self) -> None:
+        """Останавливает фоновую запись и сохраняет оставшиеся счетчики"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self._executor.submit(self._conn.close).result()
+        self._executor.shutdown(wait=True)
+
+    async def flush(self) -> None:
+        """Записывает накопленные приращения одной транзакцией"""
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = {}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._save, pending)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить учет расхода ({len(pending)} записей): {e}")
+            # Возвращаем приращения, чтобы записать их в следующий раз
+            for key, values in pending.items():
+                current = self._pending.setdefault(key, [0, 0, 0, 0, 0.0])
+                for i, value in enumerate(values):
+                    current[i] += value
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Отмена при остановке не должна терять уже изъятые из памяти приращения
+            await asyncio.shield(self.flush())
+
+    def _save(self, pending: Dict[Tuple[int, str, str], list]) -> None:
+        totals: Dict[Tuple[str, str], list] = {}
+        for (_, model, day), values in pending.items():
+            current = totals.setdefault((day, model), [0, 0, 0, 0, 0.0])
+            for i, value in enumerate(values):
+                current[i] += value
+
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage_daily (user_id, model, day, requests, prompt_tokens, cached_tokens, "
+                "completion_tokens, cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, day, model) DO UPDATE SET "
+                "requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost_usd = cost_usd + excluded.cost_usd",
+                [(*key, *values) for key, values in pending.items()],
+            )
+            self._conn.executemany(
+                "INSERT INTO usage_totals (day, model, requests, prompt_tokens, cached_tokens, "
+                "completion_tokens, cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (day, model) DO UPDATE SET "
+                "requests = requests + excluded.requests, prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "cached_tokens = cached_tokens + excluded.cached_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "cost_usd = cost_usd + excluded.cost_usd",
+                [(*key, *values) for key, values in totals.items()],
+            )
+
+    async def _read(self, query: str, params: tuple) -> List[tuple]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: self._conn.execute(query, params).fetchall())
+
+    @staticmethod
+    def _collect(rows: List[tuple], pending: List[tuple]) -> dict:
+        """
+        Складывает сохраненные агрегаты с еще не записанными приращениями.
+
+        Приращения выбираются до чтения: запись и чтение идут через один поток
+        по очереди, поэтому каждое приращение попадает в результат ровно один раз.
+        """
+        result = {key: UsageStats(*values) for key, *values in rows}
+        for key, values in pending:
+            result.setdefault(key, UsageStats()).add(values)
+        return result
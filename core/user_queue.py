@@ -0,0 +1,89 @@
+import asyncio
+from typing import Dict, List, Callable, Awaitable, Optional
+
+# Обработчик объединенного запроса пользователя
+RequestHandler = Callable[[str], Awaitable[None]]
+
+
+class _UserSlot:
+    """Очередь и блокировка одного пользователя"""
+
+    __slots__ = ("lock", "pending", "collecting", "refs")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending: List[str] = []  # Сообщения, еще не отправленные модели
+        self.collecting = False  # Есть запрос, который соберет pending
+        self.refs = 0  # Сколько вызовов submit сейчас используют слот
+
+
+class UserDispatcher:
+    """
+    Последовательная обработка запросов одного пользователя.
+
+    Запросы разных пользователей выполняются параллельно, запросы одного —
+    строго по очереди. Сообщения, пришедшие в течение debounce секунд или
+    пока выполняется предыдущий запрос, объединяются в один запрос к модели.
+    Слоты пользователей удаляются, как только у них не остается работы.
+    """
+
+    def __init__(self, debounce: float = 0.3, separator: str = "\n\n"):
+        self.debounce = debounce
+        self.separator = separator
+        self._slots: Dict[int, _UserSlot] = {}
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    async def submit(self, user_id: int, text: str, handler: RequestHandler) -> bool:
+        """
+        Ставит сообщение пользователя в очередь
+
+        Args:
+            user_id: ID пользователя
+            text: Текст сообщения
+            handler: Корутина, которая обработает объединенный текст
+
+        Returns:
+            True, если сообщение обработано этим вызовом, False — если оно
+            присоединено к запросу, который обработает другой вызов
+        """
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = _UserSlot()
+
+        slot.pending.append(text)
+        if slot.collecting:
+            # Уже есть запрос, который заберет это сообщение
+            return False
+
+        slot.collecting = True
+        slot.refs += 1
+        taken = False
+        try:
+            if self.debounce > 0:
+                await asyncio.sleep(self.debounce)
+
+            async with slot.lock:
+                # Забираем все, что накопилось, включая сообщения,
+                # пришедшие пока выполнялся предыдущий запрос
+                merged = self.separator.join(slot.pending)
+                slot.pending = []
+                slot.collecting = False
+                taken = True
+                await handler(merged)
+            return True
+        except BaseException:
+            if not taken:
+                # Сборщик отменен до отправки запроса — накопленные сообщения уходят вместе с ним
+                slot.collecting = False
+                slot.pending = []
+            raise
+        finally:
+            slot.refs -= 1
+            self._release(user_id, slot)
+
+    def _release(self, user_id: int, slot: _UserSlot) -> None:
+        """Удаляет слот пользователя, если он больше не нужен"""
+        if slot.refs == 0 and not slot.pending and self._slots.get(user_id) is slot:
+            del self._slots[user_id]
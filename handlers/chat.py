@@ -1,15 +1,20 @@
-import asyncio
+from typing import Optional
 from aiogram import Router, F
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from core.openai_client import OpenAIClient
-from utils.logger import logger
+from core.openai_client import CompletionResult, OpenAIClient
+from core.scheduler import QueueCallback
+from core.user_queue import UserDispatcher
+from core.config import STREAMING_ENABLED
+from utils.stream_writer import StreamingReply
+from utils.sender import MESSAGE_LIMIT, TelegramSender, split_message
+from utils.logger import logger, per_message
 
 # Создаем роутер для обработки сообщений
 router = Router()
-openai_client = OpenAIClient()
 
 # Определяем состояния для FSM (машина состояний)
 class SystemPromptStates(StatesGroup):
@@ -26,12 +31,14 @@ async def start_handler(message: Message):
         "Чтобы очистить историю, используй /reset\n"
         "Для установки системного промпта используй /system\n"
         "Для выбора модели используй /model\n"
-        "Для сброса системного промпта используй /reset_system"
+        "Что делать, если модель отвечает медленно, — /speed\n"
+        "Для сброса системного промпта используй /reset_system\n"
+        "Чтобы посмотреть расход токенов, используй /usage"
     )
     logger.info(f"Пользователь {message.from_user.id} запустил бота")
 
 @router.message(Command("reset"))
-async def reset_handler(message: Message):
+async def reset_handler(message: Message, openai_client: OpenAIClient):
     """Обработчик команды /reset (можно добавить сброс контекста, если нужно)"""
     user_id = message.from_user.id
     openai_client.reset_conversation(user_id)
@@ -49,7 +56,7 @@ async def system_prompt_handler(message: Message, state: FSMContext):
     logger.info(f"Пользователь {message.from_user.id} запросил установку системного промпта")
 
 @router.message(SystemPromptStates.waiting_for_prompt)
-async def process_system_prompt(message: Message, state: FSMContext):
+async def process_system_prompt(message: Message, state: FSMContext, openai_client: OpenAIClient):
     """Обработчик для сохранения системного промпта"""
     user_id = message.from_user.id
     system_prompt = message.text
@@ -70,7 +77,7 @@ async def process_system_prompt(message: Message, state: FSMContext):
     logger.info(f"Пользователь {message.from_user.id} установил новый системный промпт")
 
 @router.message(Command("reset_system"))
-async def reset_system_prompt_handler(message: Message):
+async def reset_system_prompt_handler(message: Message, openai_client: OpenAIClient):
     """Обработчик команды /reset_system для сброса системного промпта"""
     user_id = message.from_user.id
     openai_client.reset_system_prompt(user_id)
@@ -81,8 +88,25 @@ async def reset_system_prompt_handler(message: Message):
     )
     logger.info(f"Пользователь {message.from_user.id} сбросил системный промпт")
 
+def format_token_info(model_name: str, result: CompletionResult) -> str:
+    """Формирует подвал ответа с информацией о токенах и стоимости"""
+    if result.model:
+        # Выбранная модель не уложилась в бюджет задержки, ответила запасная
+        model_name = f"{result.model} (вместо {model_name})"
+    if result.cached:
+        return f"\n\n📊 Модель: <b>{model_name}</b>\n" \
+               f"⚡ Ответ из кэша: токены 0, стоимость $0.000000 (₽0.00)"
+    prompt_tokens, completion_tokens = result.prompt_tokens, result.completion_tokens
+    total_cost = result.input_cost + result.output_cost
+    # Токены из кэша промптов OpenAI оплачиваются по сниженной цене
+    sent = f"{prompt_tokens} (из кэша {result.cached_tokens})" if result.cached_tokens else f"{prompt_tokens}"
+    return f"\n\n📊 Модель: <b>{model_name}</b>\n" \
+           f"Токены: отправлено {sent}, получено {completion_tokens}, всего {prompt_tokens + completion_tokens}\n" \
+           f"Стоимость: ввод ${result.input_cost:.6f} (₽{result.input_cost_rub:.2f}), вывод ${result.output_cost:.6f} (₽{result.output_cost_rub:.2f}), Всего: ${total_cost:.6f} (₽{result.total_cost_rub:.2f})"
+
 @router.message(F.text)
-async def process_message(message: Message):
+async def process_message(message: Message, openai_client: OpenAIClient, user_dispatcher: UserDispatcher,
+                          sender: TelegramSender):
     """Обработчик всех текстовых сообщений"""
     user_id = message.from_user.id
     user_message = message.text
@@ -90,36 +114,75 @@ async def process_message(message: Message):
     # Отправляем индикатор набора текста
     await message.bot.send_chat_action(chat_id=user_id, action="typing")
     
-    logger.info(f"Получен запрос от пользователя {user_id}: {user_message}...")
+    logger.info(f"Получен запрос от пользователя {user_id}", extra=per_message(user_id=user_id, text=user_message))
+    
+    async def on_queued(position: int):
+        await sender.answer(message, f"⏳ Сейчас много запросов, ты в очереди: {position}", parse_mode=None)
+    
+    async def reply(text: str):
+        if STREAMING_ENABLED:
+            await stream_reply(message, openai_client, sender, user_id, text, on_queued)
+        else:
+            await send_reply(message, openai_client, sender, user_id, text, on_queued)
+    
+    # Запросы одного пользователя выполняются по очереди, быстрые серии сообщений объединяются
+    if await user_dispatcher.submit(user_id, user_message, reply):
+        logger.info(f"Отправлен ответ пользователю {user_id}", extra=per_message(user_id=user_id))
+    else:
+        logger.info(f"Сообщение пользователя {user_id} объединено с предыдущими", extra=per_message(user_id=user_id))
+
+async def stream_reply(message: Message, openai_client: OpenAIClient, sender: TelegramSender, user_id: int,
+                       user_message: str, on_queued: Optional[QueueCallback] = None):
+    """Потоковая отправка ответа с постепенным редактированием сообщения"""
+    model_info = openai_client.get_user_model(user_id)
+    reply = StreamingReply(message, sender)
+    await reply.start()
     
+    stream = openai_client.stream_completion(user_id, user_message, on_queued)
+    async for delta in stream:
+        await reply.feed(delta)
+    
+    await reply.finish(format_token_info(model_info["name"], stream.result))
+
+async def answer_with_fallback(message: Message, sender: TelegramSender, text: str) -> None:
+    """
+    Отправляет текст с разметкой по умолчанию, а если Telegram ее не разобрал — как обычный текст
+
+    Args:
+        message: Сообщение, на которое отвечаем
+        sender: Очередь исходящих сообщений
+        text: Текст ответа
+    """
+    try:
+        await sender.answer(message, text)
+    except TelegramBadRequest as e:
+        # Например, "a < b" вне тегов: без запасного варианта пользователь остался бы без ответа
+        logger.warning(f"Ответ не разобрался как HTML, отправляем без разметки: {e}")
+        await sender.answer(message, text, parse_mode=None)
+
+async def send_reply(message: Message, openai_client: OpenAIClient, sender: TelegramSender, user_id: int,
+                     user_message: str, on_queued: Optional[QueueCallback] = None):
+    """Отправка ответа целиком после получения от модели"""
     # Получаем ответ от OpenAI
-    response, prompt_tokens, completion_tokens, input_cost, output_cost, input_cost_rub, output_cost_rub, total_cost_rub = await openai_client.get_completion(user_id, user_message)
+    result = await openai_client.get_completion(user_id, user_message, on_queued)
+    response = result.text
     
     # Получаем информацию о модели
     model_info = openai_client.get_user_model(user_id)
-    total_cost = input_cost + output_cost
     
-    token_info = f"\n\n📊 Модель: <b>{model_info['name']}</b>\n" \
-                 f"Токены: отправлено {prompt_tokens}, получено {completion_tokens}, всего {prompt_tokens + completion_tokens}\n" \
-                 f"Стоимость: ввод ${input_cost:.6f} (₽{input_cost_rub:.2f}), вывод ${output_cost:.6f} (₽{output_cost_rub:.2f}), Всего: ${total_cost:.6f} (₽{total_cost_rub:.2f})"
+    token_info = format_token_info(model_info["name"], result)
     response_with_tokens = response + token_info
     
     # Обрабатываем длинные ответы (если они превышают лимит Telegram в 4096 символов)
-    if len(response_with_tokens) <= 4000:
-        await message.answer(response_with_tokens)
-    else:
-        # Разбиваем ответ на части без информации о токенах
-        parts = [response[i:i+4000] for i in range(0, len(response), 4000)]
-        for i, part in enumerate(parts):
-            if i > 0:
-                # Небольшая задержка между отправкой частей
-                await asyncio.sleep(0.5)
-            
-            # Добавляем информацию о токенах только к последней части
-            part_text = part
-            if i == len(parts) - 1:
-                part_text += token_info
-                
-            await message.answer(f"{part_text}\n\n[Часть {i+1}/{len(parts)}]")
-    
-    logger.info(f"Отправлен ответ пользователю {user_id}")
\ No newline at end of file
+    if len(response_with_tokens) <= MESSAGE_LIMIT:
+        await answer_with_fallback(message, sender, response_with_tokens)
+        return
+    
+    # Режем по границам абзацев и слов, оставляя место под подпись части и информацию о токенах.
+    # Части уходят без пауз — темп задают лимиты Telegram в очереди отправки
+    parts = split_message(response, MESSAGE_LIMIT - len(token_info) - 20)
+    for i, part in enumerate(parts):
+        # Добавляем информацию о токенах только к последней части
+        if i == len(parts) - 1:
+            part += token_info
+        await answer_with_fallback(message, sender, f"{part}\n\n[Часть {i+1}/{len(parts)}]")
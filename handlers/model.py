@@ -7,12 +7,11 @@ from utils.logger import logger
 
 # Создаем роутер для обработки сообщений
 router = Router()
-openai_client = OpenAIClient()
 
 @router.message(Command("model"))
-async def model_command_handler(message: Message):
+async def model_command_handler(message: Message, openai_client: OpenAIClient):
     """Обработчик команды /model"""
-    markup = create_model_keyboard()
+    markup = create_model_keyboard(openai_client)
     
     # Получаем текущую модель пользователя
     user_id = message.from_user.id
@@ -28,7 +27,7 @@ async def model_command_handler(message: Message):
     )
     logger.info(f"Пользователь {message.from_user.id} запросил выбор модели")
 
-def create_model_keyboard() -> InlineKeyboardMarkup:
+def create_model_keyboard(openai_client: OpenAIClient) -> InlineKeyboardMarkup:
     """Создает клавиатуру с доступными моделями"""
     models = openai_client.get_available_models()
     keyboard = []
@@ -40,7 +39,7 @@ def create_model_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 @router.callback_query(F.data.startswith("model:"))
-async def model_callback_handler(callback: CallbackQuery):
+async def model_callback_handler(callback: CallbackQuery, openai_client: OpenAIClient):
     """Обработчик выбора модели"""
     user_id = callback.from_user.id
     model_key = callback.data.split(":")[1]
@@ -61,4 +60,41 @@ async def model_callback_handler(callback: CallbackQuery):
         await callback.message.edit_text("❌ Ошибка при выборе модели")
         logger.error(f"Ошибка при выборе модели {model_key} для пользователя {user_id}")
     
-    await callback.answer()
\ No newline at end of file
+    await callback.answer()
+
+# Поведение, когда модель не укладывается в бюджет задержки
+SLO_MODE_TITLES = {
+    "off": "🐢 Ждать ответа выбранной модели",
+    "hedge": "🔁 Повторить запрос к той же модели",
+    "fallback": "⚡ Переключиться на более быструю модель",
+}
+
+@router.message(Command("speed"))
+async def speed_command_handler(message: Message, openai_client: OpenAIClient):
+    """Обработчик команды /speed — выбор поведения при медленном ответе"""
+    current_mode = openai_client.get_slo_mode(message.from_user.id)
+    keyboard = [
+        [InlineKeyboardButton(text=("✅ " if mode == current_mode else "") + title, callback_data=f"slo:{mode}")]
+        for mode, title in SLO_MODE_TITLES.items()
+    ]
+    await message.answer(
+        "⏱ Что делать, если модель отвечает дольше обычного?\n\n"
+        f"Сейчас: <b>{SLO_MODE_TITLES[current_mode]}</b>",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+    )
+    logger.info(f"Пользователь {message.from_user.id} запросил выбор режима задержки")
+
+@router.callback_query(F.data.startswith("slo:"))
+async def speed_callback_handler(callback: CallbackQuery, openai_client: OpenAIClient):
+    """Обработчик выбора поведения при медленном ответе"""
+    user_id = callback.from_user.id
+    mode = callback.data.split(":")[1]
+    
+    if openai_client.set_slo_mode(user_id, mode):
+        await callback.message.edit_text(f"✅ Если модель медлит: <b>{SLO_MODE_TITLES[mode]}</b>")
+        logger.info(f"Пользователь {user_id} выбрал режим задержки {mode}")
+    else:
+        await callback.message.edit_text("❌ Неизвестный режим")
+        logger.error(f"Неизвестный режим задержки {mode} от пользователя {user_id}")
+    
+    await callback.answer()
@@ -0,0 +1,66 @@
+from typing import Dict
+from aiogram import Router
+from aiogram.types import Message
+from aiogram.filters import Command
+from core.config import ADMINS, USD_TO_RUB
+from core.usage import UsageLedger, UsageStats, today, days_ago
+from utils.logger import logger
+
+# Создаем роутер для обработки сообщений
+router = Router()
+
+def format_usage(title: str, usage: Dict[str, UsageStats]) -> str:
+    """Формирует блок отчета о расходе по моделям за период"""
+    if not usage:
+        return f"<b>{title}</b>: запросов не было"
+
+    lines = [f"<b>{title}</b>:"]
+    total_cost = 0.0
+    for model_name, stats in sorted(usage.items()):
+        total_cost += stats.cost_usd
+        lines.append(
+            f"- {model_name}: запросов {stats.requests}, токены {stats.prompt_tokens} → {stats.completion_tokens} "
+            f"(из кэша {stats.cached_tokens}), ${stats.cost_usd:.6f}"
+        )
+    lines.append(f"Итого: ${total_cost:.6f} (₽{total_cost * USD_TO_RUB:.2f})")
+    return "\n".join(lines)
+
+@router.message(Command("usage"))
+async def usage_handler(message: Message, usage_ledger: UsageLedger):
+    """Обработчик команды /usage — расход пользователя за сегодня и за 30 дней"""
+    user_id = message.from_user.id
+    day_usage = await usage_ledger.user_usage(user_id, today())
+    month_usage = await usage_ledger.user_usage(user_id, days_ago(29))
+
+    await message.answer(
+        "📈 Твой расход\n\n"
+        f"{format_usage('Сегодня', day_usage)}\n\n"
+        f"{format_usage('За 30 дней', month_usage)}"
+    )
+    logger.info(f"Пользователь {user_id} запросил статистику расхода")
+
+@router.message(Command("usage_all"))
+async def usage_all_handler(message: Message, usage_ledger: UsageLedger):
+    """Обработчик команды /usage_all — сводка расхода по всем пользователям для администраторов"""
+    user_id = message.from_user.id
+    if user_id not in ADMINS:
+        await message.answer("Эта команда доступна только администраторам")
+        return
+
+    day = today()
+    day_usage = await usage_ledger.total_usage(day)
+    month_usage = await usage_ledger.total_usage(days_ago(29))
+    top = await usage_ledger.top_users(day)
+
+    text = (
+        "📊 Сводка по боту\n\n"
+        f"{format_usage('Сегодня', day_usage)}\n\n"
+        f"{format_usage('За 30 дней', month_usage)}"
+    )
+    if top:
+        text += "\n\n<b>Топ пользователей за сегодня</b>:\n" + "\n".join(
+            f"{i}. {top_user_id}: запросов {stats.requests}, токенов {stats.total_tokens}, ${stats.cost_usd:.6f}"
+            for i, (top_user_id, stats) in enumerate(top, 1)
+        )
+    await message.answer(text)
+    logger.info(f"Администратор {user_id} запросил сводку расхода")
@@ -1,40 +1,225 @@
 import asyncio
-import logging
+import os
+import signal
+import socket
+import sys
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiohttp import web
 
-from core.config import BOT_TOKEN
+from core.config import (
+    BOT_TOKEN, COALESCE_WINDOW, STATE_DB_PATH, STATE_MAX_USERS, STATE_MAX_BYTES, STATE_IDLE_TTL, STATE_FLUSH_INTERVAL,
+    STATE_COMPRESS_AFTER,
+    CACHE_ENABLED, CACHE_TTL, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_DB_PATH,
+    METRICS_ENABLED, METRICS_HOST, METRICS_PORT, USAGE_DB_PATH, USAGE_FLUSH_INTERVAL,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE,
+    SHARD_WORKERS, SHARD_MAX_PENDING, RATE_LIMITS, DEFAULT_RATE_LIMIT, MAX_CONCURRENT_REQUESTS, RATE_LIMIT_RETRIES,
+    STARTUP_PREWARM,
+)
+from core.cache import CompletionCache
+from core.openai_client import OpenAIClient
+from core.scheduler import RequestScheduler
+from core.state import StateStore, SQLiteBackend
+from core.usage import UsageLedger
+from core.user_queue import UserDispatcher
 from handlers.chat import router
 from handlers.model import router as model_router
-from utils.logger import logger
+from handlers.usage import router as usage_router
+from utils.logger import logger, bind_fields, dropped_records, request_context
+from utils.metrics import ACTIVE_CONVERSATIONS, OPENAI_QUEUE_SIZE, LOG_RECORDS_DROPPED, start_metrics_server
+from utils.sender import TelegramSender
+from utils.sharding import ShardRouter, run_worker
+from utils.webhook import WebhookServer
 
-async def main():
-    # Настраиваем логирование aiogram
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
+def share_limits(limits: dict, shards: int) -> dict:
+    """Доля лимитов OpenAI одного процесса, когда лимиты аккаунта делят несколько воркеров"""
+    return {key: value / shards for key, value in limits.items()}
+
+def create_dispatcher(shards: int = 1) -> Dispatcher:
+    """
+    Создает диспетчер со всеми роутерами и общими зависимостями обработчиков
+    
+    Args:
+        shards: Сколько процессов-воркеров делят лимиты OpenAI
+    """
+    storage = MemoryStorage()
+    
+    # Общее хранилище состояний пользователей и один клиент OpenAI на все роутеры
+    state_store = StateStore(
+        backend=SQLiteBackend(STATE_DB_PATH) if STATE_DB_PATH else None,
+        max_users=STATE_MAX_USERS,
+        max_bytes=STATE_MAX_BYTES,
+        idle_ttl=STATE_IDLE_TTL,
+        flush_interval=STATE_FLUSH_INTERVAL,
+        compress_after=STATE_COMPRESS_AFTER,
     )
+    cache = CompletionCache(
+        ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, db_path=CACHE_DB_PATH or None,
+    ) if CACHE_ENABLED else None
+    ledger = UsageLedger(USAGE_DB_PATH or None, flush_interval=USAGE_FLUSH_INTERVAL)
+    scheduler = RequestScheduler(
+        {model: share_limits(limits, shards) for model, limits in RATE_LIMITS.items()},
+        share_limits(DEFAULT_RATE_LIMIT, shards),
+        max_concurrent=max(1, MAX_CONCURRENT_REQUESTS // shards),
+        max_retries=RATE_LIMIT_RETRIES,
+    )
+    openai_client = OpenAIClient(store=state_store, scheduler=scheduler, cache=cache, ledger=ledger)
+    # Очередь запросов по пользователям с объединением быстрых серий сообщений
+    user_dispatcher = UserDispatcher(debounce=COALESCE_WINDOW)
+    # Все исходящие сообщения проходят через одну очередь с лимитами Telegram
+    sender = TelegramSender()
+    dp = Dispatcher(storage=storage, openai_client=openai_client, user_dispatcher=user_dispatcher, sender=sender,
+                    usage_ledger=ledger)
+    
+    ACTIVE_CONVERSATIONS.set_function(lambda: len(state_store))
+    OPENAI_QUEUE_SIZE.set_function(lambda: openai_client.scheduler.queue_size)
+    LOG_RECORDS_DROPPED.set_function(dropped_records)
+    
+    # Каждый апдейт получает ID запроса, который попадает во все его записи лога
+    dp.update.outer_middleware(request_context)
+    
+    async def preload_state(handler, event, data):
+        # Настройки пользователя читаем из хранилища в фоне, чтобы обработчики не ждали SQLite в event loop
+        user = data.get("event_from_user")
+        if user is not None:
+            await state_store.load_state(user.id)
+        return await handler(event, data)
     
+    dp.update.outer_middleware(preload_state)
+    
+    # Регистрируем роутеры; команды подключаем раньше общего обработчика текста
+    dp.include_router(usage_router)
+    dp.include_router(model_router)
+    dp.include_router(router)
+    
+    prewarm_tasks = []
+    
+    async def on_startup():
+        await state_store.start()
+        await ledger.start()
+        # Прогрев не задерживает старт: апдейты начинают приниматься сразу
+        if STARTUP_PREWARM:
+            prewarm_tasks.append(asyncio.create_task(openai_client.prewarm()))
+    
+    async def on_shutdown():
+        for task in prewarm_tasks:
+            task.cancel()
+        # Сохраняем несохраненные изменения перед выходом
+        await state_store.close()
+        await ledger.close()
+        if cache is not None:
+            cache.close()
+    
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+async def main():
     # Проверка наличия токена
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN не найден в .env файле!")
         return
     
-    # Инициализируем бота и диспетчер
+    # Инициализируем бота
     bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
+    if SHARD_WORKERS > 0:
+        await run_sharded(bot)
+        return
+    dp = create_dispatcher()
     
-    # Регистрируем роутеры
-    dp.include_router(router)
-    dp.include_router(model_router)
+    # Эндпоинт метрик для Prometheus
+    if METRICS_ENABLED:
+        await start_metrics_server(METRICS_HOST, METRICS_PORT)
     
     # Запускаем бота
     logger.info("Бот запущен!")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Прием апдейтов через вебхук до получения сигнала остановки"""
+    if not WEBHOOK_URL:
+        logger.error("WEBHOOK_URL не задан для режима webhook!")
+        return
+    
+    server = WebhookServer(
+        dp, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+        workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE,
+    )
+    await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Дорабатываем уже принятые апдейты перед выходом
+        logger.info("Останавливаем вебхук...")
+        await server.stop()
+        await bot.session.close()
+
+async def run_sharded(bot: Bot):
+    """Фронт-процесс: принимает апдейты и раздает их воркерам по пользователям"""
+    router = ShardRouter(
+        SHARD_WORKERS, [sys.executable, os.path.abspath(__file__), "--shard-worker"], max_pending=SHARD_MAX_PENDING,
+    )
+    await router.start()
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    runner = None
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            logger.error("WEBHOOK_URL не задан для режима webhook!")
+            await router.stop()
+            return
+        runner = web.AppRunner(router.app(WEBHOOK_PATH, WEBHOOK_SECRET))
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+        receiver = None
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        receiver = asyncio.create_task(router.poll(bot))
+    
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Останавливаем воркеры...")
+        if receiver is not None:
+            receiver.cancel()
+        if runner is not None:
+            await runner.cleanup()
+        await router.stop()
+        await bot.session.close()
+
+async def run_shard_worker(fd: int, index: int):
+    """Процесс-воркер: обрабатывает апдейты своих пользователей, полученные от фронта"""
+    # Логи всех воркеров идут в один поток вывода — помечаем их номером шарда
+    bind_fields(shard=index)
+    # Остановкой управляет фронт: воркер выходит, когда тот закрывает соединение
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = create_dispatcher(shards=SHARD_WORKERS)
+    try:
+        await run_worker(dp, bot, socket.socket(fileno=fd), concurrency=WEBHOOK_WORKERS)
+    finally:
+        await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.argv[1:2] == ["--shard-worker"]:
+        asyncio.run(run_shard_worker(int(sys.argv[2]), int(sys.argv[3])))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,47 @@
+import asyncio
+from unittest import mock
+
+from aiogram.exceptions import TelegramBadRequest
+
+from core.openai_client import CompletionResult
+from handlers.chat import send_reply
+
+
+class _Sender:
+    def __init__(self):
+        self.sent = []
+
+    async def answer(self, message, text, **kwargs):
+        # В режиме HTML Telegram не разбирает "a < b" вне тегов
+        if kwargs.get("parse_mode", "HTML") is not None and "a < b" in text:
+            raise TelegramBadRequest(mock.Mock(), "can't parse entities")
+        self.sent.append((text, kwargs.get("parse_mode", "HTML")))
+        return object()
+
+
+class _Client:
+    def __init__(self, text):
+        self.text = text
+
+    async def get_completion(self, user_id, prompt, on_queued=None):
+        return CompletionResult(self.text)
+
+    def get_user_model(self, user_id):
+        return {"name": "gpt-4.1-nano"}
+
+
+def test_reply_with_broken_markup_is_sent_as_plain_text():
+    sender = _Sender()
+    asyncio.run(send_reply(mock.Mock(), _Client("Если a < b, то min(a, b) = a"), sender, 1, "вопрос"))
+    assert len(sender.sent) == 1
+    text, parse_mode = sender.sent[0]
+    assert text.startswith("Если a < b") and parse_mode is None
+
+
+def test_long_reply_falls_back_per_part():
+    sender = _Sender()
+    response = "Обычный абзац.\n\n" * 300 + "Если a < b, то min(a, b) = a"
+    asyncio.run(send_reply(mock.Mock(), _Client(response), sender, 1, "вопрос"))
+    assert len(sender.sent) > 1
+    assert [parse_mode for _, parse_mode in sender.sent[:-1]] == ["HTML"] * (len(sender.sent) - 1)
+    assert sender.sent[-1][1] is None
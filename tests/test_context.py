@@ -0,0 +1,93 @@
+import asyncio
+
+from core.context import ContextManager
+from core.history import Message
+from core.state import StateStore
+from core.tokens import TokenCounter
+
+MODEL_INFO = {"name": "gpt-test", "history_budget": 100}
+
+
+def _turns(context, state, count):
+    for i in range(count):
+        state.history.append(Message("user", f"сообщение {i}", 40))
+        state.history, _, _ = context.build(state, "", MODEL_INFO)
+
+
+def test_overflow_is_summarized_in_batches():
+    calls = []
+
+    async def summarizer(user_id, previous, messages):
+        calls.append(len(messages))
+        return "итог"
+
+    async def run():
+        counter = TokenCounter()
+        context = ContextManager(counter, StateStore(), summarizer, batch_tokens=200)
+        state = context.store.get_state(1)
+        for _ in range(10):
+            _turns(context, state, 1)
+            await asyncio.sleep(0)
+        await asyncio.gather(*context._tasks.values())
+        counter.shutdown()
+        return state
+
+    state = asyncio.run(run())
+    # 10 ходов, из окна вытеснено 8 сообщений по 40 токенов — одна пачка из 5 вместо 8 запросов
+    assert calls == [5]
+    assert state.summary is not None
+
+
+def test_failed_batch_is_kept_for_retry():
+    attempts = []
+
+    async def summarizer(user_id, previous, messages):
+        attempts.append([m.content for m in messages])
+        if len(attempts) == 1:
+            raise RuntimeError("API недоступен")
+        return "итог"
+
+    async def run():
+        counter = TokenCounter()
+        context = ContextManager(counter, StateStore(), summarizer, batch_tokens=80)
+        state = context.store.get_state(1)
+        for _ in range(6):
+            _turns(context, state, 1)
+            await asyncio.sleep(0.01)
+        counter.shutdown()
+        return state
+
+    asyncio.run(run())
+    # Вторая попытка начинается с сообщений, которые не удалось сжать в первый раз
+    assert attempts[1][:len(attempts[0])] == attempts[0]
+
+
+def test_pending_overflow_survives_restart(tmp_path):
+    from core.state import SQLiteBackend
+
+    async def failing(user_id, previous, messages):
+        raise RuntimeError("API недоступен")
+
+    async def run(store):
+        counter = TokenCounter()
+        context = ContextManager(counter, store, failing, batch_tokens=80)
+        state = await store.load_state(1)
+        state.history = []
+        _turns(context, state, 6)
+        await asyncio.gather(*context._tasks.values())
+        await store.close()
+        counter.shutdown()
+        return [m.content for m in state.pending]
+
+    path = str(tmp_path / "state.db")
+    pending = asyncio.run(run(StateStore(backend=SQLiteBackend(path))))
+    assert pending
+
+    async def reload():
+        store = StateStore(backend=SQLiteBackend(path))
+        state = await store.load_state(1)
+        await store.close()
+        return [m.content for m in state.pending]
+
+    # Вытесненные из окна сообщения не потерялись: их нет в истории, но они ждут сжатия
+    assert asyncio.run(reload()) == pending
@@ -0,0 +1,48 @@
+import asyncio
+
+from core.hedging import hedged_call
+
+PRIMARY = {"name": "primary"}
+BACKUP = {"name": "backup"}
+
+
+def test_backup_cancelled_in_queue_is_not_reported_as_sent():
+    async def attempt(model_info, started, is_backup):
+        if is_backup:
+            # Запасная попытка так и не дождалась лимитов
+            await asyncio.sleep(10)
+            started.set()
+        started.set()
+        await asyncio.sleep(0.05)
+        return model_info["name"]
+
+    outcome = asyncio.run(hedged_call(attempt, PRIMARY, BACKUP, budget=0.01))
+    assert outcome.hedged and not outcome.backup_won
+    assert outcome.result == "primary"
+    assert outcome.losers == [(BACKUP, None, False, False)]
+
+
+def test_sent_loser_is_reported():
+    async def attempt(model_info, started, is_backup):
+        started.set()
+        await asyncio.sleep(0.01 if is_backup else 10)
+        return model_info["name"]
+
+    outcome = asyncio.run(hedged_call(attempt, PRIMARY, BACKUP, budget=0.01))
+    assert outcome.backup_won and outcome.result == "backup"
+    assert outcome.losers == [(PRIMARY, None, True, False)]
+
+
+def test_failed_loser_is_not_reported_as_cancelled():
+    async def attempt(model_info, started, is_backup):
+        started.set()
+        if is_backup:
+            await asyncio.sleep(0.1)
+            return model_info["name"]
+        # Основной запрос падает (5xx), пока запасной еще в пути
+        await asyncio.sleep(0.05)
+        raise RuntimeError("500")
+
+    outcome = asyncio.run(hedged_call(attempt, PRIMARY, BACKUP, budget=0.01))
+    assert outcome.backup_won and outcome.result == "backup"
+    assert outcome.losers == [(PRIMARY, None, True, True)]
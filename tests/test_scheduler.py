@@ -0,0 +1,120 @@
+import asyncio
+import time
+
+from core.scheduler import PRIORITY_BACKGROUND, PRIORITY_HIGH, PRIORITY_NORMAL, RequestScheduler, TokenBucket
+
+LIMIT = {"rpm": 1000, "tpm": 100000}
+
+
+def test_token_bucket_wait_time_and_pause():
+    bucket = TokenBucket(60, capacity=2)  # 1 токен в секунду
+    now = time.monotonic()
+    assert bucket.wait_time(2, now) == 0
+    bucket.take(2)
+    assert 0.9 < bucket.wait_time(1, now) <= 1.0
+    # Больше емкости не ждем вечно: запрос урезается до capacity
+    assert bucket.wait_time(10, now) <= 2.0
+
+    bucket.give(2)
+    bucket.pause(5)
+    assert bucket.wait_time(1, time.monotonic()) > 4
+
+
+def test_waiters_are_served_by_priority_then_order():
+    scheduler = RequestScheduler({}, LIMIT, max_concurrent=1)
+    order = []
+
+    async def request(name, priority):
+        async with scheduler.slot("gpt", 10, priority):
+            order.append(name)
+
+    async def run():
+        async with scheduler.slot("gpt", 10):
+            tasks = [
+                asyncio.create_task(request("background", PRIORITY_BACKGROUND)),
+                asyncio.create_task(request("normal-1", PRIORITY_NORMAL)),
+                asyncio.create_task(request("high", PRIORITY_HIGH)),
+                asyncio.create_task(request("normal-2", PRIORITY_NORMAL)),
+            ]
+            await asyncio.sleep(0)
+            assert scheduler.queue_size == 4
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["high", "normal-1", "normal-2", "background"]
+
+
+def test_blocked_model_is_not_overtaken_by_lower_priority():
+    scheduler = RequestScheduler({"big": {"rpm": 1000, "tpm": 600}}, LIMIT)
+    granted = []
+
+    async def request(name, model, tokens, priority):
+        async with scheduler.slot(model, tokens, priority):
+            granted.append(name)
+            await asyncio.sleep(10)
+
+    async def run():
+        # Первый запрос почти исчерпал лимит токенов модели
+        first = asyncio.create_task(request("first", "big", 500, PRIORITY_NORMAL))
+        await asyncio.sleep(0)
+        tasks = [
+            asyncio.create_task(request("high", "big", 500, PRIORITY_HIGH)),
+            # Поместился бы в остаток лимита, но не должен обгонять ждущий запрос
+            asyncio.create_task(request("small", "big", 50, PRIORITY_BACKGROUND)),
+            # Другая модель от чужого лимита не зависит
+            asyncio.create_task(request("other", "small-model", 50, PRIORITY_BACKGROUND)),
+        ]
+        await asyncio.sleep(0.01)
+        assert granted == ["first", "other"]
+        assert scheduler.queue_size == 2
+        for task in [first] + tasks:
+            task.cancel()
+        await asyncio.gather(first, *tasks, return_exceptions=True)
+        assert scheduler.active == 0 and scheduler.queue_size == 0
+
+    asyncio.run(run())
+
+
+def test_unused_tokens_are_refunded():
+    scheduler = RequestScheduler({}, {"rpm": 1000, "tpm": 1000})
+
+    async def run():
+        async with scheduler.slot("gpt", 800) as ticket:
+            ticket.actual_tokens = 100
+        tpm = scheduler._model_buckets("gpt")[1]
+        assert tpm.tokens >= 900
+        # Без actual_tokens оценка списывается целиком
+        async with scheduler.slot("gpt", 800):
+            pass
+        assert tpm.tokens < 200
+
+    asyncio.run(run())
+
+
+def test_slot_is_returned_when_cancelled_after_grant():
+    scheduler = RequestScheduler({}, {"rpm": 1000, "tpm": 1000}, max_concurrent=1)
+    entered = []
+
+    async def request():
+        async with scheduler.slot("gpt", 500):
+            entered.append(True)
+
+    async def run():
+        async with scheduler.slot("gpt", 400) as ticket:
+            ticket.actual_tokens = 400
+            waiting = asyncio.create_task(request())
+            await asyncio.sleep(0)
+            assert scheduler.queue_size == 1
+        # Разрешение уже выдано при освобождении слота, но задача отменяется раньше, чем его получит
+        assert scheduler.active == 1
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+
+        assert not entered
+        assert scheduler.active == 0
+        # Токены отмененного запроса вернулись в лимит, следующий запрос проходит сразу
+        assert scheduler._model_buckets("gpt")[1].tokens >= 600
+        await asyncio.wait_for(request(), timeout=1)
+        assert entered
+
+    asyncio.run(run())
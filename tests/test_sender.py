@@ -0,0 +1,41 @@
+from utils.sender import split_first, split_message
+
+CPP_CODE = "```cpp\n" + "std::vector<int> v; if (a<b && c>d) { v.push_back(a); }\n" * 400 + "```"
+JAVA_CODE = "```java\n" + "Map<String, List<Integer>> index = new HashMap<>();\n" * 200 + "```"
+
+
+def test_cpp_code_does_not_loop():
+    parts = split_message(CPP_CODE, 4000)
+    assert all(0 < len(part) <= 4000 for part in parts)
+    assert len(parts) < 10
+
+
+def test_code_is_not_treated_as_tags():
+    parts = split_message(JAVA_CODE, 4000)
+    assert all(len(part) <= 4000 for part in parts)
+    text = "".join(parts)
+    assert "</integer>" not in text.lower() and "</string>" not in text.lower()
+    assert text.count("Map<String, List<Integer>>") == 200
+
+
+def test_leading_whitespace_gives_no_empty_parts():
+    parts = split_message(" " * 5000 + "слово " * 1000, 4000)
+    assert parts and all(part.strip() for part in parts)
+    assert all(len(part) <= 4000 for part in parts)
+
+
+def test_telegram_tags_are_reopened():
+    text = "<b>" + "жирный текст " * 500 + "</b>"
+    head, tail = split_first(text, 4000)
+    assert head.endswith("</b>") and len(head) <= 4000
+    assert tail.startswith("<b>") and len(tail) < len(text)
+
+
+def test_tail_always_shrinks():
+    # Открывающие теги занимают почти весь лимит: повторное открытие не дает продвинуться
+    text = "<b><i><u><s>" * 10 + "x " * 200
+    while text:
+        head, rest = split_first(text, 50)
+        assert head and len(head) <= 50
+        assert len(rest) < len(text)
+        text = rest
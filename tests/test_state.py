@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from core.state import StateBackend, StateStore
+
+
+def test_memory_only_store_keeps_user_settings():
+    store = StateStore(max_users=2)
+    for user_id in range(5):
+        state = store.get_state(user_id)
+        state.system_prompt = f"промпт {user_id}"
+        store.mark_dirty(state)
+    store.idle_ttl = 0
+    store._evict_idle()
+    # Без постоянного хранилища вытеснение стерло бы настройки
+    assert all(store.get_state(user_id).system_prompt == f"промпт {user_id}" for user_id in range(5))
+
+
+def test_memory_only_store_evicts_default_states():
+    store = StateStore(max_users=2)
+    for user_id in range(5):
+        store.get_state(user_id)
+    assert len(store) == 2
+
+
+class _Backend(StateBackend):
+    def __init__(self):
+        self.loaded = []
+
+    def load_settings(self, user_id):
+        self.loaded.append(user_id)
+        return "gpt-4.1", None, None, None, None
+
+    def load_history(self, user_id):
+        return None
+
+    def save(self, rows):
+        pass
+
+
+def test_incomplete_backend_fails_on_creation():
+    class Incomplete(StateBackend):
+        def load_settings(self, user_id):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_concurrent_load_state_returns_one_state():
+    backend = _Backend()
+    store = StateStore(backend=backend)
+
+    async def run():
+        states = await asyncio.gather(store.load_state(7), store.load_state(7))
+        return states, store.get_state(7)
+
+    (first, second), cached = asyncio.run(run())
+    assert first is second is cached
+    assert first.model == "gpt-4.1"
@@ -0,0 +1,50 @@
+import asyncio
+from unittest import mock
+
+from utils.stream_writer import StreamingReply
+
+CPP_CODE = "```cpp\n" + "std::vector<int> v; if (a<b && c>d) { v.push_back(a); }\n" * 400 + "```"
+
+
+class _Sender:
+    def __init__(self):
+        self.answers = 0
+
+    async def answer(self, message, text, **kwargs):
+        self.answers += 1
+        return object()
+
+    async def edit(self, message, text, retry=True, **kwargs):
+        assert text and len(text) <= 4000
+
+    def ready(self, chat_id):
+        return True
+
+
+def test_feed_makes_progress_when_chunker_does_not():
+    sender = _Sender()
+    reply = StreamingReply(mock.Mock(), sender)
+
+    async def run():
+        await reply.start()
+        # Разрез, который возвращает остаток не короче исходного текста
+        with mock.patch("utils.stream_writer.split_first", lambda text, limit: (text[:10], text)):
+            await reply.feed(CPP_CODE)
+        await reply.finish()
+
+    asyncio.run(run())
+    assert sender.answers <= len(CPP_CODE) // 4000 + 2
+
+
+def test_feed_splits_code_into_few_messages():
+    sender = _Sender()
+    reply = StreamingReply(mock.Mock(), sender)
+
+    async def run():
+        await reply.start()
+        for i in range(0, len(CPP_CODE), 50):
+            await reply.feed(CPP_CODE[i:i + 50])
+        await reply.finish()
+
+    asyncio.run(run())
+    assert sender.answers <= len(CPP_CODE) // 3000 + 2
@@ -0,0 +1,56 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+from core import tokens
+from core.tokens import TokenCounter
+
+
+class _Encoding:
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def _reset():
+    tokens._encodings.clear()
+    tokens._failed_at.clear()
+
+
+def test_load_failure_is_retried():
+    _reset()
+    with mock.patch("core.tokens._load_encoding", side_effect=ConnectionError("offline")):
+        assert tokens.get_encoding("gpt-test") is None
+    # Повтор откладывается, но не навсегда
+    tokens._failed_at["gpt-test"] -= tokens.ENCODING_RETRY_INTERVAL
+    with mock.patch("core.tokens._load_encoding", return_value=_Encoding()):
+        assert tokens.get_encoding("gpt-test") is not None
+    assert tokens.count_text("три слова здесь", "gpt-test") == 3
+    _reset()
+
+
+def test_concurrent_callers_share_one_load_off_the_loop():
+    _reset()
+    loop_thread = threading.get_ident()
+    calls = []
+
+    def load(model_name):
+        calls.append(threading.get_ident())
+        time.sleep(0.05)
+        return _Encoding()
+
+    async def run():
+        counter = TokenCounter()
+        try:
+            await asyncio.gather(
+                counter.prewarm(["gpt-test"]),
+                counter.make_message("user", "один два", "gpt-test"),
+            )
+            return await counter.acount_text("а б в г", "gpt-test")
+        finally:
+            counter.shutdown()
+
+    with mock.patch("core.tokens._load_encoding", side_effect=load):
+        assert asyncio.run(run()) == 4
+    assert len(calls) == 1 and calls[0] != loop_thread
+    _reset()
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+from core.user_queue import UserDispatcher
+
+
+def test_messages_within_debounce_are_merged():
+    dispatcher = UserDispatcher(debounce=0.05)
+    handled = []
+
+    async def handler(text):
+        handled.append(text)
+
+    async def run():
+        return await asyncio.gather(*(dispatcher.submit(1, text, handler) for text in ("раз", "два", "три")))
+
+    assert asyncio.run(run()) == [True, False, False]
+    assert handled == ["раз\n\nдва\n\nтри"]
+    assert len(dispatcher) == 0
+
+
+def test_messages_during_request_go_into_next_one():
+    dispatcher = UserDispatcher(debounce=0)
+    handled = []
+    running = 0
+
+    async def handler(text):
+        nonlocal running
+        running += 1
+        assert running == 1  # Запросы одного пользователя не пересекаются
+        await asyncio.sleep(0.05)
+        handled.append(text)
+        running -= 1
+
+    async def other(text):
+        handled.append(text)
+
+    async def run():
+        first = asyncio.create_task(dispatcher.submit(1, "первое", handler))
+        await asyncio.sleep(0.01)
+        rest = [asyncio.create_task(dispatcher.submit(1, text, handler)) for text in ("второе", "третье")]
+        # Другой пользователь не ждет первого
+        await dispatcher.submit(2, "чужое", other)
+        assert handled == ["чужое"]
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(run())
+    assert handled == ["чужое", "первое", "второе\n\nтретье"]
+    assert len(dispatcher) == 0
+
+
+def test_slot_is_released_after_handler_error():
+    dispatcher = UserDispatcher(debounce=0)
+
+    async def failing(text):
+        raise RuntimeError("boom")
+
+    async def ok(text):
+        pass
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await dispatcher.submit(1, "текст", failing)
+        assert len(dispatcher) == 0
+        # Следующее сообщение обрабатывается как обычно
+        assert await dispatcher.submit(1, "еще", ok)
+        assert len(dispatcher) == 0
+
+    asyncio.run(run())
+
+
+def test_slot_is_released_when_cancelled_during_debounce():
+    dispatcher = UserDispatcher(debounce=10)
+    handled = []
+
+    async def handler(text):
+        handled.append(text)
+
+    async def run():
+        collector = asyncio.create_task(dispatcher.submit(1, "раз", handler))
+        await asyncio.sleep(0)
+        assert not await dispatcher.submit(1, "два", handler)
+        collector.cancel()
+        await asyncio.gather(collector, return_exceptions=True)
+        assert len(dispatcher) == 0
+
+        # Накопленные сообщения ушли вместе с отмененным сборщиком
+        dispatcher.debounce = 0
+        await dispatcher.submit(1, "три", handler)
+
+    asyncio.run(run())
+    assert handled == ["три"]
+    assert len(dispatcher) == 0
+
+
+def test_slot_is_released_when_cancelled_during_request():
+    dispatcher = UserDispatcher(debounce=0)
+
+    async def handler(text):
+        await asyncio.sleep(10)
+
+    async def run():
+        task = asyncio.create_task(dispatcher.submit(1, "текст", handler))
+        await asyncio.sleep(0.01)
+        assert len(dispatcher) == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert len(dispatcher) == 0
+
+    asyncio.run(run())
@@ -1,24 +1,211 @@
+import atexit
+import contextvars
+import copy
+import itertools
+import json
 import logging
+import queue
+import random
 import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from core.config import LOG_FORMAT, LOG_LEVEL, LOG_SAMPLE_RATE, LOG_MAX_LENGTH, LOG_QUEUE_SIZE
+
+# ID запроса (апдейта) и решение о выборке для логов, записанных при его обработке
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_sampled: contextvars.ContextVar[Optional[bool]] = contextvars.ContextVar("log_sampled", default=None)
+_request_seq = itertools.count(1)
+
+# Поля, которые добавляются к каждой записи процесса (например, номер шарда)
+_static_fields: Dict[str, Any] = {}
+
+# Логгеры, каждая запись которых относится к одному сообщению пользователя
+PER_MESSAGE_LOGGERS = {"aiogram.event"}
+
+# Очередь записей процесса; создается в setup_logger
+_queue_handler: Optional["_DroppingQueueHandler"] = None
+
+# Атрибуты, которые есть у любой записи; остальные пришли через extra
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "per_message"}
+
+
+def per_message(**fields: Any) -> Dict[str, Any]:
+    """
+    extra для логов, которые пишутся на каждое сообщение пользователя
+
+    Такие записи попадают в лог с вероятностью LOG_SAMPLE_RATE, причем
+    решение принимается один раз на запрос: либо все его записи, либо ни одной.
+
+    Args:
+        fields: Дополнительные поля записи
+
+    Returns:
+        Словарь для параметра extra
+    """
+    return {"per_message": True, **fields}
+
+
+def bind_fields(**fields: Any) -> None:
+    """Добавляет поля ко всем последующим записям процесса"""
+    _static_fields.update(fields)
+
+
+def _truncate(value: Any) -> Any:
+    if isinstance(value, str) and len(value) > LOG_MAX_LENGTH:
+        return f"{value[:LOG_MAX_LENGTH]}… (+{len(value) - LOG_MAX_LENGTH})"
+    return value
+
+
+class _ContextFilter(logging.Filter):
+    """Выполняется в потоке вызова: добавляет ID запроса и отбрасывает записи вне выборки"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "per_message", False) or record.name in PER_MESSAGE_LOGGERS:
+            sampled = _sampled.get()
+            if sampled is None:
+                sampled = random.random() < LOG_SAMPLE_RATE
+            if not sampled:
+                return False
+        record.request_id = _request_id.get()
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """Кладет записи в ограниченную очередь и не ждет, если она заполнена"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._plain = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляем сразу: они могут измениться, пока запись ждет в очереди.
+        # Трейсбек храним отдельно от сообщения, чтобы его не задело обрезание
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._plain.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Медленный вывод не должен тормозить обработку запросов — теряем запись
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON; длинные значения обрезаются"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": _truncate(record.getMessage()),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update(_static_fields)
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != "request_id":
+                entry[key] = _truncate(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Человекочитаемый формат с ID запроса; длинные сообщения обрезаются"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = _truncate(record.message)
+        line = super().formatMessage(record)
+        prefix = " ".join(f"{key}={value}" for key, value in _static_fields.items())
+        if getattr(record, "request_id", None):
+            prefix = f"{prefix} [{record.request_id}]".strip()
+        return f"{prefix} {line}" if prefix else line
+
+
+async def request_context(handler: Callable[..., Awaitable[Any]], event: Any, data: Dict[str, Any]) -> Any:
+    """
+    Внешний middleware aiogram: присваивает апдейту ID запроса для логов
+
+    Args:
+        handler: Следующий обработчик
+        event: Апдейт
+        data: Данные обработчика
+
+    Returns:
+        Результат обработчика
+    """
+    update_id = getattr(event, "update_id", None)
+    request_token = _request_id.set(f"{update_id}" if update_id is not None else f"r{next(_request_seq)}")
+    sampled_token = _sampled.set(random.random() < LOG_SAMPLE_RATE)
+    try:
+        return await handler(event, data)
+    finally:
+        _sampled.reset(sampled_token)
+        _request_id.reset(request_token)
+
+
+def create_pipeline(stream: Any, formatter: logging.Formatter) -> tuple:
+    """
+    Создает очередь записей и поток, который выводит их в stream
+
+    Args:
+        stream: Куда писать записи
+        formatter: Формат записей
+
+    Returns:
+        Кортеж (обработчик для логгера, еще не запущенный QueueListener)
+    """
+    handler = _DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(_ContextFilter())
+    sink = logging.StreamHandler(stream)
+    sink.setFormatter(formatter)
+    return handler, QueueListener(handler.queue, sink)
+
 
 def setup_logger():
-    # Настраиваем логгер
+    """
+    Настраивает логирование процесса
+
+    Все записи (и бота, и библиотек) идут через корневой логгер в очередь,
+    а в stdout их пишет отдельный поток. Обработчики событий только кладут
+    запись в очередь и не ждут вывода.
+    """
+    global _queue_handler
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    
-    # Обработчик для вывода в консоль
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
-    
-    # Форматируем вывод логов
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
-    handler.setFormatter(formatter)
-    
-    # Добавляем обработчик к логгеру
-    logger.addHandler(handler)
-    
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if _queue_handler is None:
+        # Обработчики, добавленные раньше (например, basicConfig), дублировали бы вывод
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+
+        formatter = JsonFormatter() if LOG_FORMAT == "json" else TextFormatter()
+        _queue_handler, listener = create_pipeline(sys.stdout, formatter)
+        root.addHandler(_queue_handler)
+        listener.start()
+        # Дописываем оставшееся в очереди при выходе
+        atexit.register(listener.stop)
+
     return logger
 
-logger = setup_logger()
\ No newline at end of file
+
+logger = setup_logger()
+
+
+def dropped_records() -> int:
+    """Сколько записей потеряно из-за переполненной очереди"""
+    return _queue_handler.dropped if _queue_handler is not None else 0
@@ -0,0 +1,181 @@
+import bisect
+import time
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from core.config import METRICS_ENABLED
+from utils.logger import logger
+
+# Границы корзин гистограмм задержек (сек)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Текущее значение, вычисляемое функцией в момент выгрузки"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        self._function = function
+
+    def render(self) -> List[str]:
+        value = self._function() if self._function is not None else 0
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram: "Histogram", labels: Tuple[str, ...]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Tuple[str, ...], list] = {}  # labels -> [счетчики корзин..., сумма, количество]
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()) -> None:
+        data = self.values.get(labels)
+        if data is None:
+            data = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    def time(self, labels: Tuple[str, ...] = ()) -> _Timer:
+        """Контекстный менеджер, замеряющий длительность блока"""
+        return _Timer(self, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, data in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {data[-1]}")
+        return lines
+
+
+class _NullMetric:
+    """Заглушка для выключенных метрик: все операции ничего не делают"""
+
+    def inc(self, *args, **kwargs) -> None:
+        pass
+
+    def observe(self, *args, **kwargs) -> None:
+        pass
+
+    def set_function(self, *args, **kwargs) -> None:
+        pass
+
+    def time(self, *args, **kwargs):
+        return nullcontext()
+
+    def render(self) -> List[str]:
+        return []
+
+
+_NULL = _NullMetric()
+_registry: List = []
+
+
+def _register(metric):
+    if not METRICS_ENABLED:
+        return _NULL
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    """Выгружает все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Этапы обработки: tokenize, queue_wait, first_token, api_total, send, edit
+STAGE_SECONDS = _register(Histogram("gptbot_stage_seconds", "Длительность этапов обработки запроса", ["stage"]))
+TOKENS_TOTAL = _register(Counter("gptbot_tokens_total", "Израсходовано токенов", ["model", "kind"]))
+COST_USD_TOTAL = _register(Counter("gptbot_cost_usd_total", "Стоимость запросов в долларах", ["model"]))
+HEDGED_TOTAL = _register(Counter("gptbot_hedged_total", "Запросы, превысившие бюджет задержки", ["model", "mode", "winner"]))
+ERRORS_TOTAL = _register(Counter("gptbot_errors_total", "Ошибки по типам", ["type"]))
+ACTIVE_CONVERSATIONS = _register(Gauge("gptbot_active_conversations", "Пользователей с состоянием в памяти"))
+OPENAI_QUEUE_SIZE = _register(Gauge("gptbot_openai_queue_size", "Запросов, ожидающих лимитов OpenAI"))
+LOG_RECORDS_DROPPED = _register(Gauge("gptbot_log_records_dropped", "Записей лога, потерянных из-за переполненной очереди"))
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Запускает HTTP-сервер с эндпоинтом /metrics
+
+    Args:
+        host: Адрес для прослушивания
+        port: Порт
+
+    Returns:
+        Runner сервера для остановки
+    """
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,263 @@
+import asyncio
+import re
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+from core.config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+from core.scheduler import TokenBucket
+from utils.logger import logger
+from utils.metrics import STAGE_SECONDS
+
+# Лимит Telegram 4096 символов, оставляем запас под разметку
+MESSAGE_LIMIT = 4000
+
+# Теги, которые понимает Telegram в режиме HTML; остальное в угловых скобках — обычный текст
+# (например, std::vector<int> или Map<String, List<Integer>> в ответах с кодом)
+TELEGRAM_TAGS = frozenset({
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "a", "code", "pre",
+    "span", "tg-spoiler", "tg-emoji", "blockquote",
+})
+
+# HTML-теги (имя и атрибуты вида key="value"), HTML-сущности и границы блоков кода Markdown
+_TOKEN_RE = re.compile(
+    r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)(?:\s+[a-zA-Z][\w:-]*(?:\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s\"'<>]+))?)*\s*>"
+    r"|&#?\w+;|```"
+)
+_PARTIAL_TAG_RE = re.compile(r"</?[a-zA-Z][^<>]*$")
+
+# Уровни позиций в тексте: где можно разрезать сообщение
+_FREE = 0  # Вне тегов и блоков кода
+_NESTED = 1  # Внутри открытого тега или блока кода — резать можно, но придется закрыть и открыть заново
+_TOKEN = 2  # Внутри самого тега или сущности — резать нельзя
+
+
+def _scan(text: str) -> Tuple[bytearray, List[Tuple[str, str]], bool]:
+    """
+    Размечает позиции текста по уровням и находит незакрытые теги
+
+    Returns:
+        Кортеж (уровень каждой позиции, открытые теги [(имя, тег)], открыт ли блок ```)
+    """
+    marks = bytearray(len(text) + 1)
+    stack: List[Tuple[str, str]] = []
+    fence = False
+    last = 0
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group(0)
+        if token.startswith("<") and (fence or match.group(2).lower() not in TELEGRAM_TAGS):
+            # Внутри блока кода и для неизвестных Telegram тегов угловые скобки — просто текст
+            continue
+        start, end = match.span()
+        level = _NESTED if stack or fence else _FREE
+        marks[last:start + 1] = bytes([level]) * (start + 1 - last)
+        marks[start + 1:end] = bytes([_TOKEN]) * (end - start - 1)
+        last = end
+
+        if token == "```":
+            fence = not fence
+        elif token.startswith("<"):
+            name = match.group(2).lower()
+            if match.group(1):
+                # Закрывающий тег снимает со стека все вложенные до парного открывающего
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i][0] == name:
+                        del stack[i:]
+                        break
+            else:
+                stack.append((name, token))
+
+    level = _NESTED if stack or fence else _FREE
+    marks[last:] = bytes([level]) * (len(marks) - last)
+    # Недописанный тег в конце текста (например, во время стриминга) тоже нельзя резать
+    partial = None if fence else _PARTIAL_TAG_RE.search(text, last)
+    if partial:
+        marks[partial.start() + 1:] = bytes([_TOKEN]) * (len(marks) - partial.start() - 1)
+    return marks, stack, fence
+
+
+def _find_cut(text: str, limit: int, marks: bytearray) -> int:
+    """Ищет лучшую позицию разреза в пределах limit символов"""
+    window = text[:limit]
+    candidates = (("\n\n", _FREE), ("\n", _FREE), (" ", _FREE), ("\n", _NESTED), (" ", _NESTED))
+    # Сначала ищем разрез не раньше середины, чтобы не плодить короткие части
+    for min_pos in (limit // 2, 1):
+        for separator, max_level in candidates:
+            pos = window.rfind(separator)
+            while pos >= min_pos:
+                if marks[pos] <= max_level:
+                    return pos
+                pos = window.rfind(separator, 0, pos)
+
+    # Разделителей нет (например, длинная ссылка) — режем где угодно, но не внутри тега
+    pos = limit
+    while pos > 0 and marks[pos] == _TOKEN:
+        pos -= 1
+    return pos or limit
+
+
+def split_first(text: str, limit: int = MESSAGE_LIMIT) -> Tuple[str, str]:
+    """
+    Отрезает от текста первую часть, не длиннее limit символов
+
+    Разрез делается по абзацу, строке или пробелу и никогда не попадает внутрь
+    HTML-тега или сущности. Если разрез проходит внутри тега или блока кода,
+    они закрываются в первой части и открываются заново во второй. Остаток
+    всегда короче исходного текста, а первая часть не бывает пустой.
+
+    Args:
+        text: Исходный текст
+        limit: Максимальная длина части
+
+    Returns:
+        Кортеж (первая часть, остаток)
+    """
+    # Пробелы в начале Telegram все равно обрежет, а часть из одних пробелов он не примет
+    text = text.lstrip()
+    if len(text) <= limit:
+        return text, ""
+
+    # Размечаем текст до конца тега, который может начинаться до лимита
+    end = text.find(">", limit)
+    marks, _, _ = _scan(text[:end + 1] if end != -1 else text)
+    window = limit
+    while True:
+        cut = _find_cut(text, window, marks)
+        head = text[:cut].rstrip()
+        _, open_tags, fence = _scan(head)
+        closing = ("\n```" if fence else "") + "".join(f"</{name}>" for name, _ in reversed(open_tags))
+        if len(head) + len(closing) <= limit or window <= len(closing) + 1:
+            break
+        window -= len(head) + len(closing) - limit
+
+    tail = text[cut:]
+    if not fence:
+        tail = tail.lstrip()
+    elif tail.startswith("\n"):
+        # В блоке кода сохраняем отступы, убираем только перевод строки на месте разреза
+        tail = tail[1:]
+    reopen = "".join(tag for _, tag in open_tags) + ("```\n" if fence else "")
+    if not head or len(head) + len(closing) > limit or len(reopen) + len(tail) >= len(text):
+        # Теги не помещаются или разрез не продвинулся (повторно открытые теги длиннее отрезанного) —
+        # режем по лимиту без восстановления разметки, но не внутри тега
+        cut = limit
+        while cut > 1 and marks[cut] == _TOKEN:
+            cut -= 1
+        return text[:cut], text[cut:]
+    return head + closing, reopen + tail
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """
+    Разбивает длинный текст на части для отправки в Telegram
+
+    Args:
+        text: Исходный текст
+        limit: Максимальная длина части
+
+    Returns:
+        Список частей
+    """
+    parts = []
+    while text:
+        head, text = split_first(text, limit)
+        if head:
+            parts.append(head)
+    return parts
+
+
+class TelegramSender:
+    """
+    Очередь исходящих сообщений с учетом лимитов Telegram.
+
+    Отправки и правки проходят через общий лимит на бота и лимит на чат.
+    Части длинного ответа уходят так быстро, как позволяют лимиты, без
+    фиксированных пауз. При RetryAfter чат ставится на паузу на указанное
+    Telegram время, а вызов повторяется.
+    """
+
+    def __init__(self, global_per_second: float = TELEGRAM_GLOBAL_RATE, chat_per_second: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, max_retries: int = 3):
+        self.global_bucket = TokenBucket(global_per_second * 60, capacity=global_per_second)
+        self.chat_per_second = chat_per_second
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: Dict[int, TokenBucket] = {}
+
+    async def answer(self, message: Message, text: str, **kwargs) -> Message:
+        """
+        Отправляет сообщение в чат исходного сообщения
+
+        Args:
+            message: Сообщение, на которое отвечаем
+            text: Текст ответа
+            **kwargs: Параметры send_message (parse_mode и т.п.)
+
+        Returns:
+            Отправленное сообщение
+        """
+        with STAGE_SECONDS.time(("send",)):
+            return await self._call(message.chat.id, lambda: message.answer(text, **kwargs))
+
+    async def edit(self, message: Message, text: str, retry: bool = True, **kwargs) -> None:
+        """
+        Редактирует отправленное сообщение
+
+        Args:
+            message: Сообщение бота
+            text: Новый текст
+            retry: Повторять ли правку после RetryAfter (промежуточные правки проще пропустить)
+            **kwargs: Параметры edit_text (parse_mode и т.п.)
+        """
+        with STAGE_SECONDS.time(("edit",)):
+            await self._call(message.chat.id, lambda: message.edit_text(text, **kwargs),
+                             self.max_retries if retry else 0)
+
+    def ready(self, chat_id: int) -> bool:
+        """Можно ли отправить в чат прямо сейчас, не дожидаясь лимитов"""
+        now = time.monotonic()
+        return self.global_bucket.wait_time(1, now) == 0 and self._chat_bucket(chat_id).wait_time(1, now) == 0
+
+    async def _call(self, chat_id: int, request, max_retries: Optional[int] = None):
+        if max_retries is None:
+            max_retries = self.max_retries
+        attempt = 0
+        while True:
+            await self._acquire(chat_id)
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                self._chat_bucket(chat_id).pause(e.retry_after)
+                if attempt >= max_retries:
+                    raise
+                attempt += 1
+                logger.warning(f"Флуд-лимит Telegram для чата {chat_id}, пауза {e.retry_after} с")
+
+    async def _acquire(self, chat_id: int) -> None:
+        """Ждет, пока общий лимит и лимит чата позволят отправку"""
+        chat_bucket = self._chat_bucket(chat_id)
+        while True:
+            now = time.monotonic()
+            wait = max(self.global_bucket.wait_time(1, now), chat_bucket.wait_time(1, now))
+            if wait <= 0:
+                self.global_bucket.take(1)
+                chat_bucket.take(1)
+                return
+            await asyncio.sleep(wait)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 10000:
+                self._prune()
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_per_second * 60, capacity=self.chat_burst)
+        return bucket
+
+    def _prune(self) -> None:
+        """Забывает чаты, чей лимит полностью восстановился"""
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chats.items()):
+            if bucket.wait_time(bucket.capacity, now) == 0:
+                del self._chats[chat_id]
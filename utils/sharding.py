@@ -0,0 +1,301 @@
+import asyncio
+import bisect
+import hashlib
+import hmac
+import json
+import socket
+import struct
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from utils.logger import logger
+from utils.webhook import SECRET_HEADER
+
+# Кадр обмена между фронтом и воркером: длина (4 байта) и содержимое.
+# Фронт отправляет JSON апдейта, воркер подтверждает обработку его update_id
+_FRAME = struct.Struct(">I")
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Читает один кадр; None — соединение закрыто"""
+    try:
+        header = await reader.readexactly(_FRAME.size)
+        return await reader.readexactly(_FRAME.unpack(header)[0])
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    writer.write(_FRAME.pack(len(payload)) + payload)
+
+
+class HashRing:
+    """
+    Консистентное хэширование пользователей по шардам.
+
+    Каждый шард занимает replicas точек на кольце; при изменении числа шардов
+    к другому воркеру переезжает лишь около 1/N пользователей.
+    """
+
+    def __init__(self, shards: int, replicas: int = 100):
+        points = sorted((self._hash(f"{shard}:{i}"), shard) for shard in range(shards) for i in range(replicas))
+        self._keys = [key for key, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def get(self, key: int) -> int:
+        """Номер шарда для ключа"""
+        index = bisect.bisect(self._keys, self._hash(str(key)))
+        return self._shards[index % len(self._shards)]
+
+
+def routing_key(update: dict) -> int:
+    """
+    Ключ маршрутизации апдейта: ID пользователя или чата
+
+    Args:
+        update: Апдейт в виде словаря из JSON
+
+    Returns:
+        ID пользователя; для апдейтов без пользователя — ID апдейта
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = value.get(field)
+            if isinstance(owner, dict) and "id" in owner:
+                return owner["id"]
+    return update.get("update_id", 0)
+
+
+class _Shard:
+    """Процесс-воркер и отправленные ему, но еще не подтвержденные апдейты"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.pending: "OrderedDict[int, bytes]" = OrderedDict()
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.changed = asyncio.Condition()
+        self.processed = 0
+        self.restarts = 0
+
+
+class ShardRouter:
+    """
+    Фронт шардированного режима.
+
+    Принимает апдейты и по консистентному хэшу ID пользователя отправляет
+    каждый в один из N процессов-воркеров, так что история пользователя
+    всегда живет в памяти одного процесса. Апдейт остается в очереди шарда,
+    пока воркер не подтвердит его обработку; если воркер упал, он
+    перезапускается и получает все неподтвержденные апдейты заново
+    (доставка «хотя бы один раз»).
+
+    Args:
+        shards: Число процессов-воркеров
+        command: Команда запуска воркера; к ней добавляются номер дескриптора сокета и номер шарда
+        max_pending: Сколько неподтвержденных апдейтов держать на шард, прежде чем ждать
+        restart_delay: Пауза перед перезапуском упавшего воркера (сек)
+    """
+
+    def __init__(self, shards: int, command: Sequence[str], max_pending: int = 1000, restart_delay: float = 1.0):
+        self.command = list(command)
+        self.max_pending = max_pending
+        self.restart_delay = restart_delay
+        self.ring = HashRing(shards)
+        self.shards = [_Shard(i) for i in range(shards)]
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False
+
+    async def start(self) -> None:
+        """Запускает воркеры"""
+        for shard in self.shards:
+            await self._spawn(shard)
+            self._tasks.append(asyncio.create_task(self._supervise(shard)))
+        logger.info(f"Запущено воркеров: {len(self.shards)}")
+
+    async def route(self, raw: bytes) -> int:
+        """
+        Отправляет апдейт воркеру его пользователя
+
+        Args:
+            raw: JSON апдейта
+
+        Returns:
+            Номер шарда
+        """
+        update = json.loads(raw)
+        shard = self.shards[self.ring.get(routing_key(update))]
+        async with shard.changed:
+            await shard.changed.wait_for(lambda: len(shard.pending) < self.max_pending)
+        shard.pending[update["update_id"]] = raw
+
+        # Если воркер сейчас перезапускается, апдейт уйдет ему после старта
+        writer = shard.writer
+        if writer is not None and not writer.is_closing():
+            write_frame(writer, raw)
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        return shard.index
+
+    async def join(self) -> None:
+        """Ждет подтверждения всех отправленных апдейтов"""
+        for shard in self.shards:
+            async with shard.changed:
+                await shard.changed.wait_for(lambda: not shard.pending)
+
+    async def stop(self, drain_timeout: float = 30.0) -> None:
+        """
+        Дожидается обработки очередей и останавливает воркеры
+
+        Args:
+            drain_timeout: Сколько ждать обработки уже принятых апдейтов (сек)
+        """
+        try:
+            await asyncio.wait_for(self.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            pending = sum(len(shard.pending) for shard in self.shards)
+            logger.warning(f"Не дождались обработки {pending} апдейтов при остановке")
+
+        self._stopping = True
+        # Закрытый сокет — сигнал воркеру доработать текущие апдейты и выйти
+        for shard in self.shards:
+            if shard.writer is not None:
+                shard.writer.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _spawn(self, shard: _Shard) -> None:
+        parent, child = socket.socketpair()
+        shard.process = await asyncio.create_subprocess_exec(
+            *self.command, str(child.fileno()), str(shard.index), pass_fds=(child.fileno(),),
+        )
+        child.close()
+        shard.reader, shard.writer = await asyncio.open_unix_connection(sock=parent)
+        # Повторяем все, что не успел подтвердить предыдущий процесс
+        for raw in shard.pending.values():
+            write_frame(shard.writer, raw)
+
+    async def _supervise(self, shard: _Shard) -> None:
+        """Принимает подтверждения воркера и перезапускает его после падения"""
+        while True:
+            while True:
+                frame = await read_frame(shard.reader)
+                if frame is None:
+                    break
+                shard.pending.pop(int(frame), None)
+                shard.processed += 1
+                async with shard.changed:
+                    shard.changed.notify_all()
+
+            shard.writer.close()
+            code = await shard.process.wait()
+            if self._stopping:
+                return
+            shard.restarts += 1
+            logger.error(
+                f"Воркер {shard.index} завершился с кодом {code}, перезапускаем; "
+                f"неподтвержденных апдейтов: {len(shard.pending)}"
+            )
+            await asyncio.sleep(self.restart_delay)
+            await self._spawn(shard)
+
+    def app(self, path: str = "/webhook", secret: Optional[str] = None, enqueue_timeout: float = 1.0) -> web.Application:
+        """
+        Веб-приложение вебхука, раздающее апдейты по воркерам
+
+        Args:
+            path: Путь вебхука
+            secret: Секрет из заголовка X-Telegram-Bot-Api-Secret-Token
+            enqueue_timeout: Сколько ждать места в очереди шарда, прежде чем ответить 503
+        """
+        async def handle(request: web.Request) -> web.Response:
+            if secret is not None:
+                token = request.headers.get(SECRET_HEADER, "")
+                if not hmac.compare_digest(token.encode(), secret.encode()):
+                    return web.Response(status=401)
+            if self._stopping:
+                return web.Response(status=503)
+
+            raw = await request.read()
+            try:
+                await asyncio.wait_for(self.route(raw), enqueue_timeout)
+            except (ValueError, KeyError):
+                return web.Response(status=400)
+            except asyncio.TimeoutError:
+                # Воркер не успевает — Telegram повторит доставку позже
+                logger.warning("Очередь шарда переполнена, отвечаем 503")
+                return web.Response(status=503)
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(path, handle)
+        return app
+
+    async def poll(self, bot: Bot) -> None:
+        """Получает апдейты long polling и раздает их по воркерам"""
+        offset = None
+        while not self._stopping:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30)
+            except Exception as e:
+                logger.error(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.route(update.model_dump_json(exclude_none=True).encode())
+                offset = update.update_id + 1
+
+
+async def run_worker(dp: Dispatcher, bot: Bot, sock: socket.socket, concurrency: int = 64) -> None:
+    """
+    Цикл процесса-воркера: обрабатывает апдейты от фронта и подтверждает их
+
+    Args:
+        dp: Диспетчер с роутерами и зависимостями
+        bot: Бот для ответов
+        sock: Сокет, полученный от фронта
+        concurrency: Сколько апдейтов обрабатывать одновременно
+    """
+    reader, writer = await asyncio.open_unix_connection(sock=sock)
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def process(raw: bytes) -> None:
+        data = json.loads(raw)
+        try:
+            await dp.feed_update(bot, Update.model_validate(data, context={"bot": bot}))
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {data.get('update_id')}: {e}")
+        finally:
+            slots.release()
+            # Подтверждаем и неудачные апдейты: повтор после ошибки обработчика ничего не исправит
+            if not writer.is_closing():
+                write_frame(writer, str(data["update_id"]).encode())
+
+    while True:
+        raw = await read_frame(reader)
+        if raw is None:
+            break
+        await slots.acquire()
+        task = asyncio.create_task(process(raw))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # Фронт закрыл соединение — дорабатываем принятые апдейты и выходим
+    await asyncio.gather(*tasks, return_exceptions=True)
+    writer.close()
+    await dp.emit_shutdown(bot=bot, **dp.workflow_data)
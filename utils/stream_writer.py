@@ -0,0 +1,107 @@
+import time
+from typing import Optional
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+
+from core.config import STREAM_EDIT_INTERVAL
+from utils.sender import MESSAGE_LIMIT, TelegramSender, split_first
+
+PLACEHOLDER = "⏳"
+
+
+class StreamingReply:
+    """
+    Ответ, который постепенно дописывается редактированием сообщения.
+
+    Промежуточные правки отправляются не чаще edit_interval и без разметки,
+    чтобы незакрытые HTML-теги не ломали отправку. Финальная правка идет с
+    разметкой по умолчанию. При достижении лимита длины текст разрезается
+    по границе абзаца или слова и продолжается в новом сообщении.
+    """
+
+    def __init__(self, message: Message, sender: TelegramSender, edit_interval: float = STREAM_EDIT_INTERVAL,
+                 limit: int = MESSAGE_LIMIT):
+        self.message = message
+        self.sender = sender
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self._sent: Optional[Message] = None
+        self._text = ""  # Текст текущего сообщения
+        self._shown = None  # (текст, финальная ли правка) — что уже видит пользователь
+        self._next_edit = 0.0
+
+    async def start(self) -> None:
+        """Отправляет сообщение-заглушку, которое будет редактироваться"""
+        self._sent = await self.sender.answer(self.message, PLACEHOLDER, parse_mode=None)
+        self._next_edit = time.monotonic() + self.edit_interval
+
+    async def feed(self, delta: str) -> None:
+        """
+        Добавляет фрагмент ответа и при необходимости обновляет сообщение
+
+        Args:
+            delta: Новый фрагмент текста
+        """
+        self._text += delta
+        while len(self._text) > self.limit:
+            head, tail = split_first(self._text, self.limit)
+            if not head or len(tail) >= len(self._text):
+                # Разрез не продвинулся — иначе каждый проход отправлял бы новое сообщение без конца
+                head, tail = self._text[:self.limit], self._text[self.limit:]
+            self._text = head
+            await self._rollover(tail)
+
+        # Промежуточную правку не ждем: если лимит чата исчерпан, покажем текст позже
+        if time.monotonic() >= self._next_edit and self.sender.ready(self.message.chat.id):
+            await self._edit(final=False)
+
+    async def finish(self, footer: str = "") -> None:
+        """
+        Завершает ответ, дописывая подвал со статистикой
+
+        Args:
+            footer: Текст подвала (токены и стоимость)
+        """
+        if len(self._text) + len(footer) > self.limit:
+            await self._edit(final=True)
+            self._sent = await self.sender.answer(self.message, footer.strip())
+            return
+        self._text += footer
+        await self._edit(final=True)
+
+    async def _rollover(self, tail: str) -> None:
+        """Фиксирует текущее сообщение и продолжает текст в новом"""
+        await self._edit(final=True)
+        self._sent = await self.sender.answer(self.message, PLACEHOLDER, parse_mode=None)
+        self._text = tail
+        self._shown = None
+
+    async def _edit(self, final: bool) -> None:
+        """Редактирует текущее сообщение, если текст изменился"""
+        text = self._text or PLACEHOLDER
+        if self._shown == (text, final):
+            return
+
+        try:
+            if final:
+                await self.sender.edit(self._sent, text)
+            else:
+                await self.sender.edit(self._sent, text, retry=False, parse_mode=None)
+        except TelegramRetryAfter as e:
+            # Промежуточную правку просто откладываем, финальную повторяем
+            if not final:
+                self._next_edit = time.monotonic() + e.retry_after
+                return
+            return await self._edit(final)
+        except TelegramBadRequest:
+            # Разметка ответа не разобралась — показываем как обычный текст.
+            # Если такой текст уже показан, Telegram вернет "message is not modified"
+            if final:
+                try:
+                    await self.sender.edit(self._sent, text, parse_mode=None)
+                except TelegramBadRequest:
+                    pass
+
+        self._shown = (text, final)
+        self._next_edit = time.monotonic() + self.edit_interval
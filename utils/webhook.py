@@ -0,0 +1,115 @@
+import asyncio
+import hmac
+from typing import List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from aiohttp import web
+
+from utils.logger import logger
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Прием апдейтов Telegram через вебхук.
+
+    HTTP-обработчик только проверяет секрет и кладет апдейт в ограниченную
+    очередь, а обработку выполняет пул воркеров. Если очередь заполнена
+    дольше enqueue_timeout, Telegram получает 503 и повторит доставку позже.
+    При остановке сервер перестает принимать апдейты и дорабатывает очередь.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, path: str = "/webhook", secret: Optional[str] = None,
+                 workers: int = 64, queue_size: int = 1000, enqueue_timeout: float = 1.0):
+        self.dp = dp
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._accepting = False
+        self._worker_tasks: List[asyncio.Task] = []
+        self._runner: Optional[web.AppRunner] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    async def start(self, host: str, port: int) -> int:
+        """
+        Запускает воркеры и HTTP-сервер
+
+        Args:
+            host: Адрес для прослушивания
+            port: Порт (0 — выбрать свободный)
+
+        Returns:
+            Фактический порт сервера
+        """
+        await self.dp.emit_startup(bot=self.bot, **self.dp.workflow_data)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._accepting = True
+
+        port = self._runner.addresses[0][1]
+        logger.info(f"Вебхук слушает {host}:{port}{self.path}, воркеров: {self.workers}")
+        return port
+
+    async def stop(self, drain_timeout: float = 30.0) -> None:
+        """
+        Останавливает прием и дожидается обработки уже принятых апдейтов
+
+        Args:
+            drain_timeout: Сколько ждать обработки очереди (сек)
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self.queue.qsize()} апдейтов при остановке")
+
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        if self._runner is not None:
+            await self._runner.cleanup()
+        await self.dp.emit_shutdown(bot=self.bot, **self.dp.workflow_data)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret is not None:
+            token = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(token.encode(), self.secret.encode()):
+                return web.Response(status=401)
+
+        if not self._accepting:
+            return web.Response(status=503)
+
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            await asyncio.wait_for(self.queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            # Очередь переполнена — Telegram повторит доставку позже
+            logger.warning("Очередь апдейтов переполнена, отвечаем 503")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()